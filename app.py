@@ -6,10 +6,30 @@ import random
 import string
 import mimetypes
 import json
+import bisect
+import csv
+import io
+import time
 import secrets
-from datetime import datetime
+import gzip
+import hashlib
+import hmac
+import zlib
+import smtplib
+import cProfile
+import pstats
+import queue
+import multiprocessing
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
 from pathlib import Path
 from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor
+
+# Начало импорта — от него считается время до готовности приложения
+IMPORT_STARTED = time.perf_counter()
 # from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла (если он есть)
@@ -22,22 +42,134 @@ try:
 except ImportError:
     pass
 
-from flask import Flask, render_template_string, request, redirect, url_for, flash, session, send_from_directory, jsonify
+from flask import Flask, render_template_string, request, redirect, url_for, flash, session, send_from_directory, jsonify, g, has_app_context, abort
+from flask import before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as BaseSession
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from flask_mail import Mail, Message
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from flask_mail import Mail, Message as MailMessage
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+
+# Pillow нужен для миниатюр и аватаров; без него отдаются оригиналы
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# brotli сжимает статические бандлы заметно лучше gzip (pip install brotli); без него — только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# MessagePack — компактная двоичная кодировка new_message для клиентов, которые её запросили (pip install msgpack)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Redis используется как общий кэш для нескольких воркеров, если задан CACHE_REDIS_URL
+try:
+    import redis
+except ImportError:
+    redis = None
 
 # ---------- Конфигурация ----------
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-key-12345')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///mateugram.db'
+# Абсолютный путь: без него SQLAlchemy кладёт базу в instance/, а FTP-синхронизация ищет её в рабочей папке
+app.config['DATABASE_PATH'] = os.path.abspath(os.getenv('DATABASE_PATH', 'mateugram.db'))
+app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{app.config['DATABASE_PATH']}"
+# Восстанавливать базу и файлы с FTP в create_app (gunicorn делает это один раз в мастере и выключает)
+app.config['FTP_RESTORE_ON_START'] = os.getenv('FTP_RESTORE_ON_START', '1') == '1'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+app.config['CHAT_PAGE_SIZE'] = 50
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'mp3', 'pdf', 'doc', 'docx'}
+app.config['IMAGE_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
+# Размеры вариантов изображений: аватар обрезается до квадрата, миниатюра вписывается в рамку
+app.config['IMAGE_VARIANTS'] = {'avatar': (160, 160), 'thumb': (480, 480)}
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))
+# Архив: сообщения старше ARCHIVE_AFTER_DAYS переносятся в сжатые сегменты по ARCHIVE_SEGMENT_SIZE штук,
+# в памяти держится ARCHIVE_CACHE_SEGMENTS последних прочитанных сегментов
+app.config['ARCHIVE_FOLDER'] = os.getenv('ARCHIVE_FOLDER', 'archive')
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+app.config['ARCHIVE_SEGMENT_SIZE'] = int(os.getenv('ARCHIVE_SEGMENT_SIZE', 1000))
+app.config['ARCHIVE_CACHE_SEGMENTS'] = int(os.getenv('ARCHIVE_CACHE_SEGMENTS', 32))
+
+# Кэши
+app.config['CACHE_REDIS_URL'] = os.getenv('CACHE_REDIS_URL')
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 300))
+app.config['MEMBERSHIP_CACHE_SIZE'] = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 50000))
+app.config['MEMBERSHIP_CACHE_TTL'] = int(os.getenv('MEMBERSHIP_CACHE_TTL', 600))
+
+# Присутствие: как часто рассылать накопленные изменения, сколько живёт «печатает…»
+# без обновления и как часто писать last_seen в базу (секунды)
+app.config['PRESENCE_INTERVAL'] = float(os.getenv('PRESENCE_INTERVAL', 1))
+app.config['TYPING_TTL'] = float(os.getenv('TYPING_TTL', 6))
+app.config['LAST_SEEN_FLUSH_INTERVAL'] = float(os.getenv('LAST_SEEN_FLUSH_INTERVAL', 30))
+# Как часто писать накопленные счётчики непрочитанных в базу (секунды)
+app.config['UNREAD_FLUSH_INTERVAL'] = float(os.getenv('UNREAD_FLUSH_INTERVAL', 5))
+
+# Догрузка пропущенных сообщений при переподключении: сколько последних событий держать
+# на комнату, для скольких комнат, и сколько сообщений максимум отдавать вместо перезагрузки страницы
+app.config['ROOM_BUFFER_SIZE'] = int(os.getenv('ROOM_BUFFER_SIZE', 100))
+app.config['ROOM_BUFFER_ROOMS'] = int(os.getenv('ROOM_BUFFER_ROOMS', 2000))
+app.config['CATCH_UP_LIMIT'] = int(os.getenv('CATCH_UP_LIMIT', 200))
+# Очередь Socket.IO (например, redis://) для нескольких воркеров gunicorn
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+
+# Рассылка new_message: MessagePack для клиентов, запросивших его в join, и окно (секунды), в течение
+# которого следующие сообщения чата копятся и уходят одним кадром (0 — каждое сразу), не больше MESSAGE_BATCH_MAX
+app.config['SOCKET_MSGPACK'] = os.getenv('SOCKET_MSGPACK', '1') == '1'
+app.config['MESSAGE_BATCH_WINDOW'] = float(os.getenv('MESSAGE_BATCH_WINDOW', 0.05))
+app.config['MESSAGE_BATCH_MAX'] = int(os.getenv('MESSAGE_BATCH_MAX', 50))
+
+# Горячий кэш последних сообщений: сколько держать на чат (не меньше страницы) и общий бюджет памяти в байтах.
+# Кэш в памяти процесса, поэтому при общем Redis (несколько воркеров) по умолчанию выключен
+app.config['RECENT_MESSAGES_CACHE'] = os.getenv('RECENT_MESSAGES_CACHE', '0' if os.getenv('CACHE_REDIS_URL') else '1') == '1'
+app.config['RECENT_MESSAGES_PER_CHAT'] = int(os.getenv('RECENT_MESSAGES_PER_CHAT', 60))
+app.config['RECENT_MESSAGES_BYTES'] = int(os.getenv('RECENT_MESSAGES_BYTES', 64 * 1024 * 1024))
+
+# Пароли: метод хэширования werkzeug ('scrypt', 'pbkdf2', 'pbkdf2:sha256:600000', ...) —
+# хэши с другими алгоритмом или параметрами пересчитываются при следующем входе.
+# Одновременно считается не больше PASSWORD_HASH_WORKERS хэшей, очередь ждёт слот до PASSWORD_HASH_WAIT секунд
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+app.config['PASSWORD_HASH_WAIT'] = float(os.getenv('PASSWORD_HASH_WAIT', 5))
+# Неудачные входы: после стольких подряд по имени пользователя / с одного IP вход закрыт на LOGIN_LOCKOUT секунд
+app.config['LOGIN_MAX_FAILURES'] = int(os.getenv('LOGIN_MAX_FAILURES', 5))
+app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(os.getenv('LOGIN_MAX_FAILURES_PER_IP', 50))
+app.config['LOGIN_LOCKOUT'] = int(os.getenv('LOGIN_LOCKOUT', 300))
+# Сколько прокси перед приложением дописывают X-Forwarded-For/-Proto (роутер платформы — один).
+# Без этого request.remote_addr — адрес прокси, и лимит по IP закрыл бы вход всем сразу. 0 — запуск без прокси
+app.config['PROXY_FIX_HOPS'] = int(os.getenv('PROXY_FIX_HOPS', 1))
+
+# Сжатие HTML/JSON-ответов: не меньше COMPRESS_MIN_SIZE байт, brotli (если установлен) или gzip.
+# Для ответов на лету качество ниже, чем у статики: сжатие идёт на каждый запрос.
+# Потоковые ответы сжимаются по кускам (COMPRESS_STREAMING), сжатые стабильные страницы кэшируются
+app.config['COMPRESS_ENABLED'] = os.getenv('COMPRESS_ENABLED', '1') == '1'
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_GZIP_LEVEL'] = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+app.config['COMPRESS_STREAMING'] = os.getenv('COMPRESS_STREAMING', '1') == '1'
+app.config['COMPRESS_CACHE_SIZE'] = int(os.getenv('COMPRESS_CACHE_SIZE', 256))
+
+# Секрет для /metrics (Prometheus передаёт его как Bearer-токен); по умолчанию совпадает с SYNC_SECRET
+app.config['METRICS_SECRET'] = os.getenv('METRICS_SECRET')
+# Профилировщик медленных запросов: порог в мс и сколько последних трасс хранить
+app.config['SLOW_REQUEST_MS'] = int(os.getenv('SLOW_REQUEST_MS', 500))
+app.config['SLOW_TRACES'] = int(os.getenv('SLOW_TRACES', 50))
 
 # Настройки почты (mail.ru)
 app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.mail.ru')
@@ -46,23 +178,475 @@ app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL', 'True').lower() == 'true'
 app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = app.config['MAIL_USERNAME']
+# Очередь исходящей почты: письма лежат в таблице outbound_mail, фоновый воркер отправляет их
+# пачками через одно SMTP-соединение, не быстрее MAIL_RATE_PER_MINUTE (лимит провайдера на процесс)
+# и повторяет неудачные с экспоненциальной задержкой от MAIL_RETRY_DELAY секунд
+app.config['MAIL_QUEUE_WORKER'] = os.getenv('MAIL_QUEUE_WORKER', '1') == '1'
+app.config['MAIL_BATCH_SIZE'] = int(os.getenv('MAIL_BATCH_SIZE', 20))
+app.config['MAIL_RATE_PER_MINUTE'] = float(os.getenv('MAIL_RATE_PER_MINUTE', 30))
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.getenv('MAIL_MAX_ATTEMPTS', 6))
+app.config['MAIL_RETRY_DELAY'] = float(os.getenv('MAIL_RETRY_DELAY', 30))
+app.config['MAIL_POLL_INTERVAL'] = float(os.getenv('MAIL_POLL_INTERVAL', 10))
+# Письмо после регистрации — по умолчанию только если почта настроена
+app.config['MAIL_ON_REGISTER'] = os.getenv('MAIL_ON_REGISTER', '1' if app.config['MAIL_USERNAME'] else '0') == '1'
+
+def socketio_async_mode():
+    """eventlet — только если процесс уже пропатчен (воркер gunicorn -k eventlet),
+    иначе обычные потоки: сам по себе установленный eventlet не должен менять режим dev-сервера."""
+    mode = os.getenv('SOCKETIO_ASYNC_MODE')
+    if mode:
+        return mode
+    # Воркер eventlet импортирует его сам; если модуля нет в sys.modules, не тратим время на импорт
+    eventlet = sys.modules.get('eventlet')
+    if eventlet is not None:
+        import eventlet.patcher
+        if eventlet.patcher.is_monkey_patched('socket'):
+            return 'eventlet'
+    return 'threading'
+
+# ---------- Шарды сообщений ----------
+# По умолчанию всё лежит в одной базе. При MESSAGE_SHARDS > 1 таблицы сообщений (SHARDED_TABLES)
+# хранятся в отдельных файлах mateugram-shard<N>.db, шард чата — chat_id % MESSAGE_SHARDS,
+# а пользователи, чаты и участники остаются в основной базе (каталоге).
+# id строк шарда N начинаются с N * SHARD_ID_SPAN, поэтому шард сообщения виден по одному id.
+# От числа шардов зависят id, поэтому оно читается при импорте; перенос старой базы — python app.py shard
+MESSAGE_SHARDS = max(1, int(os.getenv('MESSAGE_SHARDS', 1)))
+SHARD_ID_SPAN = 2 ** 40  # с запасом укладывается в безопасные целые JavaScript
+SHARDED_TABLES = ('message', 'reaction', 'comment')
+# AUTOINCREMENT: id шарда продолжают sqlite_sequence, заданный при его создании
+SHARD_TABLE_ARGS = {'sqlite_autoincrement': MESSAGE_SHARDS > 1}
+current_shard = ContextVar('current_shard', default=None)
+
+class ShardedSession(BaseSession):
+    """Запросы к таблицам сообщений идут в шард, выбранный use_chat_shard()/use_message_shard()
+    или shard_scope(); всё остальное — как обычно, в основную базу."""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and MESSAGE_SHARDS > 1 and mapper is not None:
+            table = db.inspect(mapper).local_table.name
+            if table in SHARDED_TABLES:
+                shard = current_shard.get()
+                if shard is None:
+                    raise RuntimeError(f"Shard is not selected for table {table}")
+                return self._db.engines[f'shard{shard}']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def shard_of_chat(chat_id):
+    return int(chat_id) % MESSAGE_SHARDS
+
+def shard_of_message(message_id):
+    return int(message_id) // SHARD_ID_SPAN % MESSAGE_SHARDS
+
+def use_chat_shard(chat_id):
+    """Выбирает шард чата до конца запроса или события Socket.IO."""
+    current_shard.set(shard_of_chat(chat_id))
+
+def use_message_shard(message_id):
+    """Выбирает шард по id сообщения; некорректный id уходит в шард 0, где его просто не найдут."""
+    try:
+        current_shard.set(shard_of_message(message_id))
+    except (TypeError, ValueError):
+        current_shard.set(0)
+
+@contextmanager
+def shard_scope(shard):
+    """Шард на время блока — для циклов по нескольким чатам и фоновых задач."""
+    token = current_shard.set(shard)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+@app.before_request
+def reset_shard():
+    # Поток может обслуживать запросы по очереди — выбор шарда прошлого запроса не должен переходить в новый
+    current_shard.set(None)
 
-db = SQLAlchemy(app)
-mail = Mail(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
-login_manager = LoginManager(app)
+def shard_path(shard):
+    return f"{os.path.splitext(app.config['DATABASE_PATH'])[0]}-shard{shard}.db"
+
+def shard_engine(shard):
+    return db.engines[f'shard{shard}'] if MESSAGE_SHARDS > 1 else db.engine
+
+def database_files():
+    """{имя на FTP: локальный путь} основной базы и шардов."""
+    files = {'mateugram.db': app.config['DATABASE_PATH']}
+    if MESSAGE_SHARDS > 1:
+        for shard in range(MESSAGE_SHARDS):
+            files[f'mateugram-shard{shard}.db'] = shard_path(shard)
+    return files
+
+def database_of(table):
+    """Имя на FTP файла базы, в который сейчас пишется таблица table."""
+    if MESSAGE_SHARDS > 1 and table in SHARDED_TABLES:
+        return f'mateugram-shard{current_shard.get()}.db'
+    return 'mateugram.db'
+
+# Расширения подключаются к приложению в create_app()
+db = SQLAlchemy(session_options={'class_': ShardedSession})
+mail = Mail()
+socketio = SocketIO()
+login_manager = LoginManager()
 login_manager.login_view = 'login'
 
-# Создание папок
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs('photos', exist_ok=True)
+def start_background_task(target, *args):
+    """Долгая фоновая задача в модели Socket.IO: под eventlet — green thread, который уступает
+    циклу событий, в режиме потоков — поток-демон, чтобы не задерживать выход процесса."""
+    if getattr(socketio, 'async_mode', None) == 'threading':
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+    return socketio.start_background_task(target, *args)
+
+# ---------- Служебные эндпоинты ----------
+def secret_required(secret=lambda: SYNC_SECRET, bearer=False):
+    """Декоратор служебных эндпоинтов: без секрета в X-Sync-Secret (или, при bearer, в Authorization: Bearer)
+    ответ 403. secret — функция, потому что SYNC_SECRET задаётся ниже; сравнение за постоянное время."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            expected = secret().encode()
+            supplied = [request.headers.get('X-Sync-Secret', '')]
+            auth = request.headers.get('Authorization', '')
+            if bearer and auth.startswith('Bearer '):
+                supplied.append(auth[len('Bearer '):])
+            if not any(value and hmac.compare_digest(value.encode(), expected) for value in supplied):
+                return 'Unauthorized', 403
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ---------- Метрики ----------
+class Metrics:
+    """Счётчики и гистограммы в памяти процесса, отдаются на /metrics в формате Prometheus."""
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}        # имя -> (тип, описание, границы корзин)
+        self.counters = {}    # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики корзин..., +Inf, сумма]
+        self.gauges = {}      # имя -> функция, возвращающая [(метки, значение)]
+
+    def counter(self, name, help_text):
+        self.meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.meta[name] = ('histogram', help_text, buckets)
+
+    def gauge(self, name, help_text, func):
+        self.meta[name] = ('gauge', help_text, None)
+        self.gauges[name] = func
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            data = self.histograms.get(key)
+            if data is None:
+                data = self.histograms[key] = [0] * (len(buckets) + 2)
+            data[bisect.bisect_left(buckets, value)] += 1
+            data[-1] += value
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        # Текстовый формат Prometheus: в значении метки экранируются обратная косая черта, кавычка и перевод строки
+        return '{' + ','.join(f'{k}="{Metrics._escape(v)}"' for k, v in labels) + '}'
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        for name, (kind, help_text, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (metric, labels), value in counters.items():
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+            elif kind == 'gauge':
+                try:
+                    values = self.gauges[name]()
+                except Exception:
+                    values = []
+                for labels, value in values:
+                    lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+            else:
+                for (metric, labels), data in histograms.items():
+                    if metric != name:
+                        continue
+                    total = 0
+                    for bound, count in zip(buckets + ('+Inf',), data[:-1]):
+                        total += count
+                        lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {total}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {data[-1]}")
+                    lines.append(f"{name}_count{self._labels(labels)} {total}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('mateugram_http_request_duration_seconds', 'HTTP request latency by endpoint')
+metrics.counter('mateugram_http_requests_total', 'HTTP requests by endpoint and status')
+metrics.histogram('mateugram_sql_statements_per_request', 'SQL statements executed per HTTP request', Metrics.COUNT_BUCKETS)
+metrics.histogram('mateugram_sql_seconds_per_request', 'Time spent in SQL per HTTP request')
+metrics.counter('mateugram_sql_statements_total', 'SQL statements executed')
+metrics.counter('mateugram_sql_seconds_total', 'Time spent executing SQL')
+metrics.histogram('mateugram_socketio_event_duration_seconds', 'Socket.IO event handler latency')
+metrics.counter('mateugram_ftp_bytes_total', 'Bytes transferred to/from FTP')
+metrics.counter('mateugram_ftp_operations_total', 'FTP file transfers')
+metrics.counter('mateugram_ftp_errors_total', 'FTP failures')
+metrics.histogram('mateugram_ftp_sync_duration_seconds', 'Full FTP sync duration', (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+def socket_rooms():
+    """Комнаты Socket.IO в пространстве имён '/': {комната: число сокетов}."""
+    try:
+        rooms = socketio.server.manager.rooms.get('/', {})
+    except AttributeError:
+        return {}
+    # copy(): в режиме threading другие потоки добавляют комнаты во время обхода
+    return {room: len(sids) for room, sids in rooms.copy().items()}
+
+metrics.gauge('mateugram_socketio_connected', 'Connected Socket.IO clients',
+              lambda: [({}, socket_rooms().get(None, 0))])
+metrics.gauge('mateugram_process_cpu_seconds', 'CPU time used by this process',
+              lambda: [({}, round(time.process_time(), 3))])
+metrics.gauge('mateugram_socketio_chat_rooms', 'Chat rooms with at least one connected client',
+              lambda: [({}, sum(1 for r in socket_rooms() if isinstance(r, str) and r.startswith('chat_')))])
+# Размеры всех комнат дали бы метку на каждый чат — отдаём только самые большие
+metrics.gauge('mateugram_socketio_room_size', 'Connected clients in the 20 largest chat rooms',
+              lambda: [({'room': r}, n) for r, n in sorted(
+                  ((r, n) for r, n in socket_rooms().items() if isinstance(r, str) and r.startswith('chat_')),
+                  key=lambda item: -item[1])[:20]])
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sql_timer_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def sql_timer_stop(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        # Событие без парного before_cursor_execute (слушатель подключился посреди запроса) — время неизвестно
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    metrics.inc('mateugram_sql_statements_total')
+    metrics.inc('mateugram_sql_seconds_total', elapsed)
+    if has_app_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_time = g.get('sql_time', 0.0) + elapsed
+        sql_log = g.get('sql_log')
+        if sql_log is not None:
+            sql_log.append((statement, elapsed))
+
+@app.before_request
+def request_timer_start():
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+
+@app.after_request
+def request_timer_stop(response):
+    start = g.get('request_start')
+    if start is not None:
+        endpoint = request.endpoint or 'unknown'
+        metrics.observe('mateugram_http_request_duration_seconds', time.perf_counter() - start, endpoint=endpoint)
+        metrics.inc('mateugram_http_requests_total', endpoint=endpoint, status=response.status_code)
+        metrics.observe('mateugram_sql_statements_per_request', g.get('sql_count', 0), endpoint=endpoint)
+        metrics.observe('mateugram_sql_seconds_per_request', g.get('sql_time', 0.0), endpoint=endpoint)
+    return response
+
+def timed_event(name):
+    """Декоратор для обработчиков Socket.IO: пишет длительность в метрики."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe('mateugram_socketio_event_duration_seconds', time.perf_counter() - start, event=name)
+        return wrapper
+    return decorator
+
+def counting_writer(write, direction):
+    """Оборачивает callback retrbinary, чтобы считать скачанные байты."""
+    def wrapper(data):
+        metrics.inc('mateugram_ftp_bytes_total', len(data), direction=direction)
+        return write(data)
+    return wrapper
+
+@app.route('/metrics')
+@secret_required(lambda: app.config['METRICS_SECRET'] or SYNC_SECRET, bearer=True)
+def metrics_endpoint():
+    """Метрики в формате Prometheus. Требует Bearer-токен или X-Sync-Secret."""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# ---------- Профилирование медленных запросов ----------
+class RequestProfiler:
+    """Включаемый на лету профилировщик: запросы дольше порога сохраняются
+    в кольцевой буфер вместе с SQL, временем рендера шаблонов и выводом cProfile."""
+    MAX_STATEMENTS = 200
+
+    def __init__(self, threshold_ms, size):
+        self.lock = threading.Lock()
+        # Профилируется один запрос за раз: cProfile (в Python 3.12 — sys.monitoring) один на процесс,
+        # а под eventlet все запросы делят один поток ОС и попали бы в чужой профиль
+        self.running = threading.Lock()
+        self.enabled = False
+        self.threshold_ms = threshold_ms
+        self.traces = deque(maxlen=size)
+        self.next_id = 1
+
+    def configure(self, enabled=None, threshold_ms=None):
+        with self.lock:
+            if enabled is not None:
+                self.enabled = enabled
+            if threshold_ms is not None:
+                self.threshold_ms = threshold_ms
+
+    def add(self, trace):
+        with self.lock:
+            trace['id'] = self.next_id
+            self.next_id += 1
+            self.traces.append(trace)
+
+    def get(self, trace_id):
+        with self.lock:
+            for trace in self.traces:
+                if trace['id'] == trace_id:
+                    return trace
+        return None
+
+    def summary(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'threshold_ms': self.threshold_ms,
+                'traces': [{k: t[k] for k in ('id', 'time', 'method', 'path', 'status',
+                                               'duration_ms', 'sql_count', 'sql_ms', 'template_ms')}
+                           for t in reversed(self.traces)]
+            }
+
+profiler = RequestProfiler(app.config['SLOW_REQUEST_MS'], app.config['SLOW_TRACES'])
+
+@app.before_request
+def profile_start():
+    if not profiler.enabled or not profiler.running.acquire(blocking=False):
+        return
+    g.profiling = True
+    g.sql_log = []
+    g.template_time = 0.0
+    g.profile = cProfile.Profile()
+    try:
+        g.profile.enable()
+    except ValueError:
+        # cProfile занят кем-то вне профилировщика — обходимся без него
+        g.profile = None
+
+@before_render_template.connect_via(app)
+def template_timer_start(sender, template, context, **extra):
+    if g.get('sql_log') is not None:
+        g.template_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def template_timer_stop(sender, template, context, **extra):
+    start = g.pop('template_start', None)
+    if start is not None:
+        g.template_time += time.perf_counter() - start
+
+@app.after_request
+def profile_stop(response):
+    sql_log = g.pop('sql_log', None)
+    if sql_log is None:
+        return response
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+    duration_ms = (time.perf_counter() - g.request_start) * 1000
+    if duration_ms < profiler.threshold_ms:
+        return response
+    stats_text = ''
+    if profile is not None:
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(40)
+        stats_text = out.getvalue()
+    profiler.add({
+        'time': datetime.utcnow().isoformat(timespec='seconds'),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(duration_ms, 1),
+        'sql_count': len(sql_log),
+        'sql_ms': round(sum(t for _, t in sql_log) * 1000, 1),
+        'template_ms': round(g.get('template_time', 0.0) * 1000, 1),
+        'sql': [{'statement': stmt, 'ms': round(t * 1000, 2)} for stmt, t in sql_log[:RequestProfiler.MAX_STATEMENTS]],
+        'profile': stats_text
+    })
+    return response
+
+@app.teardown_request
+def profile_release(exc):
+    # Выполняется и после необработанного исключения, когда after_request мог не дойти до disable()
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+    if g.pop('profiling', False):
+        profiler.running.release()
+
+@app.route('/profiler', methods=['GET', 'POST'])
+@secret_required()
+def profiler_control():
+    """GET — список медленных запросов, POST — включить/выключить профилировщик
+    (enabled=1/0, threshold_ms=N). Требует секретный заголовок."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        enabled = data.get('enabled')
+        if isinstance(enabled, str):
+            enabled = enabled.lower() in ('1', 'true', 'on', 'yes')
+        threshold_ms = data.get('threshold_ms')
+        if threshold_ms is not None:
+            try:
+                threshold_ms = int(threshold_ms)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'threshold_ms must be an integer'}), 400
+            if threshold_ms < 0:
+                return jsonify({'error': 'threshold_ms must be non-negative'}), 400
+        profiler.configure(enabled, threshold_ms)
+    return jsonify(profiler.summary())
+
+@app.route('/profiler/<int:trace_id>')
+@secret_required()
+def profiler_trace(trace_id):
+    """Полная трасса медленного запроса: SQL с временем и вывод cProfile. ?format=text — текстом."""
+    trace = profiler.get(trace_id)
+    if trace is None:
+        return 'Not found', 404
+    if request.args.get('format') != 'text':
+        return jsonify(trace)
+    lines = [f"{trace['method']} {trace['path']} -> {trace['status']}  {trace['duration_ms']} ms",
+             f"SQL: {trace['sql_count']} statements, {trace['sql_ms']} ms; templates: {trace['template_ms']} ms", '']
+    lines += [f"{q['ms']:>8} ms  {q['statement']}" for q in trace['sql']]
+    lines += ['', trace['profile']]
+    return '\n'.join(lines), 200, {'Content-Type': 'text/plain; charset=utf-8'}
 
 # ---------- FTP-синхронизация (через переменные окружения) ----------
 FTP_HOST = os.getenv('FTP_HOST')
 FTP_USER = os.getenv('FTP_USER')
 FTP_PASS = os.getenv('FTP_PASS')
+FTP_PORT = int(os.getenv('FTP_PORT', 21))
 FTP_BASE_PATH = os.getenv('FTP_BASE_PATH', '/mateugram')  # папка на FTP, где хранятся данные
-LOCAL_DB_PATH = 'mateugram.db'
 LOCAL_UPLOAD_FOLDER = 'uploads'
 
 # Блокировка для потокобезопасной работы с FTP
@@ -77,7 +661,9 @@ def get_ftp_connection():
         print("FTP credentials are not set. Check environment variables.")
         return None
     try:
-        ftp = ftplib.FTP(FTP_HOST, FTP_USER, FTP_PASS, timeout=10)
+        ftp = ftplib.FTP(timeout=10)
+        ftp.connect(FTP_HOST, FTP_PORT)
+        ftp.login(FTP_USER, FTP_PASS)
         ftp.encoding = 'utf-8'
         # Переходим в рабочую папку, создаём если нет
         try:
@@ -96,6 +682,7 @@ def get_ftp_connection():
         return ftp
     except Exception as e:
         print(f"FTP connection error: {e}")
+        metrics.inc('mateugram_ftp_errors_total', op='connect')
         return None
 
 def download_file_from_ftp(remote_path, local_path):
@@ -104,18 +691,21 @@ def download_file_from_ftp(remote_path, local_path):
         ftp = get_ftp_connection()
         if not ftp:
             return False
-        # Проверяем, существует ли файл
+        # Проверяем, существует ли файл (SIZE многие серверы выполняют только в двоичном режиме)
         try:
+            ftp.voidcmd('TYPE I')
             ftp.size(remote_path)
         except ftplib.error_perm:
             ftp.quit()
             return False
         with open(local_path, 'wb') as f:
-            ftp.retrbinary(f'RETR {remote_path}', f.write)
+            ftp.retrbinary(f'RETR {remote_path}', counting_writer(f.write, 'download'))
         ftp.quit()
+        metrics.inc('mateugram_ftp_operations_total', direction='download')
         return True
     except Exception as e:
         print(f"Download error: {e}")
+        metrics.inc('mateugram_ftp_errors_total', op='download')
         return False
 
 def upload_file_to_ftp(local_path, remote_path):
@@ -127,21 +717,25 @@ def upload_file_to_ftp(local_path, remote_path):
         with open(local_path, 'rb') as f:
             ftp.storbinary(f'STOR {remote_path}', f)
         ftp.quit()
+        metrics.inc('mateugram_ftp_operations_total', direction='upload')
+        metrics.inc('mateugram_ftp_bytes_total', os.path.getsize(local_path), direction='upload')
         return True
     except Exception as e:
         print(f"Upload error: {e}")
+        metrics.inc('mateugram_ftp_errors_total', op='upload')
         return False
 
 def sync_from_ftp():
     """При запуске: скачиваем базу и все файлы из uploads с FTP."""
     print("Syncing from FTP...")
+    start = time.perf_counter()
     with ftp_lock:
-        # Скачиваем базу данных
-        db_remote = 'mateugram.db'
-        if download_file_from_ftp(db_remote, LOCAL_DB_PATH):
-            print("Database downloaded.")
-        else:
-            print("No remote database found, will create new one.")
+        # Скачиваем базу данных и шарды сообщений
+        for db_remote, db_local in database_files().items():
+            if download_file_from_ftp(db_remote, db_local):
+                print(f"Database {db_remote} downloaded.")
+            else:
+                print(f"No remote database {db_remote} found, will create new one.")
 
         # Скачиваем все файлы из папки uploads (рекурсивно)
         try:
@@ -170,21 +764,34 @@ def sync_from_ftp():
                             local_file = os.path.join(local_dir, name)
                             remote_file = f"{remote_dir}/{name}"
                             with open(local_file, 'wb') as f:
-                                ftp.retrbinary(f'RETR {remote_file}', f.write)
+                                ftp.retrbinary(f'RETR {remote_file}', counting_writer(f.write, 'download'))
+                            metrics.inc('mateugram_ftp_operations_total', direction='download')
                             print(f"Downloaded {remote_file}")
                 download_dir('.', LOCAL_UPLOAD_FOLDER)
                 ftp.quit()
         except Exception as e:
             print(f"FTP sync error during download: {e}")
+            metrics.inc('mateugram_ftp_errors_total', op='sync_from')
+        finally:
+            metrics.observe('mateugram_ftp_sync_duration_seconds', time.perf_counter() - start, direction='download')
 
-def sync_to_ftp():
-    """Загружает базу и все файлы из uploads на FTP (полная синхронизация)."""
+def sync_to_ftp(full=False):
+    """Загружает на FTP изменившиеся файлы баз (при full — все) и все файлы из uploads."""
     print("Syncing to FTP...")
+    start = time.perf_counter()
     with ftp_lock:
-        # Загружаем базу данных
-        if os.path.exists(LOCAL_DB_PATH):
-            upload_file_to_ftp(LOCAL_DB_PATH, 'mateugram.db')
-            print("Database uploaded.")
+        # Загружаем базы: при шардах — только те, в которые писали с прошлой синхронизации
+        databases = database_files()
+        changed = change_tracker.take_databases()
+        if full:
+            changed = set(databases)
+        for db_remote, db_local in databases.items():
+            if db_remote not in changed or not os.path.exists(db_local):
+                continue
+            if upload_file_to_ftp(db_local, db_remote):
+                print(f"Database {db_remote} uploaded.")
+            else:
+                change_tracker.record_databases({db_remote})
 
         # Загружаем все файлы из локальной папки uploads
         try:
@@ -226,19 +833,150 @@ def sync_to_ftp():
                         remote_file = f"{remote_subdir}/{file}"
                         with open(local_file, 'rb') as f:
                             ftp.storbinary(f'STOR {remote_file}', f)
+                        metrics.inc('mateugram_ftp_operations_total', direction='upload')
+                        metrics.inc('mateugram_ftp_bytes_total', os.path.getsize(local_file), direction='upload')
                         print(f"Uploaded {remote_file}")
             upload_dir(LOCAL_UPLOAD_FOLDER, 'uploads')
             ftp.quit()
         except Exception as e:
             print(f"FTP sync error during upload: {e}")
+            metrics.inc('mateugram_ftp_errors_total', op='sync_to')
+        finally:
+            metrics.observe('mateugram_ftp_sync_duration_seconds', time.perf_counter() - start, direction='upload')
+
+# ---------- Отслеживание изменений ----------
+class ChangeTracker:
+    """Помнит, изменились ли данные с прошлой синхронизации.
+    Данные считаются изменёнными, только если коммит реально затронул строки
+    или в UPLOAD_FOLDER был записан файл."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.table_changes = Counter()
+        self.databases = set()  # файлы баз (имена на FTP), изменённые с прошлой выгрузки
+        self.file_writes = 0
+        self.syncs_started = 0
+        self.syncs_skipped = 0
+
+    def record_rows(self, counts, databases):
+        with self.lock:
+            self.table_changes.update(counts)
+            self.databases.update(databases)
+            self.dirty = True
+
+    def record_databases(self, databases):
+        with self.lock:
+            self.databases.update(databases)
+
+    def take_databases(self):
+        with self.lock:
+            databases, self.databases = self.databases, set()
+            return databases
+
+    def record_file(self):
+        with self.lock:
+            self.file_writes += 1
+            self.dirty = True
+
+    def take_dirty(self):
+        """Возвращает признак изменений и сбрасывает его."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, False
+            if dirty:
+                self.syncs_started += 1
+            else:
+                self.syncs_skipped += 1
+            return dirty
+
+    def stats(self):
+        with self.lock:
+            return {'dirty': self.dirty, 'table_changes': dict(self.table_changes),
+                    'dirty_databases': sorted(self.databases),
+                    'file_writes': self.file_writes, 'syncs_started': self.syncs_started,
+                    'syncs_skipped': self.syncs_skipped}
+
+change_tracker = ChangeTracker()
+
+# Изменённые строки копятся в session.info до коммита и отбрасываются при откате
+@event.listens_for(db.session, 'after_flush')
+def track_flush(session, flush_context):
+    pending = session.info.setdefault('changed_tables', Counter())
+    databases = session.info.setdefault('changed_databases', set())
+    changed = list(session.new) + list(session.deleted)
+    changed += [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    for obj in changed:
+        pending[obj.__tablename__] += 1
+        databases.add(database_of(obj.__tablename__))
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_statement(orm_execute_state):
+    """Массовые query.update()/delete() и insert() идут мимо flush — учитываем их по rowcount."""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return None
+    result = orm_execute_state.invoke_statement()
+    rowcount = getattr(result, 'rowcount', None)
+    if rowcount is None or rowcount < 0:
+        params = orm_execute_state.parameters
+        rowcount = len(params) if isinstance(params, list) else 1
+    if rowcount and orm_execute_state.bind_mapper is not None:
+        info = orm_execute_state.session.info
+        table = orm_execute_state.bind_mapper.local_table.name
+        info.setdefault('changed_tables', Counter())[table] += rowcount
+        info.setdefault('changed_databases', set()).add(database_of(table))
+    return result
+
+@event.listens_for(db.session, 'after_commit')
+def track_commit(session):
+    pending = session.info.pop('changed_tables', None)
+    databases = session.info.pop('changed_databases', set())
+    if pending:
+        change_tracker.record_rows(pending, databases)
+
+@event.listens_for(db.session, 'after_rollback')
+def track_rollback(session):
+    session.info.pop('changed_tables', None)
+    session.info.pop('changed_databases', None)
+
+def save_upload(file, filename):
+    """Сохраняет загруженный файл в UPLOAD_FOLDER и помечает данные для синхронизации."""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(path)
+    change_tracker.record_file()
+    return path
+
+def avatar_filename(original):
+    """Имя нового аватара. Уникальное: иначе повторная загрузка файла с тем же именем
+    отдавала бы старый вариант, пока новый не обработан."""
+    return secure_filename(f"{current_user.id}_{secrets.token_hex(4)}_{original}")
+
+def request_sync():
+    """Запускает синхронизацию в фоне, если с прошлого запуска что-то изменилось."""
+    if change_tracker.take_dirty():
+        threading.Thread(target=sync_to_ftp, daemon=True).start()
+
+def final_sync():
+    """Вызывается при остановке процесса: дожидается фоновой выгрузки
+    и выгружает изменения, которые ещё не попали на FTP."""
+    try:
+        flush_last_seen(include_online=True)
+    except Exception as e:
+        print(f"last_seen flush error: {e}")
+    try:
+        flush_unread()
+    except Exception as e:
+        print(f"Unread flush error: {e}")
+    with ftp_lock:
+        pass
+    if change_tracker.take_dirty():
+        sync_to_ftp()
 
 # ---------- Декоратор для синхронизации после изменений ----------
 def sync_after_change(func):
-    """Декоратор: выполняет функцию, затем запускает синхронизацию в фоне."""
+    """Декоратор: выполняет функцию, затем запускает синхронизацию в фоне, если данные изменились."""
     @wraps(func)
     def wrapper(*args, **kwargs):
         result = func(*args, **kwargs)
-        threading.Thread(target=sync_to_ftp, daemon=True).start()
+        request_sync()
         return result
     return wrapper
 
@@ -249,16 +987,17 @@ def ping():
     return 'pong', 200
 
 @app.route('/sync-ftp', methods=['POST'])
+@secret_required()
 def sync_ftp():
     """Вызывает полную синхронизацию с FTP. Требует секретный заголовок."""
-    auth = request.headers.get('X-Sync-Secret')
-    if auth != SYNC_SECRET:
-        return 'Unauthorized', 403
-    threading.Thread(target=sync_to_ftp, daemon=True).start()
+    threading.Thread(target=sync_to_ftp, kwargs={'full': True}, daemon=True).start()
     return 'Sync started', 202
 
-# ---------- Загрузка данных при старте ----------
-sync_from_ftp()
+@app.route('/sync-stats')
+@secret_required()
+def sync_stats():
+    """Счётчики изменений по таблицам и запусков синхронизации. Требует секретный заголовок."""
+    return jsonify(change_tracker.stats())
 
 # ---------- Модели базы данных ----------
 class User(UserMixin, db.Model):
@@ -273,12 +1012,14 @@ class User(UserMixin, db.Model):
     avatar = db.Column(db.String(200), default='default.jpg')
     verified = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Обновляется пачками из PresenceTracker, а не на каждое событие сокета
+    last_seen = db.Column(db.DateTime, nullable=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
 class Chat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -289,15 +1030,26 @@ class Chat(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     invite_token = db.Column(db.String(50), unique=True, nullable=True)
+    # Для личных чатов: "меньший_id:больший_id" участников, уникален — один чат на пару
+    private_key = db.Column(db.String(40), nullable=True)
 
     linked_group = db.relationship('Chat', remote_side=[id], foreign_keys=[linked_group_id])
 
+    __table_args__ = (db.Index('ix_chat_private_key', 'private_key', unique=True),)
+
 class ChatMember(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'))
     role = db.Column(db.String(20), default='member')
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Непрочитанные сообщения; свежие изменения сначала копятся в UnreadCounters
+    unread_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_chat_member_user_chat', 'user_id', 'chat_id'),
+        db.Index('ix_chat_member_chat', 'chat_id'),
+    )
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -312,6 +1064,10 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     edited = db.Column(db.Boolean, default=False)
     pinned = db.Column(db.Boolean, default=False)
+    # Счётчик комментариев, чтобы не считать их для каждого сообщения при отрисовке чата
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Сообщения из архивных сегментов (ArchivedMessage) только для чтения
+    archived = False
 
     replies = db.relationship(
         'Message',
@@ -322,12 +1078,16 @@ class Message(db.Model):
     reactions = db.relationship('Reaction', backref='message', lazy='dynamic')
     comments = db.relationship('Comment', backref='message', lazy='dynamic')
 
+    __table_args__ = (db.Index('ix_message_chat_id', 'chat_id', 'id'), SHARD_TABLE_ARGS)
+
 class Reaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     reaction = db.Column(db.String(10))
 
+    __table_args__ = SHARD_TABLE_ARGS
+
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -335,15 +1095,252 @@ class Comment(db.Model):
     content = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    user = db.relationship('User')
+
+    __table_args__ = (db.Index('ix_comment_message_id', 'message_id', 'id'), SHARD_TABLE_ARGS)
+
+class OutboundMail(db.Model):
+    """Письмо в очереди: pending -> sending (захвачено воркером) -> sent или failed."""
+    __tablename__ = 'outbound_mail'
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(10), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # Когда письмо можно брать в работу: время повтора, а у захваченного — срок аренды
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claim = db.Column(db.String(32), nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_outbound_mail_due', 'status', 'next_attempt_at'),)
+
+class ArchiveSegment(db.Model):
+    """Индекс архива: какой диапазон id чата лежит в каком файле сегмента."""
+    __tablename__ = 'archive_segment'
+    id = db.Column(db.Integer, primary_key=True)
+    chat_id = db.Column(db.Integer, nullable=False)
+    first_id = db.Column(db.Integer, nullable=False)
+    last_id = db.Column(db.Integer, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(100), nullable=False, unique=True)
+    size = db.Column(db.Integer, nullable=False)
+    uploaded = db.Column(db.Boolean, default=False, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_archive_segment_chat', 'chat_id', 'last_id'),)
+
+# ---------- Кэширование ----------
+class LRUCache:
+    """Потокобезопасный LRU-кэш в памяти процесса с TTL и счётчиками попаданий."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def incr(self, key):
+        """Атомарно увеличивает счётчик на 1 и продлевает его TTL. Возвращает новое значение."""
+        with self._lock:
+            item = self._data.get(key)
+            value = item[0] + 1 if item is not None and item[1] >= time.monotonic() else 1
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'backend': 'memory', 'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+class RedisCache:
+    """Тот же интерфейс поверх Redis: кэш общий для всех воркеров. Значения хранятся в JSON."""
+    def __init__(self, client, prefix, ttl):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f"mateugram:{self.prefix}:{key}"
+
+    def get(self, key, default=None):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self._key(key), json.dumps(value), ex=self.ttl)
+
+    def incr(self, key):
+        pipe = self.client.pipeline()
+        pipe.incr(self._key(key))
+        pipe.expire(self._key(key), self.ttl)
+        return pipe.execute()[0]
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        for key in self.client.scan_iter(self._key('*')):
+            self.client.delete(key)
+
+    def stats(self):
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses}
+
+caches = {}
+
+def make_cache(name, maxsize, ttl):
+    """Создаёт именованный кэш: Redis, если он настроен, иначе LRU в памяти."""
+    if redis is not None and app.config['CACHE_REDIS_URL']:
+        cache = RedisCache(redis.Redis.from_url(app.config['CACHE_REDIS_URL']), name, ttl)
+    else:
+        cache = LRUCache(maxsize, ttl)
+    caches[name] = cache
+    return cache
+
+# Профили пользователей: всё, что нужно для отрисовки имени и аватара и для load_user.
+# Хэш пароля и даты не кэшируются — при обращении SQLAlchemy дочитает их из БД.
+USER_CACHE_FIELDS = ('id', 'username', 'first_name', 'last_name', 'email',
+                     'avatar', 'verified', 'birth_day', 'birth_month')
+UserProfile = namedtuple('UserProfile', USER_CACHE_FIELDS)
+
+user_profile_cache = make_cache('users', app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+def cache_user(user):
+    profile = {field: getattr(user, field) for field in USER_CACHE_FIELDS}
+    user_profile_cache.set(user.id, profile)
+    return profile
+
+def get_user_profile(user_id):
+    """Профиль пользователя из кэша (или из БД при промахе); None, если пользователя нет."""
+    profile = user_profile_cache.get(user_id)
+    if profile is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        profile = cache_user(user)
+    return UserProfile(**profile)
+
+def get_user_profiles(user_ids):
+    """Профили нескольких пользователей: промахи кэша дочитываются одним запросом."""
+    profiles, missing = {}, []
+    for user_id in set(user_ids):
+        profile = user_profile_cache.get(user_id)
+        if profile is None:
+            missing.append(user_id)
+        else:
+            profiles[user_id] = UserProfile(**profile)
+    if missing:
+        for user in User.query.filter(User.id.in_(missing)):
+            profiles[user.id] = UserProfile(**cache_user(user))
+    return profiles
+
+def invalidate_user(user_id):
+    user_profile_cache.delete(user_id)
+
+# Членство в чатах: (user_id, chat_id) -> роль ('' — не участник) и user_id -> список id чатов.
+# Сбрасывается явно в каждом месте, где меняются строки ChatMember.
+Membership = namedtuple('Membership', ('user_id', 'chat_id', 'role'))
+
+membership_cache = make_cache('memberships', app.config['MEMBERSHIP_CACHE_SIZE'], app.config['MEMBERSHIP_CACHE_TTL'])
+user_chats_cache = make_cache('user_chats', app.config['USER_CACHE_SIZE'], app.config['MEMBERSHIP_CACHE_TTL'])
+chat_members_cache = make_cache('chat_members', app.config['MEMBERSHIP_CACHE_SIZE'], app.config['MEMBERSHIP_CACHE_TTL'])
+
+def get_membership(user_id, chat_id):
+    """Членство пользователя в чате или None. Отсутствие членства тоже кэшируется."""
+    key = (user_id, chat_id)
+    role = membership_cache.get(key)
+    if role is None:
+        cm = ChatMember.query.filter_by(user_id=user_id, chat_id=chat_id).first()
+        role = (cm.role or 'member') if cm else ''
+        membership_cache.set(key, role)
+    return Membership(user_id, chat_id, role) if role else None
+
+def get_user_chat_ids(user_id):
+    """Множество id чатов, в которых состоит пользователь."""
+    chat_ids = user_chats_cache.get(user_id)
+    if chat_ids is None:
+        chat_ids = [cid for (cid,) in db.session.query(ChatMember.chat_id).filter_by(user_id=user_id)]
+        user_chats_cache.set(user_id, chat_ids)
+    return set(chat_ids)
+
+def get_chat_member_ids(chat_id):
+    """id участников чата — для рассылки по личным комнатам без запроса к ChatMember на каждое сообщение."""
+    member_ids = chat_members_cache.get(chat_id)
+    if member_ids is None:
+        member_ids = [uid for (uid,) in db.session.query(ChatMember.user_id).filter_by(chat_id=chat_id)]
+        chat_members_cache.set(chat_id, member_ids)
+    return member_ids
+
+def invalidate_membership(user_id, chat_id):
+    membership_cache.delete((user_id, chat_id))
+    user_chats_cache.delete(user_id)
+    chat_members_cache.delete(chat_id)
+
+@app.route('/cache-stats')
+@secret_required()
+def cache_stats():
+    """Статистика кэшей для мониторинга. Требует секретный заголовок."""
+    return jsonify({name: cache.stats() for name, cache in caches.items()})
+
 # ---------- Вспомогательные функции ----------
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def get_avatar_url(user):
+def is_image(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['IMAGE_EXTENSIONS']
+
+def get_avatar_url(user, variant='avatar'):
+    """URL аватара нужного размера; variant=None — оригинал."""
     if user.avatar and user.avatar != 'default.jpg':
-        return url_for('uploads', filename=user.avatar)
+        return get_upload_url(user.avatar, variant)
     return '/photos/default.jpg'
 
+def get_upload_url(file_path, variant=None):
+    """URL загруженного файла. Для изображений можно запросить вариант ('avatar', 'thumb')."""
+    filename = file_path.split('/')[-1]
+    if variant and is_image(filename):
+        return url_for('upload_variant', variant=variant, filename=filename)
+    return url_for('uploads', filename=filename)
+
 def get_chat_name(chat):
     if chat.name:
         return chat.name
@@ -351,9 +1348,699 @@ def get_chat_name(chat):
     names = [m.first_name for m in members if m.id != current_user.id]
     return ', '.join(names) if names else 'Личный чат'
 
+def chat_names(chats):
+    """Названия нескольких чатов (как get_chat_name): собеседники безымянных чатов — одним запросом."""
+    unnamed = [chat.id for chat in chats if not chat.name]
+    others = {}
+    if unnamed:
+        rows = (db.session.query(ChatMember.chat_id, User.first_name).join(User, User.id == ChatMember.user_id)
+                .filter(ChatMember.chat_id.in_(unnamed), ChatMember.user_id != current_user.id))
+        for chat_id, first_name in rows:
+            others.setdefault(chat_id, []).append(first_name)
+    return {chat.id: chat.name or ', '.join(others.get(chat.id, [])) or 'Личный чат' for chat in chats}
+
+def last_messages(chat_ids):
+    """Последнее сообщение каждого чата: один запрос на шард по индексу (chat_id, id)."""
+    by_shard = {}
+    for chat_id in chat_ids:
+        by_shard.setdefault(shard_of_chat(chat_id), []).append(chat_id)
+    last = {}
+    for shard, ids in by_shard.items():
+        with shard_scope(shard):
+            latest = db.select(db.func.max(Message.id)).where(Message.chat_id.in_(ids)).group_by(Message.chat_id)
+            for msg in Message.query.filter(Message.id.in_(latest)):
+                last[msg.chat_id] = msg
+    return last
+
 def generate_invite_token():
     return ''.join(random.choices(string.ascii_letters + string.digits, k=20))
 
+def private_chat_key(user_a, user_b):
+    return f"{min(user_a, user_b)}:{max(user_a, user_b)}"
+
+def unpaired_chat_key(chat_id):
+    """Ключ личного чата, который больше не ищется по паре (дубликат или из него вышли).
+    Уникален, как того требует индекс, и не совпадает ни с одним ключом пары."""
+    return f"-{chat_id}"
+
+def release_private_chat(chat):
+    """Участник вышел из личного чата или удалён: следующий «новый чат» с тем же человеком
+    создаст новый чат, а не отправит в этот, где его уже нет."""
+    if chat and not chat.is_group and not chat.is_channel:
+        chat.private_key = unpaired_chat_key(chat.id)
+
+def can_post(chat, membership):
+    """В канал пишут только владелец и администраторы, в остальные чаты — все участники."""
+    if not membership:
+        return False
+    return not chat.is_channel or membership.role in ['owner', 'admin']
+
+def load_history(chat_id, before=None, limit=None):
+    """Страница истории чата (keyset по id): последние limit сообщений до before.
+    Когда горячая база заканчивается (или в ней остались старые закреплённые сообщения),
+    страница дополняется из архивных сегментов.
+    Возвращает (сообщения по возрастанию id, есть ли более ранние)."""
+    limit = limit or app.config['CHAT_PAGE_SIZE']
+    query = Message.query.filter_by(chat_id=chat_id)
+    if before:
+        query = query.filter(Message.id < before)
+    page = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    boundary = archived_boundary(chat_id, before)
+    if boundary and (len(page) <= limit or page[-1].id < boundary):
+        page = sorted(page + archived_page(chat_id, before, limit + 1), key=lambda m: m.id, reverse=True)[:limit + 1]
+    has_more = len(page) > limit
+    return list(reversed(page[:limit])), has_more
+
+# ---------- Архив старых сообщений ----------
+# Старые сообщения вместе с реакциями и комментариями уходят из горячей базы в неизменяемые
+# сегменты archive/<chat>-<first_id>-<last_id>.json.gz. Сегмент один раз выгружается на FTP,
+# а при старте не скачивается: его читают по требованию при листании истории.
+ArchivedReaction = namedtuple('ArchivedReaction', ('user_id', 'reaction'))
+
+class ArchivedRow:
+    """Строка из сегмента с теми же полями, что у модели; даты — снова datetime."""
+    def __init__(self, row):
+        self.__dict__.update(row)
+        self.created_at = datetime.fromisoformat(row['created_at']) if row['created_at'] else None
+
+class ArchivedMessage(ArchivedRow):
+    """Сообщение из сегмента: реакции и комментарии — списками."""
+    archived = True
+
+    def __init__(self, row):
+        super().__init__(row)
+        self.reactions = [ArchivedReaction(*r) for r in row['reactions']]
+        self.comments = [ArchivedRow(c) for c in row['comments']]
+
+def row_to_dict(obj):
+    row = {}
+    for column in obj.__table__.columns:
+        value = getattr(obj, column.name)
+        row[column.name] = value.isoformat() if isinstance(value, datetime) else value
+    return row
+
+segment_cache = LRUCache(app.config['ARCHIVE_CACHE_SEGMENTS'], 24 * 3600)
+metrics.counter('mateugram_archive_segment_reads_total', 'Archive segment reads by source')
+
+def segment_path(filename):
+    return os.path.join(app.config['ARCHIVE_FOLDER'], filename)
+
+def read_segment(filename):
+    """Сообщения сегмента по возрастанию id: из кэша, с диска или с FTP."""
+    messages = segment_cache.get(filename)
+    if messages is not None:
+        metrics.inc('mateugram_archive_segment_reads_total', source='cache')
+        return messages
+    path = segment_path(filename)
+    source = 'disk'
+    if not os.path.exists(path):
+        os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+        # Без ftp_lock: страница чата не должна ждать полной выгрузки базы. Сегмент неизменяем,
+        # поэтому параллельные загрузки одного файла безопасны — каждая в свой временный файл
+        part = f"{path}.{secrets.token_hex(4)}.part"
+        if not download_file_from_ftp(f'archive/{filename}', part):
+            if os.path.exists(part):
+                os.remove(part)
+            print(f"Archive segment {filename} is not available")
+            return []
+        os.replace(part, path)
+        source = 'ftp'
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        messages = [ArchivedMessage(row) for row in json.load(f)['messages']]
+    segment_cache.set(filename, messages)
+    metrics.inc('mateugram_archive_segment_reads_total', source=source)
+    return messages
+
+def archived_boundary(chat_id, before=None):
+    """Наибольший id чата в архиве ниже before (0, если архива нет) — одним запросом по индексу."""
+    query = db.session.query(db.func.max(ArchiveSegment.last_id)).filter(ArchiveSegment.chat_id == chat_id)
+    if before:
+        query = query.filter(ArchiveSegment.first_id < before)
+    return query.scalar() or 0
+
+def archived_page(chat_id, before, limit):
+    """До limit архивных сообщений чата с id < before, по убыванию id."""
+    query = ArchiveSegment.query.filter(ArchiveSegment.chat_id == chat_id)
+    if before:
+        query = query.filter(ArchiveSegment.first_id < before)
+    page = []
+    for segment in query.order_by(ArchiveSegment.last_id.desc()):
+        for msg in reversed(read_segment(segment.filename)):
+            if not before or msg.id < before:
+                page.append(msg)
+                if len(page) >= limit:
+                    return page
+    return page
+
+def find_archived_message(message_id):
+    """Архивное сообщение по id или None. Диапазоны сегментов разных чатов пересекаются,
+    поэтому читаются все сегменты, в диапазон которых попадает id."""
+    segments = ArchiveSegment.query.filter(ArchiveSegment.first_id <= message_id,
+                                           ArchiveSegment.last_id >= message_id)
+    for segment in segments:
+        messages = read_segment(segment.filename)
+        i = bisect.bisect_left([msg.id for msg in messages], message_id)
+        if i < len(messages) and messages[i].id == message_id:
+            return messages[i]
+    return None
+
+def upload_segment(segment):
+    """Выгружает сегмент на FTP в archive/. Сегменты неизменяемы, поэтому — ровно один раз."""
+    ftp = get_ftp_connection()
+    if not ftp:
+        return False
+    try:
+        try:
+            ftp.mkd('archive')
+        except ftplib.error_perm:
+            pass
+        path = segment_path(segment.filename)
+        with open(path, 'rb') as f:
+            ftp.storbinary(f'STOR archive/{segment.filename}', f)
+        ftp.quit()
+        metrics.inc('mateugram_ftp_operations_total', direction='upload')
+        metrics.inc('mateugram_ftp_bytes_total', segment.size, direction='upload')
+        return True
+    except Exception as e:
+        print(f"Archive upload error: {e}")
+        metrics.inc('mateugram_ftp_errors_total', op='archive')
+        return False
+
+def segment_rows(ids):
+    """Строки сегмента для сообщений ids (по возрастанию) — с реакциями и комментариями, как сейчас в базе."""
+    messages, reactions, comments = {}, {}, {}
+    for chunk in chunked(ids):
+        for msg in Message.query.filter(Message.id.in_(chunk)):
+            messages[msg.id] = row_to_dict(msg)
+        for r in Reaction.query.filter(Reaction.message_id.in_(chunk)).order_by(Reaction.id):
+            reactions.setdefault(r.message_id, []).append([r.user_id, r.reaction])
+        for c in Comment.query.filter(Comment.message_id.in_(chunk)).order_by(Comment.id):
+            comments.setdefault(c.message_id, []).append(row_to_dict(c))
+    rows = []
+    for message_id in ids:
+        if message_id in messages:
+            row = messages[message_id]
+            row['reactions'] = reactions.get(message_id, [])
+            row['comments'] = comments.get(message_id, [])
+            rows.append(row)
+    return rows
+
+def write_segment(chat_id, rows):
+    """Пишет строки сегмента (по возрастанию id) в новый файл сегмента."""
+    filename = f"{chat_id}-{rows[0]['id']}-{rows[-1]['id']}.json.gz"
+    path = segment_path(filename)
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump({'chat_id': chat_id, 'messages': rows}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+    return ArchiveSegment(chat_id=chat_id, first_id=rows[0]['id'], last_id=rows[-1]['id'],
+                          message_count=len(rows), filename=filename, size=os.path.getsize(path))
+
+def archive_old_messages(days=None):
+    """Переносит сообщения старше days дней в сегменты и удаляет их из базы.
+    Сегмент сначала записывается и выгружается, строки удаляются в одной транзакции с записью индекса;
+    невыгруженные (FTP был недоступен) сегменты догружаются при следующем запуске."""
+    days = app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+    for segment in ArchiveSegment.query.filter_by(uploaded=False).all():
+        segment.uploaded = upload_segment(segment)
+    db.session.commit()
+    archived = 0
+    touched = set()
+    for shard in range(MESSAGE_SHARDS):
+        with shard_scope(shard):
+            count = archive_shard(shard, cutoff)
+        if count:
+            archived += count
+            touched.add(shard)
+    # Без VACUUM SQLite оставляет освободившиеся страницы в файле, и на FTP уходит прежний размер
+    for shard in touched:
+        with shard_engine(shard).connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(db.text('VACUUM'))
+    if archived:
+        recent_messages.clear()
+        room_buffer.clear()
+        request_sync()
+    return archived
+
+def archive_shard(shard, cutoff):
+    archived = 0
+    chat_ids = [chat_id for (chat_id,) in db.session.query(Message.chat_id).filter(Message.created_at < cutoff).distinct()]
+    for chat_id in chat_ids:
+        while True:
+            batch = (Message.query.filter(Message.chat_id == chat_id, Message.created_at < cutoff,
+                                          Message.pinned.isnot(True))
+                     .order_by(Message.id).limit(app.config['ARCHIVE_SEGMENT_SIZE']).all())
+            if not batch:
+                break
+            ids = [msg.id for msg in batch]
+            db.session.expunge_all()
+            rows = segment_rows(ids)
+            db.session.rollback()
+            if not rows:
+                continue
+            segment = write_segment(chat_id, rows)
+            segment.uploaded = upload_segment(segment)
+            # Пустое обновление берёт блокировку записи SQLite до commit: пока сверяем снимок и удаляем
+            # строки, ни сервер, ни другой процесс не добавит реакцию или комментарий и не изменит сообщение.
+            # Если что-то изменилось после снимка, сегмент пишется заново
+            db.session.execute(db.update(Message).where(Message.id == ids[0]).values(chat_id=Message.chat_id),
+                               execution_options={'synchronize_session': False})
+            if segment_rows(ids) != rows:
+                db.session.rollback()
+                os.remove(segment_path(segment.filename))
+                print(f"Chat {chat_id} changed while archiving, retrying the segment")
+                continue
+            db.session.add(segment)
+            for chunk in chunked(ids):
+                db.session.execute(db.delete(Reaction).where(Reaction.message_id.in_(chunk)))
+                db.session.execute(db.delete(Comment).where(Comment.message_id.in_(chunk)))
+                db.session.execute(db.delete(Message).where(Message.id.in_(chunk)))
+            filename = segment.filename
+            db.session.commit()
+            db.session.expunge_all()
+            archived += len(rows)
+            print(f"Archived {len(rows)} messages of chat {chat_id} into {filename}")
+    return archived
+
+@app.route('/archive', methods=['POST'])
+@secret_required()
+def archive_messages():
+    """Запускает архивацию в фоне. Требует секретный заголовок."""
+    days = request.args.get('days', type=int)
+
+    def run():
+        with app.app_context():
+            try:
+                archive_old_messages(days)
+            except Exception as e:
+                print(f"Archive error: {e}")
+    threading.Thread(target=run, daemon=True).start()
+    return 'Archive started', 202
+
+# ---------- Горячий кэш последних сообщений ----------
+# Чат отрисовывается из MessageView: реакции и текст сообщения, на которое ответили, дочитываются
+# одним запросом на страницу. Последние сообщения активных чатов держатся готовыми в памяти —
+# открытие чата на попадании не делает запросов к сообщениям. Новые сообщения дописываются в кэш,
+# правка, удаление, закрепление, реакция или комментарий сбрасывают чат целиком.
+MESSAGE_VIEW_FIELDS = ('id', 'sender_id', 'chat_id', 'content', 'reply_to', 'forwarded_from', 'file_path',
+                       'file_name', 'file_type', 'created_at', 'edited', 'pinned', 'comment_count', 'archived')
+
+class MessageView:
+    """Сообщение, готовое к отрисовке: поля Message, реакции списком и reply_preview."""
+    __slots__ = MESSAGE_VIEW_FIELDS + ('reactions', 'reply_preview', 'size')
+
+    def __init__(self, msg, reactions, reply_preview):
+        for field in MESSAGE_VIEW_FIELDS:
+            setattr(self, field, getattr(msg, field))
+        self.reactions = reactions
+        self.reply_preview = reply_preview
+        # Примерный размер в памяти — для общего бюджета кэша
+        self.size = 600 + 100 * len(reactions) + sum(
+            len(value) for value in (self.content, self.file_path, self.file_name, reply_preview) if value)
+
+def message_views(messages):
+    """MessageView для страницы сообщений: реакции и тексты родителей ответов — по одному запросу."""
+    reactions = {}
+    live_ids = [msg.id for msg in messages if not msg.archived]
+    if live_ids:
+        rows = (db.session.query(Reaction.message_id, Reaction.user_id, Reaction.reaction)
+                .filter(Reaction.message_id.in_(live_ids)).order_by(Reaction.id))
+        for message_id, user_id, reaction in rows:
+            reactions.setdefault(message_id, []).append(ArchivedReaction(user_id, reaction))
+    parent_ids = {msg.reply_to for msg in messages if msg.reply_to}
+    parents = {}
+    if parent_ids:
+        parents = dict(db.session.query(Message.id, Message.content).filter(Message.id.in_(parent_ids)))
+    return [MessageView(msg, msg.reactions if msg.archived else reactions.get(msg.id, []), parents.get(msg.reply_to))
+            for msg in messages]
+
+class RecentMessages:
+    """Последние MessageView каждого чата и закреплённое сообщение.
+    Чат попадает в кэш целиком при открытии (fill) и дальше пополняется новыми сообщениями (add).
+    При превышении бюджета памяти вытесняются давно не открывавшиеся чаты."""
+    def __init__(self, per_chat, max_bytes, enabled=True):
+        self.lock = threading.Lock()
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.chats = OrderedDict()  # chat_id -> {'messages': deque, 'has_more', 'pinned', 'size'}
+        self.index = {}             # id сообщения в кэше -> chat_id
+        self.pinned = {}            # id закреплённого сообщения в кэше -> chat_id (оно может быть старше страницы)
+        self.filling = {}           # chat_id -> метка заполнения, которое ещё идёт
+
+    def page(self, chat_id, limit):
+        """(сообщения, есть ли более ранние, закреплённое) или None при промахе."""
+        with self.lock:
+            entry = self.chats.get(chat_id)
+            if entry is None or (len(entry['messages']) < limit and entry['has_more']):
+                self.misses += 1
+                return None
+            self.chats.move_to_end(chat_id)
+            self.hits += 1
+            messages = list(entry['messages'])
+            return messages[-limit:], entry['has_more'] or len(messages) > limit, entry['pinned']
+
+    def begin_fill(self, chat_id):
+        """Метка перед чтением чата из базы: если до fill чат изменится, результат не кэшируется."""
+        token = object()
+        with self.lock:
+            self.filling[chat_id] = token
+        return token
+
+    def fill(self, chat_id, token, messages, has_more, pinned):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.filling.get(chat_id) is not token:
+                return
+            del self.filling[chat_id]
+            self._drop(chat_id)
+            entry = {'messages': deque(maxlen=self.per_chat), 'has_more': has_more or len(messages) > self.per_chat,
+                     'pinned': pinned, 'size': pinned.size if pinned else 0}
+            self.chats[chat_id] = entry
+            if pinned:
+                self.pinned[pinned.id] = chat_id
+            for view in messages[-self.per_chat:]:
+                self._append(entry, view)
+            self._evict()
+
+    def add(self, msg):
+        """Новое сообщение чата: дописывается, если чат в кэше."""
+        with self.lock:
+            self.filling.pop(msg.chat_id, None)
+            entry = self.chats.get(msg.chat_id)
+            if entry is None:
+                return
+            reply_preview = None
+            if msg.reply_to:
+                if self.index.get(msg.reply_to) != msg.chat_id:
+                    # Ответ на сообщение за пределами кэша — текст родителя дочитает следующее открытие
+                    self._drop(msg.chat_id)
+                    return
+                reply_preview = next(v.content for v in entry['messages'] if v.id == msg.reply_to)
+            self._append(entry, MessageView(msg, [], reply_preview))
+            self._evict()
+
+    def invalidate(self, chat_id):
+        with self.lock:
+            self.filling.pop(chat_id, None)
+            self._drop(chat_id)
+
+    def invalidate_message(self, message_id):
+        """Сбрасывает чат, в кэше которого есть сообщение message_id (на странице или закреплённым)."""
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            chat_id = self.index.get(message_id, self.pinned.get(message_id))
+            if chat_id is not None:
+                self.filling.pop(chat_id, None)
+                self._drop(chat_id)
+
+    def clear(self):
+        with self.lock:
+            self.chats.clear()
+            self.filling.clear()
+            self.index.clear()
+            self.pinned.clear()
+            self.bytes = 0
+
+    def _append(self, entry, view):
+        messages = entry['messages']
+        if len(messages) == messages.maxlen:
+            entry['size'] -= messages[0].size
+            self.bytes -= messages[0].size
+            self.index.pop(messages[0].id, None)
+            entry['has_more'] = True
+        messages.append(view)
+        self.index[view.id] = view.chat_id
+        entry['size'] += view.size
+        self.bytes += view.size
+
+    def _drop(self, chat_id):
+        entry = self.chats.pop(chat_id, None)
+        if entry is not None:
+            self.bytes -= entry['size']
+            if entry['pinned']:
+                self.pinned.pop(entry['pinned'].id, None)
+            for view in entry['messages']:
+                self.index.pop(view.id, None)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.chats:
+            self._drop(next(iter(self.chats)))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'backend': 'memory', 'enabled': self.enabled, 'chats': len(self.chats), 'bytes': self.bytes,
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None}
+
+recent_messages = RecentMessages(max(app.config['RECENT_MESSAGES_PER_CHAT'], app.config['CHAT_PAGE_SIZE']),
+                                 app.config['RECENT_MESSAGES_BYTES'], app.config['RECENT_MESSAGES_CACHE'])
+caches['recent_messages'] = recent_messages
+metrics.counter('mateugram_recent_messages_total', 'First chat pages by recent messages cache result')
+metrics.gauge('mateugram_recent_messages_bytes', 'Approximate memory held by the recent messages cache',
+              lambda: [({}, recent_messages.bytes)])
+
+def chat_page(chat_id, before=None):
+    """Страница чата для отрисовки: (MessageView, есть ли более ранние, закреплённое MessageView).
+    Первая страница отдаётся из горячего кэша, промах заполняет его."""
+    limit = app.config['CHAT_PAGE_SIZE']
+    if before is None and recent_messages.enabled:
+        cached = recent_messages.page(chat_id, limit)
+        metrics.inc('mateugram_recent_messages_total', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            return cached
+        token = recent_messages.begin_fill(chat_id)
+        messages, has_more = load_history(chat_id, limit=recent_messages.per_chat)
+    else:
+        messages, has_more = load_history(chat_id, before)
+    pinned = Message.query.filter_by(chat_id=chat_id, pinned=True).first()
+    views = message_views(messages + [pinned] if pinned else messages)
+    pinned_view = views.pop() if pinned else None
+    if before is None and recent_messages.enabled:
+        recent_messages.fill(chat_id, token, views, has_more, pinned_view)
+        has_more = has_more or len(views) > limit
+        views = views[-limit:]
+    return views, has_more, pinned_view
+
+# ---------- Миграции схемы ----------
+def create_tables():
+    """Создаёт недостающие таблицы: при шардах таблицы сообщений — в каждом шарде, остальные — в основной базе."""
+    if MESSAGE_SHARDS == 1:
+        db.create_all()
+        return
+    catalog = [t for t in db.metadata.sorted_tables if t.name not in SHARDED_TABLES]
+    sharded = [t for t in db.metadata.sorted_tables if t.name in SHARDED_TABLES]
+    db.metadata.create_all(db.engine, tables=catalog)
+    for shard in range(MESSAGE_SHARDS):
+        engine = shard_engine(shard)
+        db.metadata.create_all(engine, tables=sharded)
+        with engine.begin() as conn:
+            for table in SHARDED_TABLES:
+                conn.execute(db.text('INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq '
+                                     'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)'),
+                             {'name': table, 'seq': shard * SHARD_ID_SPAN})
+    if 'message' in db.inspect(db.engine).get_table_names():
+        print("Main database still has messages from before sharding: run 'python app.py shard'")
+
+def migrate_schema():
+    """db.create_all() не меняет существующие таблицы: добавляем новые колонки и индексы вручную."""
+    if MESSAGE_SHARDS == 1:
+        migrate_tables(db.engine, db.metadata.sorted_tables)
+    else:
+        migrate_tables(db.engine, [t for t in db.metadata.sorted_tables if t.name not in SHARDED_TABLES])
+        for shard in range(MESSAGE_SHARDS):
+            migrate_tables(shard_engine(shard), [t for t in db.metadata.sorted_tables if t.name in SHARDED_TABLES])
+    backfill_private_keys()
+
+def migrate_tables(engine, tables):
+    inspector = db.inspect(engine)
+    added = set()
+    with engine.begin() as conn:
+        for table in tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=db.engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.execute(db.text(ddl))
+                added.add(f"{table.name}.{column.name}")
+                print(f"Added column {table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        if 'message.comment_count' in added:
+            conn.execute(db.text('UPDATE message SET comment_count = '
+                                 '(SELECT COUNT(*) FROM comment WHERE comment.message_id = message.id)'))
+
+def split_into_shards():
+    """Однократный перенос сообщений, реакций и комментариев из основной базы в шарды после включения
+    MESSAGE_SHARDS. id строк переносятся в диапазон шарда их чата (в шарде 0 не меняются), вместе с ними —
+    ссылки message_id, reply_to и forwarded_from. Реакции и комментарии удалённых сообщений отбрасываются."""
+    if MESSAGE_SHARDS == 1:
+        print("MESSAGE_SHARDS is not set")
+        return 0
+    inspector = db.inspect(db.engine)
+    if 'message' not in inspector.get_table_names():
+        return 0
+    if any(shard_of_chat(chat_id) for (chat_id,) in db.session.query(ArchiveSegment.chat_id).distinct()):
+        print("Archive segments of chats outside shard 0 hold unsharded ids; sharding is not supported for them")
+        return 0
+    with db.engine.connect() as src:
+        chat_of = dict(src.execute(db.text('SELECT id, chat_id FROM message')).all())
+
+        def moved(message_id):
+            if message_id not in chat_of:
+                return None
+            return shard_of_chat(chat_of[message_id]) * SHARD_ID_SPAN + message_id
+
+        copied = Counter()
+        for table in [t for t in db.metadata.sorted_tables if t.name in SHARDED_TABLES]:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            rows = {}
+            for row in src.execute(db.select(*[c for c in table.columns if c.name in existing])).mappings():
+                row = dict(row)
+                if table.name == 'message':
+                    row['id'] = moved(row['id'])
+                    row['reply_to'] = moved(row['reply_to'])
+                    row['forwarded_from'] = moved(row['forwarded_from'])
+                    shard = shard_of_message(row['id'])
+                else:
+                    if row['message_id'] not in chat_of:
+                        continue
+                    row['message_id'] = moved(row['message_id'])
+                    shard = shard_of_message(row['message_id'])
+                    row['id'] += shard * SHARD_ID_SPAN
+                rows.setdefault(shard, []).append(row)
+            for shard, shard_rows in rows.items():
+                with shard_engine(shard).begin() as dst:
+                    for chunk in chunked(shard_rows):
+                        dst.execute(table.insert(), chunk)
+                copied[table.name] += len(shard_rows)
+    with db.engine.begin() as conn:
+        for table in reversed(SHARDED_TABLES):
+            conn.execute(db.text(f'DROP TABLE "{table}"'))
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(db.text('VACUUM'))
+    change_tracker.record_rows(copied, set(database_files()))
+    return sum(copied.values())
+
+def backfill_private_keys():
+    """Проставляет private_key личным чатам, созданным до его появления.
+    Если у пары уже несколько чатов, ключ получает самый старый. Остальные (и чаты не из двух участников)
+    помечаются ключом без пары, чтобы не разбирать их заново при каждом запуске."""
+    rows = db.session.query(ChatMember.chat_id, ChatMember.user_id).join(Chat, Chat.id == ChatMember.chat_id).filter(
+        Chat.is_group == False, Chat.is_channel == False, Chat.private_key.is_(None)).all()
+    if not rows:
+        return
+    members = {}
+    for chat_id, user_id in rows:
+        members.setdefault(chat_id, set()).add(user_id)
+    taken = {key for (key,) in db.session.query(Chat.private_key).filter(Chat.private_key.isnot(None))}
+    updated = 0
+    unpaired = 0
+    for chat_id in sorted(members):
+        key = private_chat_key(*members[chat_id]) if len(members[chat_id]) == 2 else None
+        if key is None or key in taken:
+            key = unpaired_chat_key(chat_id)
+            unpaired += 1
+        else:
+            taken.add(key)
+            updated += 1
+        Chat.query.filter_by(id=chat_id).update({'private_key': key})
+    db.session.commit()
+    if updated or unpaired:
+        print(f"Backfilled private_key for {updated} chats, {unpaired} left without a pair key")
+
+# ---------- Обработка изображений ----------
+def variant_filename(filename, variant):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}_{variant}{ext}"
+
+def process_image(path, variants):
+    """Создаёт варианты изображения и удаляет EXIF из оригинала.
+    Выполняется в пуле процессов, поэтому работает только с путями и простыми типами."""
+    with Image.open(path) as original:
+        fmt = original.format
+        has_exif = 'exif' in original.info
+        animated = getattr(original, 'is_animated', False)
+        img = ImageOps.exif_transpose(original)
+        if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        for variant, size in variants.items():
+            if variant == 'avatar':
+                resized = ImageOps.fit(img, size, Image.LANCZOS)
+            else:
+                resized = img.copy()
+                resized.thumbnail(size, Image.LANCZOS)
+            target = variant_filename(path, variant)
+            tmp = target + '.tmp'
+            resized.save(tmp, format=fmt)
+            os.replace(tmp, target)
+        # Перезаписываем оригинал без метаданных (анимированные GIF не трогаем, чтобы не потерять кадры)
+        if has_exif and not animated:
+            tmp = path + '.tmp'
+            if fmt == 'JPEG':
+                img.save(tmp, format=fmt, quality=95)
+            else:
+                img.save(tmp, format=fmt)
+            os.replace(tmp, path)
+    return path
+
+image_executor = None
+image_executor_lock = threading.Lock()
+# Готовые задачи из пула: колбэк Future выполняется во внутреннем потоке пула,
+# поэтому он только кладёт Future сюда, а обрабатывает их фоновая задача приложения
+image_results = queue.Queue()
+
+def get_image_executor():
+    """Пул процессов создаётся при первой загрузке, чтобы не держать процессы без нужды.
+    Процессы запускаются через spawn, а не fork: копия воркера eventlet с пропатченными
+    сокетами и чужими потоками в дочернем процессе небезопасна."""
+    global image_executor
+    with image_executor_lock:
+        if image_executor is None:
+            image_executor = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'],
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            start_background_task(image_results_loop)
+        return image_executor
+
+def image_results_loop():
+    while True:
+        future = image_results.get()
+        try:
+            with app.app_context():
+                on_image_processed(future)
+        except Exception as e:
+            print(f"Image result error: {e}")
+
+def on_image_processed(future):
+    exc = future.exception()
+    if exc:
+        print(f"Image processing error: {exc}")
+        return
+    # Новые варианты тоже должны попасть на FTP
+    change_tracker.record_file()
+    request_sync()
+
+def enqueue_image_processing(filename, variants):
+    """Ставит файл из UPLOAD_FOLDER в очередь обработки. Возвращает Future или None."""
+    if Image is None or not is_image(filename):
+        return None
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    sizes = {v: app.config['IMAGE_VARIANTS'][v] for v in variants}
+    future = get_image_executor().submit(process_image, path, sizes)
+    future.add_done_callback(image_results.put)
+    return future
+
 # ---------- Статика и favicon ----------
 @app.route('/photos/<filename>')
 def photos(filename):
@@ -363,10 +2050,200 @@ def photos(filename):
 def uploads(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+@app.route('/uploads/<any(avatar, thumb):variant>/<filename>')
+def upload_variant(variant, filename):
+    """Отдаёт уменьшенный вариант, а пока он не готов — оригинал."""
+    name = variant_filename(filename, variant)
+    path = safe_join(app.config['UPLOAD_FOLDER'], name)
+    if path and os.path.isfile(path):
+        return send_from_directory(app.config['UPLOAD_FOLDER'], name)
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory('photos', 'logo.png', mimetype='image/vnd.microsoft.icon')
 
+# ---------- Статические бандлы ----------
+# Стили и скрипты страниц лежат в static/css и static/js. При старте каждый файл получает имя с хэшем
+# содержимого (css/chat.1a2b3c4d5e6f.css) и заранее сжатые gzip- и brotli-варианты, а /assets/ отдаёт их
+# с кэшированием на год: изменённый файл получит новое имя, и браузер скачает его заново.
+# Клиент Socket.IO берётся из static/vendor (python app.py fetch-socketio), пока его там нет — с CDN.
+SOCKETIO_CLIENT_URL = 'https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.min.js'
+ASSET_ALIASES = {'socket.io.js': 'vendor/socket.io.min.js'}
+ASSET_TYPES = {'.css': 'text/css; charset=utf-8', '.js': 'application/javascript; charset=utf-8'}
+Asset = namedtuple('Asset', ('path', 'content_type', 'digest', 'bodies'))  # bodies: {кодировка или None: байты}
+
+assets = {}       # имя в static/ -> Asset
+asset_paths = {}  # путь с хэшем -> Asset
+
+def build_assets():
+    """Хэширует и сжимает файлы static/css, static/js и static/vendor."""
+    assets.clear()
+    asset_paths.clear()
+    for folder in ('css', 'js', 'vendor'):
+        directory = os.path.join(app.static_folder, folder)
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            base, ext = os.path.splitext(filename)
+            if ext not in ASSET_TYPES:
+                continue
+            with open(os.path.join(directory, filename), 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            bodies = {None: data}
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                bodies['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    bodies['br'] = compressed
+            asset = Asset(f'{folder}/{base}.{digest}{ext}', ASSET_TYPES[ext], digest, bodies)
+            assets[f'{folder}/{filename}'] = asset
+            asset_paths[asset.path] = asset
+
+@app.template_global()
+def asset_url(name):
+    """URL файла из static/ с хэшем в имени; клиент Socket.IO без локальной копии — с CDN."""
+    asset = assets.get(ASSET_ALIASES.get(name, name))
+    if asset is not None:
+        return f'/assets/{asset.path}'
+    if name == 'socket.io.js':
+        return SOCKETIO_CLIENT_URL
+    return url_for('static', filename=name)
+
+@app.route('/assets/<path:path>')
+def asset_file(path):
+    asset = asset_paths.get(path)
+    if asset is None:
+        return 'Not found', 404
+    encoding = next((e for e in ('br', 'gzip') if e in asset.bodies and request.accept_encodings[e]), None)
+    response = app.response_class(asset.bodies[encoding], content_type=asset.content_type)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(f"{asset.digest}-{encoding or 'identity'}")
+    return response.make_conditional(request)
+
+def fetch_socketio_client():
+    """Скачивает клиент Socket.IO той же версии, что на CDN, в static/vendor."""
+    import urllib.request
+    path = os.path.join(app.static_folder, 'vendor', 'socket.io.min.js')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with urllib.request.urlopen(SOCKETIO_CLIENT_URL, timeout=30) as response:
+            data = response.read()
+    except Exception as e:
+        print(f"Socket.IO client download error: {e}")
+        return False
+    with open(path, 'wb') as f:
+        f.write(data)
+    print(f"Socket.IO client saved to {path}")
+    return True
+
+# ---------- Сжатие ответов ----------
+# after_request: HTML, JSON и текст сжимаются тем, что принимает клиент (brotli предпочтительнее).
+# Маленькие ответы, уже сжатые (бандлы /assets/) и файлы (send_from_directory) отдаются как есть.
+# Потоковые ответы сжимаются по кускам с досылкой после каждого, чтобы клиент получал их сразу.
+# Страницы, помеченные stable_response() (архивная история), кэшируются сжатыми по хэшу тела.
+COMPRESSIBLE_TYPES = {'text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript'}
+
+compressed_cache = LRUCache(app.config['COMPRESS_CACHE_SIZE'], 3600)
+caches['compressed_responses'] = compressed_cache
+metrics.histogram('mateugram_http_compress_seconds', 'CPU time spent compressing one response',
+                  (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+metrics.counter('mateugram_http_compress_bytes_total', 'Compressible response bytes before (in) and after (out) compression')
+metrics.counter('mateugram_http_compress_cache_total', 'Compressed stable responses by cache result')
+
+def stable_response():
+    """Помечает ответ как повторяющийся: его сжатый вид сохранится в compressed_cache."""
+    g.compress_cache = True
+
+def response_encoding():
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+def compress_bytes(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=app.config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+def compress_stream(chunks, encoding):
+    """Сжимает поток по кускам; после каждого — flush, чтобы не копить ответ в буфере компрессора."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)  # 31 — формат gzip
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    size_in = size_out = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            out = process(chunk) + flush()
+            size_in += len(chunk)
+            size_out += len(out)
+            yield out
+        out = finish()
+        size_out += len(out)
+        yield out
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        metrics.inc('mateugram_http_compress_bytes_total', size_in, stage='in')
+        metrics.inc('mateugram_http_compress_bytes_total', size_out, stage='out')
+
+@app.after_request
+def compress_response(response):
+    if (not app.config['COMPRESS_ENABLED'] or response.status_code != 200 or request.method == 'HEAD'
+            or response.direct_passthrough or response.mimetype not in COMPRESSIBLE_TYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        if not app.config['COMPRESS_STREAMING']:
+            return response
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        key = None
+        if g.get('compress_cache'):
+            key = f"{encoding}:{hashlib.blake2b(data, digest_size=16).hexdigest()}"
+            compressed = compressed_cache.get(key)
+            metrics.inc('mateugram_http_compress_cache_total', result='miss' if compressed is None else 'hit')
+        if key is None or compressed is None:
+            start = time.thread_time()
+            compressed = compress_bytes(data, encoding)
+            metrics.observe('mateugram_http_compress_seconds', time.thread_time() - start, encoding=encoding)
+            if key is not None:
+                compressed_cache.set(key, compressed)
+        if len(compressed) >= len(data):
+            return response
+        metrics.inc('mateugram_http_compress_bytes_total', len(data), stage='in')
+        metrics.inc('mateugram_http_compress_bytes_total', len(compressed), stage='out')
+        response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # Сжатое тело отличается побайтно, поэтому сильный ETag становится слабым
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
 # ---------- Главная ----------
 @app.route('/')
 def index():
@@ -378,78 +2255,7 @@ INDEX_HTML = '''<!DOCTYPE html>
     <title>MateuGram</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <link rel="icon" type="image/png" href="/photos/logo.png">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; font-family: 'Segoe UI', system-ui, sans-serif; }
-        body {
-            min-height: 100vh;
-            background: linear-gradient(145deg, #0b2b5c 0%, #1b4a7a 50%, #2c6b9e 100%);
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            animation: gradientShift 15s ease infinite;
-        }
-        @keyframes gradientShift {
-            0% { background: linear-gradient(145deg, #0b2b5c, #1b4a7a, #2c6b9e); }
-            50% { background: linear-gradient(145deg, #1b4a7a, #2c6b9e, #0b2b5c); }
-            100% { background: linear-gradient(145deg, #0b2b5c, #1b4a7a, #2c6b9e); }
-        }
-        .container {
-            text-align: center;
-            background: rgba(255,255,255,0.95);
-            backdrop-filter: blur(10px);
-            padding: 40px;
-            border-radius: 30px;
-            box-shadow: 0 30px 60px rgba(0,0,0,0.4), 0 0 0 1px rgba(255,255,255,0.2) inset;
-            max-width: 420px;
-            width: 90%;
-            transition: transform 0.3s;
-        }
-        .container:hover { transform: translateY(-5px); }
-        .logo {
-            width: 120px;
-            height: 120px;
-            border-radius: 50%;
-            margin-bottom: 20px;
-            object-fit: cover;
-            border: 4px solid #fff;
-            box-shadow: 0 10px 20px rgba(0,0,0,0.2);
-        }
-        h1 {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            font-size: 2.5em;
-            margin-bottom: 10px;
-        }
-        p { color: #4a5568; margin-bottom: 30px; font-size: 1.1em; }
-        .btn {
-            display: inline-block;
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            color: white;
-            padding: 14px 32px;
-            border-radius: 40px;
-            text-decoration: none;
-            margin: 8px;
-            font-weight: 600;
-            letter-spacing: 0.5px;
-            transition: all 0.3s;
-            box-shadow: 0 8px 15px rgba(11,43,92,0.3);
-        }
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 12px 20px rgba(11,43,92,0.4);
-        }
-        .btn-outline {
-            background: transparent;
-            border: 2px solid #2c6b9e;
-            color: #2c6b9e;
-            box-shadow: none;
-        }
-        .btn-outline:hover {
-            background: #2c6b9e;
-            color: white;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('css/index.css') }}">
 </head>
 <body>
     <div class="container">
@@ -462,6 +2268,189 @@ INDEX_HTML = '''<!DOCTYPE html>
 </body>
 </html>'''
 
+# ---------- Хэширование паролей ----------
+class PasswordHashBusy(Exception):
+    """Все слоты хэширования заняты дольше PASSWORD_HASH_WAIT."""
+
+class PasswordHasher:
+    """KDF пароля — сотни миллисекунд CPU на запрос. Слоты ограничивают число одновременных
+    расчётов, лишние запросы ждут и получают 503, а не копят очередь без конца.
+    Под eventlet расчёт уходит в настоящий поток (tpool): pbkdf2/scrypt отпускают GIL,
+    и цикл событий продолжает обслуживать сокеты."""
+    def __init__(self, workers):
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def _run(self, func, *args):
+        if not self.slots.acquire(timeout=app.config['PASSWORD_HASH_WAIT']):
+            metrics.inc('mateugram_password_hash_rejected_total')
+            raise PasswordHashBusy()
+        start = time.perf_counter()
+        try:
+            if getattr(socketio, 'async_mode', None) == 'eventlet':
+                from eventlet import tpool
+                return tpool.execute(func, *args)
+            return func(*args)
+        finally:
+            self.slots.release()
+            metrics.observe('mateugram_password_hash_seconds', time.perf_counter() - start)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return hash_params(password_hash.split('$', 1)[0]) != hash_params(app.config['PASSWORD_HASH_METHOD'])
+
+def hash_params(method):
+    """Метод werkzeug в виде (алгоритм, параметры) с подставленными умолчаниями:
+    'scrypt' и 'scrypt:32768:8:1', 'pbkdf2' и 'pbkdf2:sha256:600000' — одно и то же."""
+    algorithm, *args = method.split(':')
+    if algorithm == 'scrypt':
+        defaults = [2 ** 15, 8, 1]
+    elif algorithm == 'pbkdf2':
+        defaults = ['sha256', DEFAULT_PBKDF2_ITERATIONS]
+    else:
+        return algorithm, tuple(args)
+    params = args + defaults[len(args):]
+    # Числа сравниваем как числа: '0600000' и 600000 — одни параметры
+    return algorithm, tuple(int(p) if isinstance(d, int) and str(p).isdigit() else p for p, d in zip(params, defaults))
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'])
+metrics.histogram('mateugram_password_hash_seconds', 'Password hash/verify time including the wait for a slot')
+metrics.counter('mateugram_password_hash_rejected_total', 'Password hashes rejected because all slots were busy')
+
+@app.errorhandler(PasswordHashBusy)
+def password_hash_busy(e):
+    return 'Сервер перегружен, попробуйте через несколько секунд', 503, {'Retry-After': '5'}
+
+class LoginThrottle:
+    """Счётчики неудачных входов по имени пользователя и по IP.
+    Проверяются до хэширования, поэтому подбор пароля не занимает слоты PasswordHasher.
+    Счётчик живёт LOGIN_LOCKOUT секунд с последней неудачи; с Redis он общий для воркеров."""
+    def __init__(self):
+        self.failures = make_cache('login_failures', 100000, app.config['LOGIN_LOCKOUT'])
+
+    def blocked(self, username, ip):
+        return (self.failures.get(f'user:{username.lower()}', 0) >= app.config['LOGIN_MAX_FAILURES']
+                or self.failures.get(f'ip:{ip}', 0) >= app.config['LOGIN_MAX_FAILURES_PER_IP'])
+
+    def failed(self, username, ip):
+        # incr, а не get + set: одновременные неудачи не должны теряться
+        for key in (f'user:{username.lower()}', f'ip:{ip}'):
+            self.failures.incr(key)
+
+    def succeeded(self, username):
+        self.failures.delete(f'user:{username.lower()}')
+
+login_throttle = LoginThrottle()
+metrics.counter('mateugram_login_total', 'Login attempts by result')
+
+# ---------- Очередь исходящей почты ----------
+# Запрос только добавляет строку в outbound_mail в своей транзакции; SMTP — дело воркера
+mail_wakeup = threading.Event()
+metrics.counter('mateugram_mail_total', 'Outbound mail delivery attempts by result')
+metrics.histogram('mateugram_mail_queue_delay_seconds', 'Time from enqueue to successful send',
+                  (1, 5, 15, 60, 300, 900, 3600, 14400))
+
+def enqueue_mail(recipient, subject, body, html=None):
+    """Ставит письмо в очередь. Коммитит вызывающий код; воркер просыпается после коммита."""
+    db.session.add(OutboundMail(recipient=recipient, subject=subject, body=body, html=html))
+    db.session.info['mail_queued'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def wake_mail_worker(session):
+    if session.info.pop('mail_queued', None):
+        mail_wakeup.set()
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_queued_mail(session):
+    session.info.pop('mail_queued', None)
+
+def claim_mail_batch():
+    """Захватывает до MAIL_BATCH_SIZE писем, которым пора уходить.
+    Захват — один условный UPDATE с меткой, поэтому несколько воркеров не отправят письмо дважды;
+    письмо, зависшее в sending (процесс упал), снова станет доступно по истечении аренды."""
+    now = datetime.utcnow()
+    token = secrets.token_hex(16)
+    due = (db.select(OutboundMail.id)
+           .where(OutboundMail.status.in_(('pending', 'sending')), OutboundMail.next_attempt_at <= now)
+           .order_by(OutboundMail.next_attempt_at).limit(app.config['MAIL_BATCH_SIZE']))
+    lease = app.config['MAIL_BATCH_SIZE'] * 60 / app.config['MAIL_RATE_PER_MINUTE'] + 300
+    db.session.execute(
+        db.update(OutboundMail)
+        .where(OutboundMail.id.in_(due.scalar_subquery()),
+               OutboundMail.status.in_(('pending', 'sending')), OutboundMail.next_attempt_at <= now)
+        .values(status='sending', claim=token, next_attempt_at=now + timedelta(seconds=lease))
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    return OutboundMail.query.filter_by(claim=token).order_by(OutboundMail.id).all()
+
+def mail_failed(item, error, permanent=False):
+    """Неудача: повтор через MAIL_RETRY_DELAY * 2^(попытка-1) со случайным разбросом или отказ."""
+    item.attempts += 1
+    item.last_error = str(error)[:500]
+    item.claim = None
+    if permanent or item.attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+        item.status = 'failed'
+        metrics.inc('mateugram_mail_total', result='failed')
+        print(f"Mail to {item.recipient} failed: {error}")
+    else:
+        delay = min(app.config['MAIL_RETRY_DELAY'] * 2 ** (item.attempts - 1), 6 * 3600)
+        item.status = 'pending'
+        item.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+        metrics.inc('mateugram_mail_total', result='retry')
+
+def send_mail_batch(batch):
+    """Отправляет пачку через одно SMTP-соединение, выдерживая интервал между письмами."""
+    interval = 60 / app.config['MAIL_RATE_PER_MINUTE']
+    next_send = time.monotonic()
+    try:
+        with mail.connect() as conn:
+            for item in batch:
+                time.sleep(max(0, next_send - time.monotonic()))
+                next_send = time.monotonic() + interval
+                try:
+                    conn.send(MailMessage(item.subject, recipients=[item.recipient], body=item.body, html=item.html))
+                except smtplib.SMTPRecipientsRefused as e:
+                    mail_failed(item, e, permanent=True)
+                except smtplib.SMTPServerDisconnected:
+                    # Соединение потеряно — оставшиеся письма уйдут со следующей пачкой
+                    raise
+                except Exception as e:
+                    mail_failed(item, e)
+                else:
+                    item.status = 'sent'
+                    item.claim = None
+                    item.sent_at = datetime.utcnow()
+                    metrics.inc('mateugram_mail_total', result='sent')
+                    metrics.observe('mateugram_mail_queue_delay_seconds',
+                                    (item.sent_at - item.created_at).total_seconds())
+                db.session.commit()
+    except Exception as e:
+        print(f"SMTP connection error: {e}")
+        for item in batch:
+            if item.status == 'sending':
+                mail_failed(item, e)
+        db.session.commit()
+
+def mail_loop():
+    """Фоновая задача: отправляет очередь, пока в ней есть готовые письма,
+    затем спит до нового письма или MAIL_POLL_INTERVAL (повторы по расписанию)."""
+    while True:
+        mail_wakeup.wait(app.config['MAIL_POLL_INTERVAL'])
+        mail_wakeup.clear()
+        try:
+            with app.app_context():
+                while True:
+                    batch = claim_mail_batch()
+                    if not batch:
+                        break
+                    send_mail_batch(batch)
+        except Exception as e:
+            print(f"Mail queue error: {e}")
+
 # ---------- Регистрация ----------
 @app.route('/register', methods=['GET', 'POST'])
 @sync_after_change
@@ -508,6 +2497,10 @@ def register():
         user.set_password(password)
 
         db.session.add(user)
+        if app.config['MAIL_ON_REGISTER']:
+            # Уходит в одной транзакции с пользователем, отправка — в фоне
+            enqueue_mail(email, 'Добро пожаловать в MateuGram',
+                         f'{first_name}, вы зарегистрировались в MateuGram как @{username}.')
         db.session.commit()
         login_user(user)
         return redirect(url_for('setup_profile'))
@@ -521,73 +2514,7 @@ REGISTER_TEMPLATE = '''
     <title>Регистрация в MateuGram</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <link rel="icon" type="image/png" href="/photos/logo.png">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; font-family: 'Segoe UI', system-ui, sans-serif; }
-        body {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            min-height: 100vh;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            padding: 20px;
-        }
-        .form-container {
-            background: white;
-            border-radius: 30px;
-            padding: 40px;
-            max-width: 550px;
-            width: 100%;
-            box-shadow: 0 30px 60px rgba(0,0,0,0.3);
-        }
-        h2 { color: #0b2b5c; margin-bottom: 25px; text-align: center; font-size: 2em; }
-        .form-group { margin-bottom: 20px; }
-        label { display: block; margin-bottom: 8px; color: #2d3748; font-weight: 600; font-size: 0.95em; }
-        input {
-            width: 100%;
-            padding: 14px 18px;
-            border: 2px solid #e2e8f0;
-            border-radius: 15px;
-            font-size: 16px;
-            transition: all 0.3s;
-            background: #f8fafc;
-        }
-        input:focus {
-            border-color: #2c6b9e;
-            outline: none;
-            background: white;
-            box-shadow: 0 0 0 4px rgba(44,107,158,0.1);
-        }
-        .row { display: flex; gap: 15px; }
-        .btn {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            color: white;
-            border: none;
-            padding: 16px;
-            border-radius: 15px;
-            font-size: 18px;
-            font-weight: 600;
-            cursor: pointer;
-            width: 100%;
-            transition: all 0.3s;
-            box-shadow: 0 8px 15px rgba(11,43,92,0.3);
-        }
-        .btn:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 12px 20px rgba(11,43,92,0.4);
-        }
-        .link { text-align: center; margin-top: 25px; }
-        .link a { color: #2c6b9e; text-decoration: none; font-weight: 600; }
-        .link a:hover { text-decoration: underline; }
-        .flash {
-            background-color: #fed7d7;
-            color: #c53030;
-            padding: 15px;
-            border-radius: 12px;
-            margin-bottom: 25px;
-            border: 1px solid #fc8181;
-            font-weight: 500;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('css/register.css') }}">
 </head>
 <body>
     <div class="form-container">
@@ -627,12 +2554,14 @@ def setup_profile():
         if 'avatar' in request.files:
             file = request.files['avatar']
             if file and file.filename:
-                filename = secure_filename(f"{current_user.id}_{file.filename}")
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                filename = avatar_filename(file.filename)
+                save_upload(file, filename)
                 current_user.avatar = filename
                 db.session.commit()
+                invalidate_user(current_user.id)
+                enqueue_image_processing(filename, ['avatar'])
         return redirect(url_for('chats'))
-    return render_template_string(SETUP_PROFILE_HTML)
+    return render_template_string(SETUP_PROFILE_HTML, get_avatar_url=get_avatar_url)
 
 SETUP_PROFILE_HTML = '''
 <!DOCTYPE html>
@@ -641,22 +2570,13 @@ SETUP_PROFILE_HTML = '''
     <title>Выберите аватар</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <link rel="icon" type="image/png" href="/photos/logo.png">
-    <style>
-        body { background: linear-gradient(145deg, #0b2b5c, #2c6b9e); min-height: 100vh; display: flex; justify-content: center; align-items: center; font-family: 'Segoe UI', sans-serif; padding: 20px; }
-        .container { background: white; border-radius: 30px; padding: 40px; max-width: 500px; width: 100%; box-shadow: 0 30px 60px rgba(0,0,0,0.3); text-align: center; }
-        h2 { color: #0b2b5c; }
-        .avatar-preview { width: 150px; height: 150px; border-radius: 50%; margin: 20px auto; border: 4px solid #2c6b9e; object-fit: cover; }
-        .btn { background: linear-gradient(145deg, #0b2b5c, #2c6b9e); color: white; border: none; padding: 14px; border-radius: 15px; font-size: 16px; cursor: pointer; width: 100%; margin: 5px 0; }
-        .btn-outline { background: white; color: #2c6b9e; border: 2px solid #2c6b9e; }
-        input[type="file"] { display: none; }
-        .file-label { display: block; background: #e6f0fa; color: #0b2b5c; padding: 12px; border-radius: 15px; cursor: pointer; margin: 20px 0; border: 2px dashed #2c6b9e; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('css/setup_profile.css') }}">
 </head>
 <body>
     <div class="container">
         <h2>Завершение регистрации</h2>
         <p>Выберите аватар или пропустите</p>
-        <img src="{{ url_for('uploads', filename=current_user.avatar) if current_user.avatar != 'default.jpg' else '/photos/default.jpg' }}" class="avatar-preview" id="preview">
+        <img src="{{ get_avatar_url(current_user) }}" class="avatar-preview" id="preview">
         <form method="POST" enctype="multipart/form-data">
             <label for="avatar" class="file-label">Выбрать файл</label>
             <input type="file" name="avatar" id="avatar" accept="image/*">
@@ -664,16 +2584,7 @@ SETUP_PROFILE_HTML = '''
             <a href="/chats" class="btn btn-outline">Пропустить</a>
         </form>
     </div>
-    <script>
-        document.getElementById('avatar').addEventListener('change', function(e) {
-            const file = e.target.files[0];
-            if (file) {
-                const reader = new FileReader();
-                reader.onload = function(e) { document.getElementById('preview').src = e.target.result; };
-                reader.readAsDataURL(file);
-            }
-        });
-    </script>
+    <script src="{{ asset_url('js/setup_profile.js') }}"></script>
 </body>
 </html>
 '''
@@ -682,18 +2593,18 @@ SETUP_PROFILE_HTML = '''
 @app.route('/chats')
 @login_required
 def chats():
-    memberships = ChatMember.query.filter_by(user_id=current_user.id).all()
-    chat_ids = [m.chat_id for m in memberships]
+    chat_ids = get_user_chat_ids(current_user.id)
     chats = Chat.query.filter(Chat.id.in_(chat_ids)).all()
+    names = chat_names(chats)
+    last = last_messages(chat_ids)
+    unread = unread_counts(current_user.id)
     chat_data = []
     for chat in chats:
-        last_msg = Message.query.filter_by(chat_id=chat.id).order_by(Message.created_at.desc()).first()
-        unread = 0
         chat_data.append({
             'chat': chat,
-            'name': get_chat_name(chat),
-            'last_msg': last_msg,
-            'unread': unread
+            'name': names[chat.id],
+            'last_msg': last.get(chat.id),
+            'unread': unread.get(chat.id, 0)
         })
     return render_template_string(CHATS_HTML, chat_data=chat_data)
 
@@ -704,87 +2615,7 @@ CHATS_HTML = '''
     <title>Чаты</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <link rel="icon" type="image/png" href="/photos/logo.png">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; font-family: 'Segoe UI', sans-serif; }
-        body { background: #f5f7fa; }
-        .navbar {
-            background: white;
-            padding: 15px 20px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        .navbar h1 {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-        }
-        .nav-links a {
-            margin-left: 20px;
-            text-decoration: none;
-            color: #2c6b9e;
-            font-weight: 600;
-        }
-        .container { max-width: 800px; margin: 30px auto; padding: 0 20px; }
-        .chat-list { background: white; border-radius: 20px; box-shadow: 0 5px 15px rgba(0,0,0,0.1); overflow: hidden; }
-        .chat-item {
-            padding: 15px 20px;
-            border-bottom: 1px solid #eee;
-            display: flex;
-            align-items: center;
-            cursor: pointer;
-            transition: background 0.2s;
-        }
-        .chat-item:hover { background: #f0f4fa; }
-        .chat-avatar {
-            width: 50px; height: 50px; border-radius: 50%;
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            margin-right: 15px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-            font-weight: bold;
-            font-size: 1.2em;
-        }
-        .chat-info { flex: 1; }
-        .chat-info h3 { font-size: 18px; margin-bottom: 5px; color: #1a202c; }
-        .chat-info p { color: #718096; font-size: 14px; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; max-width: 400px; }
-        .chat-meta { text-align: right; min-width: 60px; }
-        .chat-time { font-size: 12px; color: #a0aec0; }
-        .unread-badge {
-            background: #2c6b9e;
-            color: white;
-            border-radius: 50%;
-            width: 20px;
-            height: 20px;
-            display: inline-flex;
-            align-items: center;
-            justify-content: center;
-            font-size: 12px;
-        }
-        .new-chat {
-            position: fixed;
-            bottom: 30px;
-            right: 30px;
-            width: 60px;
-            height: 60px;
-            border-radius: 50%;
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            color: white;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            font-size: 28px;
-            box-shadow: 0 5px 15px rgba(44,107,158,0.4);
-            cursor: pointer;
-            transition: transform 0.2s;
-            text-decoration: none;
-        }
-        .new-chat:hover { transform: scale(1.1); }
-        .flash { background-color: #fed7d7; color: #c53030; padding: 10px; border-radius: 12px; margin-bottom: 15px; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('css/chats.css') }}">
 </head>
 <body>
     <div class="navbar">
@@ -816,9 +2647,7 @@ CHATS_HTML = '''
                         {% if item.last_msg %}
                             <div class="chat-time">{{ item.last_msg.created_at.strftime('%H:%M') }}</div>
                         {% endif %}
-                        {% if item.unread > 0 %}
-                            <span class="unread-badge">{{ item.unread }}</span>
-                        {% endif %}
+                        <span class="unread-badge" id="unread-{{ item.chat.id }}"{% if not item.unread %} style="display: none;"{% endif %}>{{ item.unread }}</span>
                     </div>
                 </div>
                 {% endfor %}
@@ -830,6 +2659,8 @@ CHATS_HTML = '''
         </div>
     </div>
     <a href="/new-chat" class="new-chat">+</a>
+    <script src="{{ asset_url('socket.io.js') }}"></script>
+    <script src="{{ asset_url('js/chats.js') }}"></script>
 </body>
 </html>
 '''
@@ -859,13 +2690,13 @@ def new_chat():
             if not chat:
                 flash('Чат не найден')
                 return redirect(url_for('new_chat'))
-            existing = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat.id).first()
-            if existing:
+            if get_membership(current_user.id, chat.id):
                 flash('Вы уже в этом чате')
                 return redirect(url_for('chat', chat_id=chat.id))
             cm = ChatMember(user_id=current_user.id, chat_id=chat.id, role='member')
             db.session.add(cm)
             db.session.commit()
+            invalidate_membership(current_user.id, chat.id)
             flash('Вы присоединились к чату')
             return redirect(url_for('chat', chat_id=chat.id))
 
@@ -887,22 +2718,28 @@ def new_chat():
             if other.id == current_user.id:
                 flash('Нельзя создать чат с самим собой')
                 return render_template_string(NEW_CHAT_TEMPLATE, selected_type=selected_type, saved_name=saved_name, saved_username=saved_username)
-            user_chats = {m.chat_id for m in ChatMember.query.filter_by(user_id=current_user.id)}
-            other_chats = {m.chat_id for m in ChatMember.query.filter_by(user_id=other.id)}
-            common = user_chats & other_chats
-            for cid in common:
-                chat = Chat.query.get(cid)
-                if chat and not chat.is_group and not chat.is_channel:
-                    flash('Чат уже существует')
-                    return redirect(url_for('chat', chat_id=chat.id))
-            chat = Chat(is_group=False, is_channel=False, created_by=current_user.id)
-            db.session.add(chat)
-            db.session.flush()
-            db.session.add_all([
-                ChatMember(user_id=current_user.id, chat_id=chat.id, role='owner'),
-                ChatMember(user_id=other.id, chat_id=chat.id, role='member')
-            ])
-            db.session.commit()
+            key = private_chat_key(current_user.id, other.id)
+            chat = Chat.query.filter_by(private_key=key).first()
+            if chat:
+                flash('Чат уже существует')
+                return redirect(url_for('chat', chat_id=chat.id))
+            chat = Chat(is_group=False, is_channel=False, created_by=current_user.id, private_key=key)
+            try:
+                db.session.add(chat)
+                db.session.flush()
+                db.session.add_all([
+                    ChatMember(user_id=current_user.id, chat_id=chat.id, role='owner'),
+                    ChatMember(user_id=other.id, chat_id=chat.id, role='member')
+                ])
+                db.session.commit()
+            except IntegrityError:
+                # Чат для этой пары только что создал параллельный запрос
+                db.session.rollback()
+                chat = Chat.query.filter_by(private_key=key).first()
+                flash('Чат уже существует')
+                return redirect(url_for('chat', chat_id=chat.id))
+            invalidate_membership(current_user.id, chat.id)
+            invalidate_membership(other.id, chat.id)
             return redirect(url_for('chat', chat_id=chat.id))
 
         elif chat_type == 'group':
@@ -917,11 +2754,36 @@ def new_chat():
             db.session.flush()
             db.session.add(ChatMember(user_id=current_user.id, chat_id=chat.id, role='owner'))
             db.session.commit()
+            invalidate_membership(current_user.id, chat.id)
             return redirect(url_for('chat', chat_id=chat.id))
 
         elif chat_type == 'channel':
-            flash('Функция каналов временно в разработке')
-            return render_template_string(NEW_CHAT_TEMPLATE, selected_type=selected_type, saved_name=saved_name, saved_username=saved_username)
+            if not raw_name.strip():
+                flash('Введите название канала')
+                return render_template_string(NEW_CHAT_TEMPLATE, selected_type=selected_type, saved_name=saved_name, saved_username=saved_username)
+            tokens = set()
+            while len(tokens) < 2:
+                token = generate_invite_token()
+                if not Chat.query.filter_by(invite_token=token).first():
+                    tokens.add(token)
+            channel_token, group_token = tokens
+            # У каждого канала есть группа обсуждения, куда уходят комментарии к постам
+            group = Chat(name=f"{raw_name.strip()}: обсуждение", is_group=True, is_channel=False,
+                         created_by=current_user.id, invite_token=group_token)
+            db.session.add(group)
+            db.session.flush()
+            chat = Chat(name=raw_name.strip(), is_group=False, is_channel=True, created_by=current_user.id,
+                        invite_token=channel_token, linked_group_id=group.id)
+            db.session.add(chat)
+            db.session.flush()
+            db.session.add_all([
+                ChatMember(user_id=current_user.id, chat_id=chat.id, role='owner'),
+                ChatMember(user_id=current_user.id, chat_id=group.id, role='owner')
+            ])
+            db.session.commit()
+            invalidate_membership(current_user.id, chat.id)
+            invalidate_membership(current_user.id, group.id)
+            return redirect(url_for('chat', chat_id=chat.id))
 
     return render_template_string(NEW_CHAT_TEMPLATE, selected_type=selected_type, saved_name=saved_name, saved_username=saved_username)
 
@@ -932,109 +2794,8 @@ NEW_CHAT_TEMPLATE = '''
     <title>Новый чат</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <link rel="icon" type="image/png" href="/photos/logo.png">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; font-family: 'Segoe UI', sans-serif; }
-        body {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            min-height: 100vh;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            padding: 20px;
-        }
-        .container {
-            background: white;
-            border-radius: 30px;
-            padding: 40px;
-            max-width: 550px;
-            width: 100%;
-            box-shadow: 0 30px 60px rgba(0,0,0,0.3);
-        }
-        h2 { color: #0b2b5c; margin-bottom: 25px; text-align: center; }
-        .type-buttons {
-            display: flex;
-            gap: 10px;
-            margin-bottom: 20px;
-            flex-wrap: wrap;
-        }
-        .type-btn {
-            flex: 1;
-            padding: 14px;
-            border: 2px solid #e2e8f0;
-            background: white;
-            color: #2d3748;
-            border-radius: 15px;
-            font-size: 16px;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.2s;
-        }
-        .type-btn.active {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            color: white;
-            border-color: transparent;
-        }
-        .type-btn:hover { background: #e6f0fa; }
-        .type-btn.active:hover { background: linear-gradient(145deg, #1b4a7a, #3c7bb9); }
-        .form-group { margin-bottom: 20px; }
-        label { display: block; margin-bottom: 8px; color: #2d3748; font-weight: 600; }
-        input {
-            width: 100%;
-            padding: 14px 18px;
-            border: 2px solid #e2e8f0;
-            border-radius: 15px;
-            font-size: 16px;
-            transition: 0.3s;
-        }
-        input:focus {
-            border-color: #2c6b9e;
-            outline: none;
-            background: #f8fafc;
-        }
-        .btn {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            color: white;
-            border: none;
-            padding: 16px;
-            border-radius: 15px;
-            font-size: 18px;
-            font-weight: 600;
-            cursor: pointer;
-            width: 100%;
-            transition: 0.3s;
-            margin-top: 10px;
-        }
-        .btn:hover { transform: translateY(-2px); box-shadow: 0 8px 15px rgba(11,43,92,0.3); }
-        .btn-outline {
-            background: white;
-            color: #2c6b9e;
-            border: 2px solid #2c6b9e;
-        }
-        .flash {
-            background-color: #fed7d7;
-            color: #c53030;
-            padding: 15px;
-            border-radius: 12px;
-            margin-bottom: 25px;
-        }
-        .section-title {
-            font-size: 1.2em;
-            margin: 25px 0 15px;
-            color: #0b2b5c;
-            border-bottom: 2px solid #e2e8f0;
-            padding-bottom: 5px;
-        }
-        hr { margin: 30px 0; border: 1px solid #e2e8f0; }
-    </style>
-    <script>
-        function setType(type) {
-            document.getElementById('chat_type').value = type;
-            document.querySelectorAll('.type-btn').forEach(btn => btn.classList.remove('active'));
-            document.getElementById('btn-' + type).classList.add('active');
-            document.getElementById('private-fields').style.display = type === 'private' ? 'block' : 'none';
-            document.getElementById('group-fields').style.display = type === 'group' ? 'block' : 'none';
-        }
-    </script>
+    <link rel="stylesheet" href="{{ asset_url('css/new_chat.css') }}">
+    <script src="{{ asset_url('js/new_chat.js') }}"></script>
 </head>
 <body>
     <div class="container">
@@ -1065,10 +2826,10 @@ NEW_CHAT_TEMPLATE = '''
                 </div>
             </div>
 
-            <div id="group-fields" style="display: {{ 'block' if selected_type == 'group' else 'none' }};">
+            <div id="group-fields" style="display: {{ 'block' if selected_type in ['group', 'channel'] else 'none' }};">
                 <div class="form-group">
-                    <label>Название группы</label>
-                    <input type="text" name="name" value="{{ saved_name if selected_type == 'group' else '' }}">
+                    <label>Название группы или канала</label>
+                    <input type="text" name="name" value="{{ saved_name if selected_type in ['group', 'channel'] else '' }}">
                 </div>
             </div>
 
@@ -1104,12 +2865,15 @@ NEW_CHAT_TEMPLATE = '''
 @login_required
 def chat(chat_id):
     chat = Chat.query.get_or_404(chat_id)
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat_id).first()
+    membership = get_membership(current_user.id, chat_id)
     if not membership:
         flash('Вы не участник этого чата')
         return redirect(url_for('chats'))
-    messages = Message.query.filter_by(chat_id=chat_id).order_by(Message.created_at).all()
-    pinned = Message.query.filter_by(chat_id=chat_id, pinned=True).first()
+    use_chat_shard(chat_id)
+    mark_read(current_user.id, chat_id)
+    messages, has_more, pinned = chat_page(chat_id, request.args.get('before', type=int))
+    if messages and all(msg.archived for msg in messages):
+        stable_response()
     is_private = not chat.is_group and not chat.is_channel
     other_user = None
     if is_private:
@@ -1118,9 +2882,12 @@ def chat(chat_id):
             if m.id != current_user.id:
                 other_user = m
                 break
-    return render_template_string(CHAT_TEMPLATE, chat=chat, messages=messages, pinned=pinned,
+    return render_template_string(CHAT_TEMPLATE, chat=chat, messages=messages, pinned=pinned, has_more=has_more,
+                                  can_post=can_post(chat, membership),
                                   User=User, current_user=current_user, get_chat_name=get_chat_name,
-                                  membership=membership, is_private=is_private, other_user=other_user)
+                                  membership=membership, is_private=is_private, other_user=other_user,
+                                  is_image=is_image, get_upload_url=get_upload_url,
+                                  get_user_profile=get_user_profile, presence_text=presence_text)
 
 CHAT_TEMPLATE = '''
 <!DOCTYPE html>
@@ -1129,197 +2896,16 @@ CHAT_TEMPLATE = '''
     <title>Чат</title>
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <link rel="icon" type="image/png" href="/photos/logo.png">
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.js"></script>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; font-family: 'Segoe UI', sans-serif; }
-        body { background: #f0f4fa; height: 100vh; display: flex; flex-direction: column; }
-        .chat-header {
-            background: white;
-            padding: 15px 25px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-            display: flex;
-            align-items: center;
-            gap: 15px;
-            flex-wrap: wrap;
-        }
-        .chat-header .back {
-            font-size: 28px;
-            color: #2c6b9e;
-            text-decoration: none;
-        }
-        .chat-header h2 { color: #0b2b5c; font-size: 1.5em; }
-        .call-buttons {
-            display: flex;
-            gap: 10px;
-            margin-left: auto;
-        }
-        .call-btn {
-            background: #2c6b9e;
-            color: white;
-            border: none;
-            width: 45px;
-            height: 45px;
-            border-radius: 50%;
-            cursor: pointer;
-            font-size: 20px;
-            transition: 0.2s;
-            box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-            text-decoration: none;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-        }
-        .call-btn:hover { background: #1e4a7a; transform: scale(1.1); }
-        .search-box {
-            margin: 10px 25px;
-            display: flex;
-        }
-        .search-box input {
-            flex: 1;
-            padding: 12px;
-            border: 2px solid #ddd;
-            border-radius: 30px 0 0 30px;
-            outline: none;
-            font-size: 14px;
-        }
-        .search-box button {
-            background: #2c6b9e;
-            color: white;
-            border: none;
-            padding: 0 20px;
-            border-radius: 0 30px 30px 0;
-            cursor: pointer;
-        }
-        .pinned-message {
-            background: #fff3cd;
-            margin: 10px 25px;
-            padding: 12px 20px;
-            border-radius: 30px;
-            display: flex;
-            justify-content: space-between;
-            border: 1px solid #ffe58c;
-        }
-        .messages-container {
-            flex: 1;
-            overflow-y: auto;
-            padding: 20px 25px;
-            display: flex;
-            flex-direction: column;
-            gap: 10px;
-        }
-        .message {
-            max-width: 70%;
-            padding: 12px 18px;
-            border-radius: 25px;
-            position: relative;
-            word-wrap: break-word;
-            animation: fadeIn 0.2s;
-        }
-        @keyframes fadeIn { from { opacity: 0; transform: translateY(5px); } to { opacity: 1; transform: translateY(0); } }
-        .message.sent {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            color: white;
-            align-self: flex-end;
-            border-bottom-right-radius: 5px;
-        }
-        .message.received {
-            background: white;
-            color: #1a202c;
-            align-self: flex-start;
-            border-bottom-left-radius: 5px;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.05);
-        }
-        .message .sender { font-size: 12px; font-weight: bold; margin-bottom: 4px; }
-        .message.sent .sender { color: #ddd; }
-        .message .time { font-size: 10px; margin-top: 5px; text-align: right; opacity: 0.7; }
-        .reply-info, .forward-info { font-size: 11px; background: rgba(0,0,0,0.05); padding: 4px 8px; border-radius: 12px; margin-bottom: 5px; }
-        .file-attachment {
-            margin-top: 8px;
-            padding: 8px;
-            background: rgba(255,255,255,0.2);
-            border-radius: 12px;
-            display: flex;
-            align-items: center;
-        }
-        .file-attachment a { color: inherit; text-decoration: none; }
-        .reactions {
-            display: flex;
-            gap: 5px;
-            margin-top: 8px;
-            flex-wrap: wrap;
-        }
-        .reaction {
-            background: rgba(0,0,0,0.1);
-            border-radius: 20px;
-            padding: 2px 10px;
-            font-size: 13px;
-            cursor: pointer;
-        }
-        .message-actions {
-            display: flex;
-            gap: 15px;
-            margin-top: 8px;
-            font-size: 12px;
-            color: #2c6b9e;
-            cursor: pointer;
-        }
-        .input-area {
-            background: white;
-            padding: 15px 25px;
-            display: flex;
-            gap: 12px;
-            border-top: 1px solid #e2e8f0;
-            flex-wrap: wrap;
-            align-items: center;
-        }
-        .input-area input[type="text"] {
-            flex: 1;
-            padding: 14px 20px;
-            border: 2px solid #e2e8f0;
-            border-radius: 40px;
-            font-size: 15px;
-            outline: none;
-            transition: 0.2s;
-        }
-        .input-area input[type="text"]:focus { border-color: #2c6b9e; }
-        .input-area button {
-            background: linear-gradient(145deg, #0b2b5c, #2c6b9e);
-            color: white;
-            border: none;
-            width: 55px;
-            height: 55px;
-            border-radius: 50%;
-            font-size: 22px;
-            cursor: pointer;
-            transition: 0.2s;
-        }
-        .input-area button:hover { transform: scale(1.05); }
-        .input-area .file-label {
-            background: #e6f0fa;
-            color: #0b2b5c;
-            padding: 14px 20px;
-            border-radius: 40px;
-            cursor: pointer;
-            font-weight: 600;
-        }
-        .input-area input[type="file"] { display: none; }
-        .reply-context, .edit-context {
-            width: 100%;
-            background: #e6f0fa;
-            padding: 12px 20px;
-            border-radius: 30px;
-            margin-bottom: 10px;
-            display: flex;
-            justify-content: space-between;
-        }
-        .close { cursor: pointer; font-weight: bold; color: #2c6b9e; }
-        .flash { background-color: #fed7d7; color: #c53030; padding: 10px 20px; border-radius: 30px; margin: 10px 25px; }
-    </style>
+    <script src="{{ asset_url('socket.io.js') }}"></script>
+    <link rel="stylesheet" href="{{ asset_url('css/chat.css') }}">
 </head>
 <body>
     <div class="chat-header">
         <a href="/chats" class="back">←</a>
-        <h2>{{ get_chat_name(chat) }}</h2>
+        <div>
+            <h2>{{ get_chat_name(chat) }}</h2>
+            <div id="presence-status" class="presence-status">{{ presence_text(other_user) if is_private and other_user else '' }}</div>
+        </div>
         <div class="call-buttons">
             {% if is_private and other_user %}
                 <a href="https://mateugram-voice.onrender.com/create?user={{ current_user.username }}" target="_blank" class="call-btn" title="Позвонить через MateuGram Voice">📞</a>
@@ -1348,17 +2934,17 @@ CHAT_TEMPLATE = '''
             {% endfor %}
           {% endif %}
         {% endwith %}
+        {% if has_more %}
+            <a href="?before={{ messages[0].id }}" class="load-more">Показать более ранние</a>
+        {% endif %}
         {% for msg in messages %}
-            {% set sender = User.query.get(msg.sender_id) %}
+            {% set sender = get_user_profile(msg.sender_id) %}
             <div class="message {{ 'sent' if msg.sender_id == current_user.id else 'received' }}" data-id="{{ msg.id }}" id="msg-{{ msg.id }}">
                 {% if msg.sender_id != current_user.id %}
                     <div class="sender">{{ sender.first_name }}</div>
                 {% endif %}
-                {% if msg.reply_to %}
-                    {% set parent = Message.query.get(msg.reply_to) %}
-                    {% if parent %}
-                        <div class="reply-info">В ответ на: {{ parent.content[:30] }}{% if parent.content|length > 30 %}…{% endif %}</div>
-                    {% endif %}
+                {% if msg.reply_preview is not none %}
+                    <div class="reply-info">В ответ на: {{ msg.reply_preview[:30] }}{% if msg.reply_preview|length > 30 %}…{% endif %}</div>
                 {% endif %}
                 {% if msg.forwarded_from %}
                     <div class="forward-info">Переслано</div>
@@ -1367,9 +2953,15 @@ CHAT_TEMPLATE = '''
                 {% if msg.edited %}<span style="font-size: 10px;">(ред.)</span>{% endif %}
                 {% if msg.file_path %}
                     <div class="file-attachment">
-                        <a href="{{ url_for('uploads', filename=msg.file_path.split('/')[-1]) }}" target="_blank">
+                        {% if is_image(msg.file_path) %}
+                        <a href="{{ get_upload_url(msg.file_path) }}" target="_blank">
+                            <img src="{{ get_upload_url(msg.file_path, 'thumb') }}" class="file-thumb" alt="{{ msg.file_name }}" loading="lazy">
+                        </a>
+                        {% else %}
+                        <a href="{{ get_upload_url(msg.file_path) }}" target="_blank">
                             📎 {{ msg.file_name }}
                         </a>
+                        {% endif %}
                     </div>
                 {% endif %}
                 <div class="time">{{ msg.created_at.strftime('%H:%M') }}</div>
@@ -1378,10 +2970,17 @@ CHAT_TEMPLATE = '''
                         <span class="reaction" onclick="addReaction({{ msg.id }}, '{{ r.reaction }}')">{{ r.reaction }}</span>
                     {% endfor %}
                 </div>
+                {% if msg.archived %}
+                {% if msg.comment_count %}
+                <div class="message-actions">
+                    <span onclick="showComments({{ msg.id }})">Комментарии ({{ msg.comment_count }})</span>
+                </div>
+                {% endif %}
+                {% else %}
                 <div class="message-actions">
                     <span onclick="replyTo({{ msg.id }}, '{{ msg.content[:30] }}')">Ответить</span>
                     <span onclick="forward({{ msg.id }})">Переслать</span>
-                    <span onclick="showComments({{ msg.id }})">Комментарии</span>
+                    <span onclick="showComments({{ msg.id }})">Комментарии{% if msg.comment_count %} ({{ msg.comment_count }}){% endif %}</span>
                     {% if msg.sender_id == current_user.id %}
                         <span onclick="editMessage({{ msg.id }}, '{{ msg.content }}')">✏️</span>
                         <span onclick="deleteMessage({{ msg.id }})">🗑️</span>
@@ -1393,6 +2992,7 @@ CHAT_TEMPLATE = '''
                     <span onclick="addReaction({{ msg.id }}, '❤️')">❤️</span>
                     <span onclick="addReaction({{ msg.id }}, '😮')">😮</span>
                 </div>
+                {% endif %}
             </div>
         {% endfor %}
     </div>
@@ -1406,158 +3006,26 @@ CHAT_TEMPLATE = '''
         <span class="close" onclick="cancelEdit()">✖</span>
     </div>
 
+    {% if can_post %}
     <div class="input-area">
         <input type="text" id="message-input" placeholder="Напишите сообщение...">
         <label for="file-upload" class="file-label">📎 Файл</label>
         <input type="file" id="file-upload" name="file" onchange="uploadFile()">
         <button id="send-btn">➤</button>
     </div>
+    {% else %}
+    <div class="read-only">Публиковать в канале могут только администраторы</div>
+    {% endif %}
 
     <script>
-        var socket = io();
         var chatId = {{ chat.id }};
         var userId = {{ current_user.id }};
-        var replyToId = null;
-        var editMessageId = null;
         var otherUserId = {{ other_user.id if other_user else 'null' }};
-
-        socket.on('connect', function() {
-            socket.emit('join', {chat_id: chatId});
-        });
-
-        document.getElementById('send-btn').onclick = sendMessage;
-        document.getElementById('message-input').onkeypress = function(e) {
-            if (e.key === 'Enter') sendMessage();
-        };
-
-        function sendMessage() {
-            var input = document.getElementById('message-input');
-            var text = input.value.trim();
-            var fileInput = document.getElementById('file-upload');
-            if (editMessageId) {
-                fetch('/edit_message', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({message_id: editMessageId, content: text})
-                }).then(response => response.json())
-                  .then(data => { if (data.success) location.reload(); else alert('Ошибка'); });
-                cancelEdit();
-                return;
-            }
-            if (text || fileInput.files.length > 0) {
-                if (fileInput.files.length > 0) {
-                    var formData = new FormData();
-                    formData.append('file', fileInput.files[0]);
-                    formData.append('chat_id', chatId);
-                    formData.append('content', text);
-                    formData.append('reply_to', replyToId);
-                    fetch('/upload', { method: 'POST', body: formData })
-                        .then(response => response.json())
-                        .then(data => {
-                            if (data.success) {
-                                socket.emit('send_message', {
-                                    chat_id: chatId,
-                                    content: text,
-                                    file_path: data.file_path,
-                                    file_name: data.file_name,
-                                    file_type: data.file_type,
-                                    sender_id: userId,
-                                    reply_to: replyToId
-                                });
-                                input.value = '';
-                                fileInput.value = '';
-                                cancelReply();
-                            } else alert('Ошибка загрузки');
-                        });
-                } else {
-                    socket.emit('send_message', {
-                        chat_id: chatId,
-                        content: text,
-                        sender_id: userId,
-                        reply_to: replyToId
-                    });
-                    input.value = '';
-                    cancelReply();
-                }
-            }
-        }
-
-        socket.on('new_message', function(data) {
-            var messagesDiv = document.getElementById('messages');
-            var msgDiv = document.createElement('div');
-            msgDiv.className = 'message ' + (data.sender_id == userId ? 'sent' : 'received');
-            if (data.sender_id != userId) {
-                var senderDiv = document.createElement('div');
-                senderDiv.className = 'sender';
-                senderDiv.innerText = data.sender_name;
-                msgDiv.appendChild(senderDiv);
-            }
-            if (data.reply_to) {
-                var replyDiv = document.createElement('div');
-                replyDiv.className = 'reply-info';
-                replyDiv.innerText = 'В ответ на...';
-                msgDiv.appendChild(replyDiv);
-            }
-            var contentDiv = document.createElement('div');
-            contentDiv.innerText = data.content;
-            msgDiv.appendChild(contentDiv);
-            if (data.file_path) {
-                var fileDiv = document.createElement('div');
-                fileDiv.className = 'file-attachment';
-                fileDiv.innerHTML = `<a href="/uploads/${data.file_path.split('/').pop()}" target="_blank">📎 ${data.file_name}</a>`;
-                msgDiv.appendChild(fileDiv);
-            }
-            var timeDiv = document.createElement('div');
-            timeDiv.className = 'time';
-            timeDiv.innerText = new Date().toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
-            msgDiv.appendChild(timeDiv);
-            messagesDiv.appendChild(msgDiv);
-            messagesDiv.scrollTop = messagesDiv.scrollHeight;
-        });
-
-        function replyTo(msgId, preview) {
-            replyToId = msgId;
-            document.getElementById('reply-indicator').style.display = 'flex';
-            document.getElementById('reply-text').innerText = 'Ответ на: ' + preview;
-        }
-        function cancelReply() { replyToId = null; document.getElementById('reply-indicator').style.display = 'none'; }
-        function editMessage(msgId, content) {
-            editMessageId = msgId;
-            document.getElementById('message-input').value = content;
-            document.getElementById('edit-indicator').style.display = 'flex';
-        }
-        function cancelEdit() {
-            editMessageId = null;
-            document.getElementById('edit-indicator').style.display = 'none';
-            document.getElementById('message-input').value = '';
-        }
-        function deleteMessage(msgId) {
-            if (confirm('Удалить сообщение?')) {
-                fetch('/delete_message', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId}) })
-                    .then(response => response.json()).then(data => { if (data.success) location.reload(); });
-            }
-        }
-        function pinMessage(msgId) {
-            fetch('/pin_message', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId}) })
-                .then(response => response.json()).then(data => { if (data.success) location.reload(); });
-        }
-        function addReaction(msgId, emoji) {
-            fetch('/react', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId, reaction: emoji}) })
-                .then(response => response.json()).then(data => { if (data.success) location.reload(); });
-        }
-        function forward(msgId) {
-            var chatId = prompt('Введите ID чата для пересылки:');
-            if (chatId) {
-                fetch('/forward', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId, to_chat_id: chatId}) })
-                    .then(response => response.json()).then(data => { if (data.success) alert('Переслано'); else alert('Ошибка'); });
-            }
-        }
-        function showComments(msgId) { window.location.href = '/message/' + msgId + '/comments'; }
-        function searchMessages() {
-            var query = document.getElementById('search-input').value;
-            if (query) window.location.href = '/chat/' + chatId + '/search?q=' + encodeURIComponent(query);
-        }
+        // id последнего показанного сообщения: с ним переподключение догружает только пропущенное
+        var lastMessageId = {{ messages[-1].id if messages else 0 }};
     </script>
+    <script src="{{ asset_url('js/msgpack.js') }}"></script>
+    <script src="{{ asset_url('js/chat.js') }}"></script>
 </body>
 </html>
 '''
@@ -1568,21 +3036,17 @@ CHAT_TEMPLATE = '''
 def search_messages(chat_id):
     query = request.args.get('q', '')
     chat = Chat.query.get_or_404(chat_id)
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat_id).first()
+    membership = get_membership(current_user.id, chat_id)
     if not membership:
         flash('Вы не участник этого чата')
         return redirect(url_for('chats'))
+    use_chat_shard(chat_id)
     messages = Message.query.filter(Message.chat_id == chat_id, Message.content.contains(query)).order_by(Message.created_at).all()
     return render_template_string('''
         <!DOCTYPE html>
         <html>
         <head><title>Поиск</title><meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { background: #f5f7fa; padding:20px; }
-            .container { max-width:800px; margin:0 auto; background:white; border-radius:30px; padding:30px; }
-            .message { padding:12px; border-bottom:1px solid #eee; }
-            .time { font-size:12px; color:#999; }
-        </style>
+        <link rel="stylesheet" href="{{ asset_url('css/search.css') }}">
         </head>
         <body><div class="container">
             <a href="/chat/{{ chat_id }}" style="display:block; margin-bottom:20px;">← Вернуться</a>
@@ -1599,12 +3063,15 @@ def edit_message():
     data = request.get_json()
     msg_id = data.get('message_id')
     new_content = data.get('content', '').strip()
+    use_message_shard(msg_id)
     msg = Message.query.get(msg_id)
     if not msg or msg.sender_id != current_user.id:
         return jsonify({'success': False})
     msg.content = new_content
     msg.edited = True
     db.session.commit()
+    recent_messages.invalidate(msg.chat_id)
+    room_buffer.discard(msg.chat_id)
     return jsonify({'success': True})
 
 # ---------- Удаление сообщения ----------
@@ -1614,13 +3081,16 @@ def edit_message():
 def delete_message():
     data = request.get_json()
     msg_id = data.get('message_id')
+    use_message_shard(msg_id)
     msg = Message.query.get(msg_id)
     if not msg:
         return jsonify({'success': False})
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=msg.chat_id).first()
+    membership = get_membership(current_user.id, msg.chat_id)
     if msg.sender_id == current_user.id or (membership and membership.role in ['owner', 'admin']):
         db.session.delete(msg)
         db.session.commit()
+        recent_messages.invalidate(msg.chat_id)
+        room_buffer.discard(msg.chat_id)
         return jsonify({'success': True})
     return jsonify({'success': False})
 
@@ -1631,14 +3101,16 @@ def delete_message():
 def pin_message():
     data = request.get_json()
     msg_id = data.get('message_id')
+    use_message_shard(msg_id)
     msg = Message.query.get(msg_id)
     if not msg:
         return jsonify({'success': False})
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=msg.chat_id).first()
+    membership = get_membership(current_user.id, msg.chat_id)
     if membership and membership.role in ['owner', 'admin']:
         Message.query.filter_by(chat_id=msg.chat_id, pinned=True).update({'pinned': False})
         msg.pinned = True
         db.session.commit()
+        recent_messages.invalidate(msg.chat_id)
         return jsonify({'success': True})
     return jsonify({'success': False})
 
@@ -1654,13 +3126,26 @@ def upload_file():
         return jsonify({'success': False, 'error': 'No file'})
     if file and allowed_file(file.filename):
         filename = secure_filename(f"{current_user.id}_{datetime.now().timestamp()}_{file.filename}")
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        file_path = save_upload(file, filename)
+        enqueue_image_processing(filename, ['thumb'])
         file_type = file.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
         return jsonify({'success': True, 'file_path': file_path, 'file_name': file.filename, 'file_type': file_type})
     return jsonify({'success': False, 'error': 'File type not allowed'})
 
 # ---------- Реакции ----------
+def toggle_reaction(message_id, user_id, reaction):
+    """Ставит реакцию (заменяя прежнюю реакцию пользователя) или снимает такую же."""
+    use_message_shard(message_id)
+    existing = Reaction.query.filter_by(message_id=message_id, user_id=user_id, reaction=reaction).first()
+    if existing:
+        db.session.delete(existing)
+    else:
+        Reaction.query.filter_by(message_id=message_id, user_id=user_id).delete()
+        r = Reaction(message_id=message_id, user_id=user_id, reaction=reaction)
+        db.session.add(r)
+    db.session.commit()
+    recent_messages.invalidate_message(message_id)
+
 @app.route('/react', methods=['POST'])
 @login_required
 @sync_after_change
@@ -1670,14 +3155,7 @@ def react():
     reaction = data.get('reaction')
     if not message_id or not reaction:
         return jsonify({'success': False})
-    existing = Reaction.query.filter_by(message_id=message_id, user_id=current_user.id, reaction=reaction).first()
-    if existing:
-        db.session.delete(existing)
-    else:
-        Reaction.query.filter_by(message_id=message_id, user_id=current_user.id).delete()
-        r = Reaction(message_id=message_id, user_id=current_user.id, reaction=reaction)
-        db.session.add(r)
-    db.session.commit()
+    toggle_reaction(message_id, current_user.id, reaction)
     return jsonify({'success': True})
 
 # ---------- Пересылка ----------
@@ -1690,12 +3168,19 @@ def forward():
     to_chat_id = data.get('to_chat_id')
     if not message_id or not to_chat_id:
         return jsonify({'success': False})
+    use_message_shard(message_id)
     original = Message.query.get(message_id)
     if not original:
         return jsonify({'success': False})
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=to_chat_id).first()
-    if not membership:
+    try:
+        to_chat_id = int(to_chat_id)
+    except (TypeError, ValueError):
+        return jsonify({'success': False})
+    membership = get_membership(current_user.id, to_chat_id)
+    if not can_post(db.session.get(Chat, to_chat_id), membership):
         return jsonify({'success': False})
+    # Копия пишется в шард чата-получателя
+    use_chat_shard(to_chat_id)
     new_msg = Message(
         sender_id=current_user.id,
         chat_id=to_chat_id,
@@ -1707,99 +3192,177 @@ def forward():
     )
     db.session.add(new_msg)
     db.session.commit()
-    socketio.emit('new_message', {
-        'content': new_msg.content,
-        'sender_id': current_user.id,
-        'sender_name': current_user.first_name,
-        'chat_id': to_chat_id,
-        'file_path': new_msg.file_path,
-        'file_name': new_msg.file_name
-    }, room=f"chat_{to_chat_id}")
+    broadcast_message(new_msg, current_user.first_name)
     return jsonify({'success': True})
 
 # ---------- Комментарии к сообщению ----------
+COMMENTS_PAGE_SIZE = 50
+COMMENTS_MAX_PAGE_SIZE = 200
+
+def comments_limit():
+    """?limit= страницы комментариев, приведённый к 1..COMMENTS_MAX_PAGE_SIZE."""
+    limit = request.args.get('limit', COMMENTS_PAGE_SIZE, type=int)
+    return max(1, min(limit, COMMENTS_MAX_PAGE_SIZE))
+
+def comments_access(message):
+    """Проверяет доступ к комментариям сообщения.
+    Возвращает (id чата, в котором состоит пользователь, или None; комнаты для рассылки новых комментариев).
+    Комментарии к постам канала доступны и участникам его группы обсуждения."""
+    chat = db.session.get(Chat, message.chat_id)
+    rooms = [f"chat_{message.chat_id}"]
+    if chat.is_channel and chat.linked_group_id:
+        rooms.append(f"chat_{chat.linked_group_id}")
+    if get_membership(current_user.id, message.chat_id):
+        return message.chat_id, rooms
+    if chat.is_channel and chat.linked_group_id and get_membership(current_user.id, chat.linked_group_id):
+        return chat.linked_group_id, rooms
+    return None, rooms
+
+def comment_message_or_404(message_id):
+    """Сообщение для страницы комментариев: из базы или, если оно уже в архиве, из сегмента."""
+    use_message_shard(message_id)
+    message = db.session.get(Message, message_id) or find_archived_message(message_id)
+    if message is None:
+        abort(404)
+    return message
+
+def comments_page(message, after=None, limit=COMMENTS_PAGE_SIZE):
+    """Страница комментариев (keyset по id) с авторами, загруженными одним запросом.
+    Комментарии архивного сообщения лежат в его сегменте."""
+    if message.archived:
+        page = [c for c in message.comments if not after or c.id > after][:limit + 1]
+    else:
+        query = Comment.query.filter_by(message_id=message.id)
+        if after:
+            query = query.filter(Comment.id > after)
+        page = query.order_by(Comment.id).limit(limit + 1).all()
+    has_more = len(page) > limit
+    page = page[:limit]
+    authors = get_user_profiles(c.user_id for c in page)
+    return [serialize_comment(c, authors.get(c.user_id)) for c in page], has_more
+
+def add_comment(message, content, rooms):
+    """Сохраняет комментарий и рассылает его в комнаты. Возвращает событие new_comment."""
+    comment = Comment(user_id=current_user.id, message_id=message.id, content=content)
+    db.session.add(comment)
+    Message.query.filter_by(id=message.id).update({Message.comment_count: Message.comment_count + 1})
+    db.session.commit()
+    recent_messages.invalidate(message.chat_id)
+    payload = serialize_comment(comment, get_user_profile(current_user.id))
+    payload['chat_id'] = message.chat_id
+    for room in rooms:
+        socketio.emit('new_comment', payload, room=room)
+    request_sync()
+    return payload
+
+def serialize_comment(comment, author):
+    return {
+        'id': comment.id,
+        'message_id': comment.message_id,
+        'user_id': comment.user_id,
+        'user_name': author.first_name if author else '',
+        'content': comment.content,
+        'created_at': comment.created_at.strftime('%d.%m.%Y %H:%M')
+    }
+
 @app.route('/message/<int:message_id>/comments', methods=['GET', 'POST'])
 @login_required
-@sync_after_change
 def message_comments(message_id):
-    message = Message.query.get_or_404(message_id)
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=message.chat_id).first()
-    if not membership:
+    message = comment_message_or_404(message_id)
+    room_chat_id, rooms = comments_access(message)
+    if not room_chat_id:
         flash('Доступ запрещён')
         return redirect(url_for('chats'))
     if request.method == 'POST':
         content = request.form.get('content')
-        if content:
-            comment = Comment(user_id=current_user.id, message_id=message_id, content=content)
-            db.session.add(comment)
-            db.session.commit()
+        if message.archived:
+            flash('Сообщение в архиве, комментарии только для чтения')
+        elif content:
+            add_comment(message, content, rooms)
             flash('Комментарий добавлен')
         return redirect(url_for('message_comments', message_id=message_id))
-    comments = Comment.query.filter_by(message_id=message_id).order_by(Comment.created_at).all()
+    comments, has_more = comments_page(message)
     return render_template_string('''
         <!DOCTYPE html>
         <html>
         <head><title>Комментарии</title><meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { background: #f5f7fa; padding:20px; }
-            .container { max-width:600px; margin:0 auto; background:white; border-radius:30px; padding:30px; }
-            .comment { padding:15px; border-bottom:1px solid #eee; }
-            .author { font-weight:bold; color:#2c6b9e; }
-            .time { font-size:12px; color:#999; margin-left:10px; }
-            .content { margin-top:5px; }
-            textarea { width:100%; padding:12px; border:2px solid #e2e8f0; border-radius:15px; }
-            .btn { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); color:white; border:none; padding:12px; border-radius:15px; cursor:pointer; }
-        </style>
+        <script src="{{ asset_url('socket.io.js') }}"></script>
+        <link rel="stylesheet" href="{{ asset_url('css/comments.css') }}">
         </head>
         <body><div class="container">
             <a href="/chat/{{ message.chat_id }}" style="display:block; margin-bottom:20px;">← Назад</a>
             <h2>Комментарии</h2>
             <div style="background:#e6f0fa; padding:10px; border-radius:15px; margin-bottom:20px;">{{ message.content }}</div>
             {% with messages = get_flashed_messages() %}{% if messages %}{% for msg in messages %}<div style="background:#fed7d7; padding:10px; border-radius:10px;">{{ msg }}</div>{% endfor %}{% endif %}{% endwith %}
-            <div id="comments">{% for comment in comments %}<div class="comment"><span class="author">{{ comment.user.first_name }}</span><span class="time">{{ comment.created_at.strftime('%d.%m.%Y %H:%M') }}</span><div class="content">{{ comment.content }}</div></div>{% endfor %}</div>
-            <form method="POST"><textarea name="content" placeholder="Напишите комментарий..." rows="3"></textarea><button type="submit" class="btn">Отправить</button></form>
-        </div></body></html>
-    ''', message=message, comments=comments)
+            <div id="comments">{% for comment in comments %}<div class="comment"><span class="author">{{ comment.user_name }}</span><span class="time">{{ comment.created_at }}</span><div class="content">{{ comment.content }}</div></div>{% endfor %}</div>
+            <button id="more" class="btn more" onclick="loadMore()" style="display: {{ 'block' if has_more else 'none' }};">Показать ещё</button>
+            {% if not message.archived %}<form method="POST"><textarea name="content" placeholder="Напишите комментарий..." rows="3"></textarea><button type="submit" class="btn">Отправить</button></form>{% endif %}
+        </div>
+        <script>
+            var messageId = {{ message.id }};
+            var lastId = {{ comments[-1].id if comments else 0 }};
+            var hasMore = {{ 'true' if has_more else 'false' }};
+            var roomChatId = {{ room_chat_id }};
+        </script>
+        <script src="{{ asset_url('js/comments.js') }}"></script>
+        </body></html>
+    ''', message=message, comments=comments, has_more=has_more, room_chat_id=room_chat_id)
+
+@app.route('/message/<int:message_id>/comments.json')
+@login_required
+def message_comments_json(message_id):
+    """Страница комментариев в JSON: ?after=<id последнего полученного>&limit=<до 200>."""
+    message = comment_message_or_404(message_id)
+    room_chat_id, _ = comments_access(message)
+    if not room_chat_id:
+        return jsonify({'success': False, 'error': 'Forbidden'}), 403
+    comments, has_more = comments_page(message, request.args.get('after', type=int), comments_limit())
+    return jsonify({'success': True, 'comments': comments, 'has_more': has_more,
+                    'comment_count': message.comment_count})
 
 # ---------- Информация о чате ----------
+def chat_members(chat):
+    """(пользователи, роль по id пользователя, число участников) для страницы чата."""
+    member_query = ChatMember.query.filter_by(chat_id=chat.id)
+    if chat.is_channel:
+        # У канала могут быть сотни тысяч подписчиков: показываем только администрацию и число подписчиков
+        member_count = member_query.count()
+        member_query = member_query.filter(ChatMember.role.in_(['owner', 'admin']))
+    member_roles = {m.user_id: m.role for m in member_query}
+    members = User.query.filter(User.id.in_(member_roles)).all() if member_roles else []
+    if not chat.is_channel:
+        member_count = len(members)
+    return members, member_roles, member_count
+
 @app.route('/chat/<int:chat_id>/info')
 @login_required
 def chat_info(chat_id):
     chat = Chat.query.get_or_404(chat_id)
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat_id).first()
+    membership = get_membership(current_user.id, chat_id)
     if not membership:
         flash('Вы не участник этого чата')
         return redirect(url_for('chats'))
-    members = User.query.join(ChatMember, ChatMember.user_id == User.id).filter(ChatMember.chat_id == chat_id).all()
-    member_roles = {m.user_id: m.role for m in ChatMember.query.filter_by(chat_id=chat_id)}
+    members, member_roles, member_count = chat_members(chat)
     return render_template_string('''
         <!DOCTYPE html>
         <html>
         <head><title>Информация о чате</title><meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { background:#f5f7fa; padding:20px; }
-            .container { max-width:600px; margin:0 auto; background:white; border-radius:30px; padding:30px; }
-            .member { display:flex; align-items:center; padding:12px; border-bottom:1px solid #eee; }
-            .member-avatar { width:40px; height:40px; border-radius:50%; background:linear-gradient(145deg,#0b2b5c,#2c6b9e); color:white; display:flex; align-items:center; justify-content:center; margin-right:15px; }
-            .member-name { flex:1; }
-            .member-role { color:#718096; }
-            .btn { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); color:white; padding:10px 20px; border-radius:30px; text-decoration:none; display:inline-block; margin-top:20px; }
-            .btn-small { padding:5px 10px; font-size:12px; margin-left:5px; }
-        </style>
+        <link rel="stylesheet" href="{{ asset_url('css/chat_info.css') }}">
         </head>
         <body><div class="container">
             <a href="/chat/{{ chat.id }}" style="display:block; margin-bottom:20px;">← Вернуться</a>
             <h2>{{ get_chat_name(chat) }}</h2>
             <p>Тип: {% if chat.is_channel %}Канал{% elif chat.is_group %}Группа{% else %}Личный чат{% endif %}</p>
             {% if chat.invite_token %}<p>Приглашение: <a href="{{ url_for('join_chat', token=chat.invite_token) }}">{{ request.host_url }}join/{{ chat.invite_token }}</a></p>{% endif %}
-            <h3>Участники ({{ members|length }})</h3>
+            {% if chat.is_channel %}<h3>Подписчики: {{ member_count }}</h3><h4>Администраторы</h4>{% else %}<h3>Участники ({{ member_count }})</h3>{% endif %}
             <div>{% for user in members %}<div class="member"><div class="member-avatar">{{ user.first_name[:1] }}</div><div class="member-name">{{ user.first_name }} {{ user.last_name }}</div><div class="member-role">{{ member_roles[user.id] }}</div>{% if (membership.role in ['owner','admin']) and user.id != current_user.id %}<div><a href="/chat/{{ chat.id }}/set_role/{{ user.id }}/admin" class="btn-small">админ</a><a href="/chat/{{ chat.id }}/set_role/{{ user.id }}/member" class="btn-small">участник</a><a href="/chat/{{ chat.id }}/remove/{{ user.id }}" class="btn-small">удалить</a></div>{% endif %}</div>{% endfor %}</div>
             {% if chat.is_group or chat.is_channel %}
                 {% if membership.role in ['owner','admin'] %}<a href="/chat/{{ chat.id }}/add_member" class="btn">Добавить участника</a>{% endif %}
                 <a href="/chat/{{ chat.id }}/leave" class="btn" style="background:#dc3545;">Покинуть чат</a>
             {% endif %}
         </div></body></html>
-    ''', chat=chat, members=members, member_roles=member_roles, get_chat_name=get_chat_name, membership=membership)
+    ''', chat=chat, members=members, member_roles=member_roles, member_count=member_count,
+        get_chat_name=get_chat_name, membership=membership)
 
 # ---------- Назначение роли ----------
 @app.route('/chat/<int:chat_id>/set_role/<int:user_id>/<role>')
@@ -1807,7 +3370,7 @@ def chat_info(chat_id):
 @sync_after_change
 def set_role(chat_id, user_id, role):
     chat = Chat.query.get_or_404(chat_id)
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat_id).first()
+    membership = get_membership(current_user.id, chat_id)
     if not membership or membership.role != 'owner':
         flash('Нет прав')
         return redirect(url_for('chat_info', chat_id=chat_id))
@@ -1815,6 +3378,7 @@ def set_role(chat_id, user_id, role):
     if target:
         target.role = role
         db.session.commit()
+        invalidate_membership(user_id, chat_id)
         flash('Роль изменена')
     return redirect(url_for('chat_info', chat_id=chat_id))
 
@@ -1824,14 +3388,16 @@ def set_role(chat_id, user_id, role):
 @sync_after_change
 def remove_member(chat_id, user_id):
     chat = Chat.query.get_or_404(chat_id)
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat_id).first()
+    membership = get_membership(current_user.id, chat_id)
     if not membership or membership.role not in ['owner', 'admin']:
         flash('Нет прав')
         return redirect(url_for('chat_info', chat_id=chat_id))
     target = ChatMember.query.filter_by(user_id=user_id, chat_id=chat_id).first()
     if target and target.user_id != current_user.id:
         db.session.delete(target)
+        release_private_chat(chat)
         db.session.commit()
+        invalidate_membership(user_id, chat_id)
         flash('Участник удалён')
     return redirect(url_for('chat_info', chat_id=chat_id))
 
@@ -1843,7 +3409,9 @@ def leave_chat(chat_id):
     membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat_id).first()
     if membership:
         db.session.delete(membership)
+        release_private_chat(db.session.get(Chat, chat_id))
         db.session.commit()
+        invalidate_membership(current_user.id, chat_id)
         flash('Вы покинули чат')
     return redirect(url_for('chats'))
 
@@ -1856,13 +3424,13 @@ def join_chat(token):
     if not chat:
         flash('Неверная ссылка')
         return redirect(url_for('chats'))
-    existing = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat.id).first()
-    if existing:
+    if get_membership(current_user.id, chat.id):
         flash('Вы уже в чате')
     else:
         cm = ChatMember(user_id=current_user.id, chat_id=chat.id, role='member')
         db.session.add(cm)
         db.session.commit()
+        invalidate_membership(current_user.id, chat.id)
         flash('Вы присоединились к чату')
     return redirect(url_for('chat', chat_id=chat.id))
 
@@ -1872,7 +3440,7 @@ def join_chat(token):
 @sync_after_change
 def add_member(chat_id):
     chat = Chat.query.get_or_404(chat_id)
-    membership = ChatMember.query.filter_by(user_id=current_user.id, chat_id=chat_id).first()
+    membership = get_membership(current_user.id, chat_id)
     if not membership or membership.role not in ['owner', 'admin']:
         flash('У вас нет прав')
         return redirect(url_for('chat_info', chat_id=chat_id))
@@ -1881,37 +3449,125 @@ def add_member(chat_id):
         user = User.query.filter_by(username=username).first()
         if not user:
             flash('Пользователь не найден')
-        elif ChatMember.query.filter_by(user_id=user.id, chat_id=chat_id).first():
+        elif get_membership(user.id, chat_id):
             flash('Пользователь уже в чате')
         else:
             cm = ChatMember(user_id=user.id, chat_id=chat_id, role='member')
             db.session.add(cm)
             db.session.commit()
+            invalidate_membership(user.id, chat_id)
             flash('Пользователь добавлен')
             return redirect(url_for('chat_info', chat_id=chat_id))
     return render_template_string('''
         <!DOCTYPE html>
         <html>
         <head><title>Добавить участника</title><meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            * { margin:0; padding:0; box-sizing:border-box; font-family:'Segoe UI',sans-serif; }
-            body { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); min-height:100vh; display:flex; justify-content:center; align-items:center; padding:20px; }
-            .container { background:white; border-radius:30px; padding:40px; max-width:400px; width:100%; box-shadow:0 30px 60px rgba(0,0,0,0.3); }
-            h2 { color:#0b2b5c; margin-bottom:20px; text-align:center; }
-            .form-group { margin-bottom:15px; }
-            input { width:100%; padding:12px; border:2px solid #e2e8f0; border-radius:15px; }
-            .btn { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); color:white; border:none; padding:14px; border-radius:15px; cursor:pointer; width:100%; }
-            .btn-outline { background:white; color:#2c6b9e; border:2px solid #2c6b9e; margin-top:10px; }
-            .flash { background-color:#fed7d7; color:#c53030; padding:10px; border-radius:12px; margin-bottom:15px; }
-        </style>
+        <link rel="stylesheet" href="{{ asset_url('css/add_member.css') }}">
         </head>
         <body><div class="container">
             <h2>Добавить участника</h2>
             {% with messages = get_flashed_messages() %}{% if messages %}{% for message in messages %}<div class="flash">{{ message }}</div>{% endfor %}{% endif %}{% endwith %}
             <form method="POST"><div class="form-group"><input type="text" name="username" placeholder="Имя пользователя (@)" required></div><button type="submit" class="btn">Добавить</button><a href="/chat/{{ chat.id }}/info" class="btn btn-outline">Отмена</a></form>
+            <h2 style="margin-top:25px;">Добавить списком</h2>
+            <form method="POST" action="/chat/{{ chat.id }}/add_members" enctype="multipart/form-data"><div class="form-group"><textarea name="usernames" rows="5" placeholder="Имена пользователей через запятую или с новой строки" style="width:100%; padding:12px; border:2px solid #e2e8f0; border-radius:15px;"></textarea></div><div class="form-group"><input type="file" name="csv" accept=".csv,text/csv"></div><button type="submit" class="btn">Добавить всех</button></form>
         </div></body></html>
     ''', chat=chat)
 
+# ---------- Массовое добавление участников ----------
+BULK_CHUNK_SIZE = 500  # укладываемся в лимит параметров SQLite
+
+def chunked(items, size=BULK_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def parse_usernames(text):
+    """Имена из текста: через запятую, пробел или с новой строки, можно с @."""
+    return [name.lstrip('@') for name in text.replace(',', ' ').split() if name.lstrip('@')]
+
+def parse_usernames_csv(file):
+    """Имена из первой колонки CSV; строка заголовка пропускается."""
+    rows = csv.reader(io.StringIO(file.read().decode('utf-8-sig')))
+    names = [row[0].strip().lstrip('@') for row in rows if row and row[0].strip()]
+    if names and names[0].lower() in ('username', 'имя пользователя'):
+        names = names[1:]
+    return names
+
+def bulk_add_members(chat_id, usernames):
+    """Добавляет пользователей в чат одной транзакцией.
+    Возвращает отчёт: список {'username', 'status'} в порядке входных данных."""
+    unique = list(dict.fromkeys(usernames))
+    found = {}
+    for chunk in chunked(unique):
+        for user_id, username in db.session.query(User.id, User.username).filter(User.username.in_(chunk)):
+            found[username] = user_id
+    existing = set()
+    for chunk in chunked(list(found.values())):
+        existing.update(user_id for (user_id,) in db.session.query(ChatMember.user_id).filter(
+            ChatMember.chat_id == chat_id, ChatMember.user_id.in_(chunk)))
+
+    report, rows, seen = [], [], set()
+    now = datetime.utcnow()
+    for username in usernames:
+        if username in seen:
+            status = 'duplicate'
+        elif username not in found:
+            status = 'not_found'
+        elif found[username] in existing:
+            status = 'already_member'
+        else:
+            status = 'added'
+            rows.append({'user_id': found[username], 'chat_id': chat_id, 'role': 'member', 'joined_at': now})
+        seen.add(username)
+        report.append({'username': username, 'status': status})
+
+    for chunk in chunked(rows):
+        db.session.execute(db.insert(ChatMember), chunk)
+    db.session.commit()
+    for row in rows:
+        invalidate_membership(row['user_id'], chat_id)
+    return report
+
+@app.route('/chat/<int:chat_id>/add_members', methods=['POST'])
+@login_required
+@sync_after_change
+def add_members(chat_id):
+    """Массовое добавление: JSON {"usernames": [...]}, текстовое поле usernames или CSV-файл."""
+    chat = Chat.query.get_or_404(chat_id)
+    membership = get_membership(current_user.id, chat_id)
+    if not membership or membership.role not in ['owner', 'admin']:
+        if request.is_json:
+            return jsonify({'success': False, 'error': 'Forbidden'}), 403
+        flash('У вас нет прав')
+        return redirect(url_for('chat_info', chat_id=chat_id))
+    if request.is_json:
+        data = request.get_json(silent=True)
+        usernames = data.get('usernames') if isinstance(data, dict) else None
+        if not isinstance(usernames, list) or not all(isinstance(name, str) for name in usernames):
+            return jsonify({'success': False, 'error': 'usernames must be a list of strings'}), 400
+        usernames = [name.strip().lstrip('@') for name in usernames if name.strip().lstrip('@')]
+    else:
+        usernames = parse_usernames(request.form.get('usernames', ''))
+        file = request.files.get('csv')
+        if file and file.filename:
+            usernames += parse_usernames_csv(file)
+    report = bulk_add_members(chat_id, usernames)
+    added = sum(1 for row in report if row['status'] == 'added')
+    if request.is_json:
+        return jsonify({'success': True, 'added': added, 'report': report})
+    return render_template_string('''
+        <!DOCTYPE html>
+        <html>
+        <head><title>Добавление участников</title><meta name="viewport" content="width=device-width, initial-scale=1">
+        <link rel="stylesheet" href="{{ asset_url('css/add_members.css') }}">
+        </head>
+        <body><div class="container">
+            <a href="/chat/{{ chat.id }}/info" style="display:block; margin-bottom:20px;">← Вернуться</a>
+            <h2>Добавлено: {{ added }} из {{ report|length }}</h2>
+            {% for row in report %}<div class="row"><span>@{{ row.username }}</span><span class="{{ row.status }}">{{ labels[row.status] }}</span></div>{% endfor %}
+        </div></body></html>
+    ''', chat=chat, report=report, added=added, labels={
+        'added': 'добавлен', 'not_found': 'не найден', 'already_member': 'уже в чате', 'duplicate': 'повтор'})
+
 # ---------- Настройки профиля ----------
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
@@ -1937,24 +3593,19 @@ def settings():
         if 'avatar' in request.files:
             file = request.files['avatar']
             if file and file.filename:
-                filename = secure_filename(f"{current_user.id}_{file.filename}")
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                filename = avatar_filename(file.filename)
+                save_upload(file, filename)
                 current_user.avatar = filename
+                enqueue_image_processing(filename, ['avatar'])
         db.session.commit()
+        invalidate_user(current_user.id)
         flash('Настройки сохранены')
         return redirect(url_for('settings'))
     return render_template_string('''
         <!DOCTYPE html>
         <html>
         <head><title>Настройки</title><meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { background:#f5f7fa; padding:20px; }
-            .container { max-width:600px; margin:0 auto; background:white; border-radius:30px; padding:30px; }
-            .form-group { margin-bottom:15px; }
-            label { display:block; margin-bottom:5px; }
-            input { width:100%; padding:12px; border:2px solid #e2e8f0; border-radius:15px; }
-            .btn { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); color:white; border:none; padding:14px; border-radius:15px; cursor:pointer; width:100%; }
-        </style>
+        <link rel="stylesheet" href="{{ asset_url('css/settings.css') }}">
         </head>
         <body><div class="container">
             <h2>Настройки</h2>
@@ -1982,51 +3633,51 @@ def profile():
         <!DOCTYPE html>
         <html>
         <head><title>Профиль</title><meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); min-height:100vh; display:flex; align-items:center; justify-content:center; padding:20px; }
-            .container { background:white; border-radius:30px; padding:40px; max-width:500px; width:100%; text-align:center; }
-            .avatar { width:120px; height:120px; border-radius:50%; margin:0 auto 20px; border:4px solid #2c6b9e; object-fit:cover; }
-            h2 { color:#0b2b5c; }
-            .username { color:#2c6b9e; margin-bottom:20px; }
-            .info-item { display:flex; padding:10px; border-bottom:1px solid #eee; }
-            .info-label { font-weight:bold; width:120px; text-align:left; }
-            .btn { display:inline-block; background:linear-gradient(145deg,#0b2b5c,#2c6b9e); color:white; padding:12px 30px; border-radius:30px; text-decoration:none; margin-top:20px; }
-        </style>
+        <link rel="stylesheet" href="{{ asset_url('css/profile.css') }}">
         </head>
         <body><div class="container">
-            <img src="{{ url_for('uploads', filename=current_user.avatar) if current_user.avatar != 'default.jpg' else '/photos/default.jpg' }}" class="avatar">
+            <a href="{{ get_avatar_url(current_user, None) }}" target="_blank"><img src="{{ get_avatar_url(current_user) }}" class="avatar"></a>
             <h2>{{ current_user.first_name }} {{ current_user.last_name }}</h2>
             <div class="username">@{{ current_user.username }}</div>
             <div class="info-item"><span class="info-label">Email:</span> {{ current_user.email }}</div>
             <div class="info-item"><span class="info-label">День рождения:</span> {{ current_user.birth_day }}.{{ current_user.birth_month if current_user.birth_day else 'не указан' }}</div>
             <a href="/chats" class="btn">К чатам</a>
         </div></body></html>
-    ''')
+    ''', get_avatar_url=get_avatar_url)
 
 # ---------- Вход ----------
 @app.route('/login', methods=['GET', 'POST'])
 def login():
+    status = 200
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user = User.query.filter_by(username=username).first()
+        ip = request.remote_addr
+        user = None
+        if login_throttle.blocked(username, ip):
+            metrics.inc('mateugram_login_total', result='throttled')
+            flash('Слишком много неудачных попыток, попробуйте позже')
+            status = 429
+        else:
+            user = User.query.filter_by(username=username).first()
         if user and user.check_password(password):
+            login_throttle.succeeded(username)
+            metrics.inc('mateugram_login_total', result='success')
+            # Хэш со старыми параметрами пересчитываем, пока пароль известен
+            if password_hasher.needs_rehash(user.password_hash):
+                user.set_password(password)
+                db.session.commit()
             login_user(user)
             return redirect(url_for('chats'))
-        else:
+        elif status == 200:
+            login_throttle.failed(username, ip)
+            metrics.inc('mateugram_login_total', result='failure')
             flash('Неверные данные')
     return render_template_string('''
         <!DOCTYPE html>
         <html>
         <head><title>Вход</title><meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); min-height:100vh; display:flex; justify-content:center; align-items:center; }
-            .form-container { background:white; border-radius:30px; padding:40px; max-width:400px; width:100%; }
-            h2 { color:#0b2b5c; text-align:center; }
-            input { width:100%; padding:14px; border:2px solid #e2e8f0; border-radius:15px; margin-bottom:20px; }
-            .btn { background:linear-gradient(145deg,#0b2b5c,#2c6b9e); color:white; border:none; padding:14px; border-radius:15px; width:100%; cursor:pointer; }
-            .flash { background:#fed7d7; padding:10px; border-radius:10px; margin-bottom:15px; }
-        </style>
+        <link rel="stylesheet" href="{{ asset_url('css/login.css') }}">
         </head>
         <body><div class="form-container">
             <h2>Вход</h2>
@@ -2034,7 +3685,7 @@ def login():
             <form method="POST"><input type="text" name="username" placeholder="Имя пользователя" required><input type="password" name="password" placeholder="Пароль" required><button type="submit" class="btn">Войти</button></form>
             <div style="text-align:center; margin-top:20px;"><a href="/register">Регистрация</a></div>
         </div></body></html>
-    ''')
+    '''), status
 
 @app.route('/logout')
 @login_required
@@ -2042,22 +3693,791 @@ def logout():
     logout_user()
     return redirect(url_for('index'))
 
+# ---------- JSON API v1 ----------
+# Данные экранов без HTML — для тонкого клиента: список чатов, страницы истории и новые сообщения
+# (?after=), участники, поиск, реакции и комментарии. Сериализация идёт из MessageView и кэша профилей,
+# без ленивых загрузок; ?fields=id,content оставляет в элементах списка только нужные поля.
+# Каждый ответ GET несёт ETag по хэшу тела: повтор с If-None-Match получает 304 без тела.
+API_PREFIX = '/api/v1'
+API_CHAT_FIELDS = ('id', 'name', 'is_group', 'is_channel', 'last_message', 'unread')
+API_MESSAGE_FIELDS = ('id', 'chat_id', 'sender_id', 'sender_name', 'content', 'reply_to', 'reply_preview',
+                      'forwarded_from', 'file_path', 'file_name', 'file_type', 'created_at', 'edited', 'pinned',
+                      'comment_count', 'reactions')
+API_MEMBER_FIELDS = ('id', 'username', 'first_name', 'last_name', 'avatar_url', 'role')
+API_COMMENT_FIELDS = ('id', 'message_id', 'user_id', 'user_name', 'content', 'created_at')
+API_SEARCH_LIMIT = 50
+
+metrics.counter('mateugram_api_responses_total', 'API GET responses by conditional result')
+
+class ApiError(Exception):
+    def __init__(self, status, error):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+@app.errorhandler(ApiError)
+def api_error(e):
+    return jsonify({'success': False, 'error': e.error}), e.status
+
+def api_login_required(func):
+    """Как login_required, но без редиректа на страницу входа: 401 в JSON."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise ApiError(401, 'Unauthorized')
+        return func(*args, **kwargs)
+    return wrapper
+
+def api_membership(chat_id):
+    """Членство текущего пользователя в чате (иначе 403) с выбранным шардом чата."""
+    membership = get_membership(current_user.id, chat_id)
+    if not membership:
+        raise ApiError(403, 'Forbidden')
+    use_chat_shard(chat_id)
+    return membership
+
+def api_fields(rows, allowed):
+    """Оставляет в элементах только поля из ?fields=; неизвестное поле — 400."""
+    fields = request.args.get('fields')
+    if not fields:
+        return rows
+    fields = [f for f in fields.split(',') if f]
+    unknown = set(fields) - set(allowed)
+    if unknown:
+        raise ApiError(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+    return [{f: row[f] for f in fields} for row in rows]
+
+def api_response(payload):
+    """Компактный JSON с ETag; при совпадении If-None-Match — 304."""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode()
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest())
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.make_conditional(request)
+    metrics.inc('mateugram_api_responses_total', result='not_modified' if response.status_code == 304 else 'full')
+    return response
+
+def api_time(value):
+    return value.isoformat() + 'Z' if value else None
+
+def api_message(view, senders):
+    sender = senders.get(view.sender_id)
+    return {
+        'id': view.id,
+        'chat_id': view.chat_id,
+        'sender_id': view.sender_id,
+        'sender_name': sender.first_name if sender else '',
+        'content': view.content,
+        'reply_to': view.reply_to,
+        'reply_preview': view.reply_preview,
+        'forwarded_from': view.forwarded_from,
+        'file_path': view.file_path,
+        'file_name': view.file_name,
+        'file_type': view.file_type,
+        'created_at': api_time(view.created_at),
+        'edited': bool(view.edited),
+        'pinned': bool(view.pinned),
+        'comment_count': view.comment_count,
+        'reactions': [[r.user_id, r.reaction] for r in view.reactions]
+    }
+
+def api_messages(views):
+    senders = get_user_profiles(view.sender_id for view in views)
+    return api_fields([api_message(view, senders) for view in views], API_MESSAGE_FIELDS)
+
+@app.route(API_PREFIX + '/chats')
+@api_login_required
+def api_chats():
+    chat_ids = get_user_chat_ids(current_user.id)
+    chats = Chat.query.filter(Chat.id.in_(chat_ids)).all() if chat_ids else []
+    names = chat_names(chats)
+    last = last_messages(chat_ids)
+    unread = unread_counts(current_user.id)
+    rows = []
+    for chat in chats:
+        msg = last.get(chat.id)
+        rows.append({
+            'id': chat.id,
+            'name': names[chat.id],
+            'is_group': bool(chat.is_group),
+            'is_channel': bool(chat.is_channel),
+            'last_message': {'id': msg.id, 'sender_id': msg.sender_id, 'content': msg.content,
+                             'created_at': api_time(msg.created_at)} if msg else None,
+            'unread': unread.get(chat.id, 0)
+        })
+    return api_response({'chats': api_fields(rows, API_CHAT_FIELDS)})
+
+@app.route(API_PREFIX + '/chats/<int:chat_id>/messages')
+@api_login_required
+def api_chat_messages(chat_id):
+    """Страница истории (?before=<id>, первая — из горячего кэша) или новые сообщения после ?after=<id>.
+    Счётчик непрочитанных не трогает: GET может прийти от предзагрузки, прочитанным чат отмечает POST .../read."""
+    api_membership(chat_id)
+    after = request.args.get('after', type=int)
+    if after is not None:
+        limit = app.config['CHAT_PAGE_SIZE']
+        page = (Message.query.filter(Message.chat_id == chat_id, Message.id > after)
+                .order_by(Message.id).limit(limit + 1).all())
+        views = message_views(page[:limit])
+        return api_response({'messages': api_messages(views), 'has_more': len(page) > limit})
+    views, has_more, pinned = chat_page(chat_id, request.args.get('before', type=int))
+    return api_response({'messages': api_messages(views), 'has_more': has_more,
+                         'pinned': api_messages([pinned])[0] if pinned else None})
+
+@app.route(API_PREFIX + '/chats/<int:chat_id>/read', methods=['POST'])
+@api_login_required
+def api_mark_read(chat_id):
+    """Отмечает чат прочитанным: обнуляет счётчик непрочитанных на всех устройствах."""
+    api_membership(chat_id)
+    mark_read(current_user.id, chat_id)
+    return jsonify({'success': True})
+
+@app.route(API_PREFIX + '/chats/<int:chat_id>/members')
+@api_login_required
+def api_chat_members(chat_id):
+    api_membership(chat_id)
+    chat = db.session.get(Chat, chat_id)
+    members, member_roles, member_count = chat_members(chat)
+    rows = [{'id': user.id, 'username': user.username, 'first_name': user.first_name, 'last_name': user.last_name,
+             'avatar_url': get_avatar_url(user), 'role': member_roles[user.id]} for user in members]
+    return api_response({'members': api_fields(rows, API_MEMBER_FIELDS), 'member_count': member_count})
+
+@app.route(API_PREFIX + '/chats/<int:chat_id>/search')
+@api_login_required
+def api_search(chat_id):
+    """Поиск по тексту, от новых к старым страницами по API_SEARCH_LIMIT (?before=<id>)."""
+    api_membership(chat_id)
+    query = request.args.get('q', '')
+    if not query:
+        raise ApiError(400, 'Empty query')
+    page_query = Message.query.filter(Message.chat_id == chat_id, Message.content.contains(query))
+    before = request.args.get('before', type=int)
+    if before:
+        page_query = page_query.filter(Message.id < before)
+    page = page_query.order_by(Message.id.desc()).limit(API_SEARCH_LIMIT + 1).all()
+    views = message_views(page[:API_SEARCH_LIMIT])
+    return api_response({'messages': api_messages(views), 'has_more': len(page) > API_SEARCH_LIMIT})
+
+@app.route(API_PREFIX + '/messages/<int:message_id>/reactions', methods=['POST'])
+@api_login_required
+@sync_after_change
+def api_react(message_id):
+    """Ставит или снимает реакцию {"reaction": "👍"}; возвращает реакции сообщения."""
+    reaction = (request.get_json(silent=True) or {}).get('reaction')
+    if not reaction or not isinstance(reaction, str) or len(reaction) > 10:
+        raise ApiError(400, 'Bad reaction')
+    use_message_shard(message_id)
+    message = db.session.get(Message, message_id)
+    if not message:
+        raise ApiError(404, 'Not found')
+    api_membership(message.chat_id)
+    toggle_reaction(message_id, current_user.id, reaction)
+    rows = (db.session.query(Reaction.user_id, Reaction.reaction)
+            .filter(Reaction.message_id == message_id).order_by(Reaction.id))
+    return jsonify({'success': True, 'reactions': [[user_id, r] for user_id, r in rows]})
+
+@app.route(API_PREFIX + '/messages/<int:message_id>/comments', methods=['GET', 'POST'])
+@api_login_required
+def api_comments(message_id):
+    """GET: страница комментариев (?after=<id>&limit=<до 200>). POST {"content": ...}: новый комментарий.
+    У архивных сообщений комментарии только читаются."""
+    use_message_shard(message_id)
+    message = db.session.get(Message, message_id) or find_archived_message(message_id)
+    if not message:
+        raise ApiError(404, 'Not found')
+    room_chat_id, rooms = comments_access(message)
+    if not room_chat_id:
+        raise ApiError(403, 'Forbidden')
+    if request.method == 'POST':
+        if message.archived:
+            raise ApiError(409, 'Message is archived')
+        content = ((request.get_json(silent=True) or {}).get('content') or '').strip()
+        if not content:
+            raise ApiError(400, 'Empty comment')
+        return jsonify({'success': True, 'comment': add_comment(message, content, rooms)}), 201
+    comments, has_more = comments_page(message, request.args.get('after', type=int), comments_limit())
+    return api_response({'comments': api_fields(comments, API_COMMENT_FIELDS), 'has_more': has_more,
+                         'comment_count': message.comment_count})
+
+# ---------- Присутствие и набор текста ----------
+class PresenceTracker:
+    """Кто в сети и кто печатает — в памяти процесса.
+    Изменения копятся по чатам и рассылаются одной пачкой раз в PRESENCE_INTERVAL,
+    поэтому число рассылок не зависит от числа сокетов и нажатий клавиш."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sockets = {}        # sid -> user_id
+        self.online = Counter()  # user_id -> число открытых сокетов
+        self.user_chats = {}     # user_id -> чаты пользователя, пока он в сети
+        self.last_seen = {}      # user_id -> время выхода, ещё не записанное в базу
+        self.typing = {}         # chat_id -> {user_id: когда истекает}
+        self.dirty = {}          # chat_id -> (кто вошёл, кто вышел)
+
+    def _mark(self, chat_ids, user_id=None, online=None):
+        for chat_id in chat_ids:
+            came, left = self.dirty.setdefault(chat_id, (set(), set()))
+            if online is True:
+                left.discard(user_id)
+                came.add(user_id)
+            elif online is False:
+                came.discard(user_id)
+                left.add(user_id)
+
+    def connect(self, sid, user_id, chat_ids):
+        with self.lock:
+            self.sockets[sid] = user_id
+            self.online[user_id] += 1
+            if self.online[user_id] == 1:
+                self.user_chats[user_id] = chat_ids
+                self.last_seen[user_id] = datetime.utcnow()
+                self._mark(chat_ids, user_id, True)
+
+    def disconnect(self, sid):
+        with self.lock:
+            user_id = self.sockets.pop(sid, None)
+            if user_id is None:
+                return
+            self.online[user_id] -= 1
+            if self.online[user_id] > 0:
+                return
+            del self.online[user_id]
+            chat_ids = self.user_chats.pop(user_id, ())
+            self.last_seen[user_id] = datetime.utcnow()
+            self._mark(chat_ids, user_id, False)
+            for chat_id in chat_ids:
+                users = self.typing.get(chat_id)
+                if users and users.pop(user_id, None) is not None and not users:
+                    del self.typing[chat_id]
+
+    def set_typing(self, chat_id, user_id, active):
+        """Повторное «печатает» только продлевает срок; рассылка — лишь при смене состояния."""
+        with self.lock:
+            users = self.typing.setdefault(chat_id, {})
+            was_typing = user_id in users
+            if active:
+                users[user_id] = time.monotonic() + app.config['TYPING_TTL']
+            else:
+                users.pop(user_id, None)
+            if was_typing != active:
+                self._mark([chat_id])
+            if not users:
+                del self.typing[chat_id]
+
+    def user_of(self, sid):
+        return self.sockets.get(sid)
+
+    def is_online(self, user_id):
+        return user_id in self.online
+
+    def get_last_seen(self, user_id):
+        return self.last_seen.get(user_id)
+
+    def collect(self):
+        """Снимает накопленные изменения: [(chat_id, вошли, вышли, печатают)]."""
+        now = time.monotonic()
+        with self.lock:
+            for chat_id, users in list(self.typing.items()):
+                expired = [user_id for user_id, until in users.items() if until <= now]
+                for user_id in expired:
+                    del users[user_id]
+                if expired:
+                    self._mark([chat_id])
+                if not users:
+                    del self.typing[chat_id]
+            dirty, self.dirty = self.dirty, {}
+            return [(chat_id, sorted(came), sorted(left), sorted(self.typing.get(chat_id, ())))
+                    for chat_id, (came, left) in dirty.items()]
+
+    def take_last_seen(self, include_online=False):
+        """last_seen для записи в базу: вошедшие и вышедшие с момента прошлой записи.
+        Тех, кто просто остаётся в сети, не переписываем — иначе каждый сброс менял бы
+        строки всех пользователей онлайн и запускал выгрузку на FTP. include_online — при остановке."""
+        now = datetime.utcnow()
+        with self.lock:
+            pending, self.last_seen = self.last_seen, {}
+            if include_online:
+                for user_id in self.online:
+                    pending[user_id] = now
+        return pending
+
+presence = PresenceTracker()
+metrics.counter('mateugram_presence_broadcasts_total', 'Coalesced presence/typing broadcasts')
+metrics.gauge('mateugram_presence_online_users', 'Users with at least one open socket',
+              lambda: [({}, len(presence.online))])
+
+def flush_last_seen(include_online=False):
+    """Пишет накопленные last_seen одним пакетным UPDATE."""
+    pending = presence.take_last_seen(include_online)
+    if not pending:
+        return
+    with app.app_context():
+        db.session.execute(db.update(User), [{'id': user_id, 'last_seen': ts} for user_id, ts in pending.items()])
+        db.session.commit()
+
+def presence_loop():
+    """Фоновая задача: раз в PRESENCE_INTERVAL рассылает изменения присутствия по комнатам,
+    раз в LAST_SEEN_FLUSH_INTERVAL сбрасывает last_seen в базу, раз в UNREAD_FLUSH_INTERVAL — непрочитанные."""
+    last_flush = last_unread_flush = time.monotonic()
+    while True:
+        socketio.sleep(app.config['PRESENCE_INTERVAL'])
+        try:
+            changes = presence.collect()
+            if changes:
+                changes = [c for c in changes if room_has_sockets(f"chat_{c[0]}")]
+            if changes:
+                with app.app_context():
+                    names = get_user_profiles(user_id for c in changes for user_id in c[3])
+                for chat_id, came, left, typing in changes:
+                    socketio.emit('presence', {
+                        'chat_id': chat_id,
+                        'online': came,
+                        'offline': left,
+                        'typing': [{'id': user_id, 'name': names[user_id].first_name}
+                                   for user_id in typing if user_id in names]
+                    }, room=f"chat_{chat_id}")
+                metrics.inc('mateugram_presence_broadcasts_total', len(changes))
+            if time.monotonic() - last_flush >= app.config['LAST_SEEN_FLUSH_INTERVAL']:
+                last_flush = time.monotonic()
+                flush_last_seen()
+            if time.monotonic() - last_unread_flush >= app.config['UNREAD_FLUSH_INTERVAL']:
+                last_unread_flush = time.monotonic()
+                flush_unread()
+        except Exception as e:
+            print(f"Presence loop error: {e}")
+
+def presence_text(user):
+    """«в сети» или «был(а) в сети …» для шапки личного чата."""
+    if presence.is_online(user.id):
+        return 'в сети'
+    last_seen = presence.get_last_seen(user.id) or user.last_seen
+    if not last_seen:
+        return ''
+    return 'был(а) в сети ' + last_seen.strftime('%d.%m.%Y %H:%M')
+
+# ---------- Непрочитанные сообщения ----------
+# Каждый сокет пользователя стоит в комнате user_<id>. Новое сообщение добавляет единицу непрочитанных
+# всем участникам чата, кроме отправителя и тех, у кого чат открыт, и уходит им одним событием
+# unread {"chat_id", "delta": 1} по личным комнатам; открытие чата шлёт {"chat_id", "count": 0}.
+# Список участников берётся из кэша, счётчики копятся в памяти и пишутся в ChatMember.unread_count
+# пачкой раз в UNREAD_FLUSH_INTERVAL. С SOCKETIO_MESSAGE_QUEUE воркеров несколько, а память у каждого своя,
+# поэтому тогда изменения пишутся в базу сразу, и все воркеры читают одно и то же.
+class UnreadCounters:
+    """Незаписанные изменения непрочитанных поверх ChatMember.unread_count.
+    Снятое для записи остаётся видно в apply(), пока запись не закоммичена (done) или не вернулось
+    после ошибки (restore); flushing держит запись и чтение базы с apply() порознь."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.deltas = Counter()  # (user_id, chat_id) -> сколько прибавить
+        self.resets = set()      # (user_id, chat_id), обнулённые после прошлой записи
+        self.in_flight = (Counter(), set())  # снятое take() и ещё не записанное
+
+    def add(self, chat_id, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.deltas[(user_id, chat_id)] += 1
+
+    def reset(self, user_id, chat_id):
+        key = (user_id, chat_id)
+        with self.lock:
+            self.deltas.pop(key, None)
+            self.resets.add(key)
+
+    def apply(self, user_id, stored):
+        """Текущие значения по значениям из базы {chat_id: unread_count}."""
+        with self.lock:
+            flight_deltas, flight_resets = self.in_flight
+            counts = {}
+            for chat_id, count in stored.items():
+                key = (user_id, chat_id)
+                if key in self.resets:
+                    count = 0
+                elif key in flight_resets:
+                    count = flight_deltas.get(key, 0)
+                else:
+                    count += flight_deltas.get(key, 0)
+                counts[chat_id] = count + self.deltas.get(key, 0)
+            return counts
+
+    def take(self):
+        with self.lock:
+            self.in_flight = (self.deltas, self.resets)
+            self.deltas, self.resets = Counter(), set()
+            return self.in_flight
+
+    def done(self):
+        with self.lock:
+            self.in_flight = (Counter(), set())
+
+    def restore(self):
+        """Запись не удалась: снятое возвращается под более поздние изменения."""
+        with self.lock:
+            deltas, resets = self.in_flight
+            self.in_flight = (Counter(), set())
+            for key, n in deltas.items():
+                # Обнуление после take() отменяет и то, что не записалось
+                if key not in self.resets:
+                    self.deltas[key] += n
+            self.resets |= resets
+
+unread = UnreadCounters()
+metrics.counter('mateugram_unread_notifications_total', 'Unread increments pushed to user rooms')
+
+def unread_counts(user_id):
+    """{chat_id: непрочитанных} по всем чатам пользователя — одним запросом."""
+    with unread.flushing:
+        stored = dict(db.session.query(ChatMember.chat_id, ChatMember.unread_count).filter_by(user_id=user_id))
+        return unread.apply(user_id, stored)
+
+def unread_changed():
+    """С очередью сообщений счётчики пишутся сразу: в памяти этого воркера их не увидят остальные."""
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        flush_unread()
+
+def mark_read(user_id, chat_id):
+    """Обнуляет непрочитанные. Открытие уже прочитанного чата ничего не ставит в очередь записи:
+    иначе каждое открытие и переподключение пачкали бы базу для выгрузки на FTP."""
+    with unread.flushing:
+        stored = db.session.query(ChatMember.unread_count).filter_by(user_id=user_id, chat_id=chat_id).scalar()
+        if not unread.apply(user_id, {chat_id: stored or 0})[chat_id]:
+            return
+    unread.reset(user_id, chat_id)
+    unread_changed()
+    socketio.emit('unread', {'chat_id': chat_id, 'count': 0}, room=f"user_{user_id}")
+
+def chat_viewers(chat_id):
+    """Пользователи, у которых чат сейчас открыт (их сокеты в комнатах чата этого процесса)."""
+    try:
+        rooms = socketio.server.manager.rooms.get('/', {})
+    except AttributeError:
+        return set()
+    viewers = set()
+    for encoding in MESSAGE_ENCODINGS:
+        for sid in rooms.get(f"{encoding}_{chat_id}", ()):
+            user_id = presence.user_of(sid)
+            if user_id is not None:
+                viewers.add(user_id)
+    return viewers
+
+def notify_unread(msg):
+    recipients = set(get_chat_member_ids(msg.chat_id))
+    recipients.discard(msg.sender_id)
+    recipients -= chat_viewers(msg.chat_id)
+    if not recipients:
+        return
+    unread.add(msg.chat_id, recipients)
+    unread_changed()
+    socketio.emit('unread', {'chat_id': msg.chat_id, 'delta': 1}, room=[f"user_{user_id}" for user_id in recipients])
+    metrics.inc('mateugram_unread_notifications_total', len(recipients))
+
+def flush_unread():
+    """Пишет накопленные обнуления и приращения пакетными UPDATE. При ошибке они возвращаются в память
+    и уйдут следующей записью."""
+    with unread.flushing:
+        deltas, resets = unread.take()
+        if not deltas and not resets:
+            return
+        table = ChatMember.__table__
+        match = (table.c.user_id == db.bindparam('uid')) & (table.c.chat_id == db.bindparam('cid'))
+        # Обновление по таблице, а не по модели, мимо track_bulk_statement: изменённые строки считаем по rowcount
+        changed = 0
+        try:
+            with app.app_context():
+                if resets:
+                    changed += db.session.execute(
+                        db.update(table).where(match & (table.c.unread_count != 0)).values(unread_count=0),
+                        [{'uid': user_id, 'cid': chat_id} for user_id, chat_id in resets]).rowcount
+                if deltas:
+                    changed += db.session.execute(
+                        db.update(table).where(match).values(unread_count=table.c.unread_count + db.bindparam('n')),
+                        [{'uid': user_id, 'cid': chat_id, 'n': n} for (user_id, chat_id), n in deltas.items()]).rowcount
+                db.session.commit()
+        except Exception:
+            unread.restore()
+            raise
+        unread.done()
+    if changed > 0:
+        change_tracker.record_rows({'chat_member': changed}, {database_of('chat_member')})
+
+# ---------- Новые сообщения и догрузка пропущенных ----------
+def message_payload(msg, sender_name):
+    """Событие new_message — одно и то же для живой рассылки, буфера и догрузки."""
+    return {
+        'id': msg.id,
+        'chat_id': msg.chat_id,
+        'sender_id': msg.sender_id,
+        'sender_name': sender_name,
+        'content': msg.content,
+        'reply_to': msg.reply_to,
+        'forwarded_from': msg.forwarded_from,
+        'file_path': msg.file_path,
+        'file_name': msg.file_name,
+        'file_type': msg.file_type,
+        'created_at': msg.created_at.isoformat() + 'Z' if msg.created_at else None
+    }
+
+class RoomBuffer:
+    """Последние new_message каждой комнаты в памяти процесса.
+    Буфер комнаты непрерывен: если клиент видел его первое сообщение, весь пропуск — в буфере.
+    Число комнат ограничено, давно молчавшие вытесняются. Правка или удаление сообщения
+    сбрасывают буфер комнаты, и догрузка идёт из базы."""
+    def __init__(self, size, max_rooms, enabled=True):
+        self.lock = threading.Lock()
+        self.enabled = enabled
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()  # chat_id -> deque событий по возрастанию id
+
+    def add(self, chat_id, payload):
+        if not self.enabled:
+            return
+        with self.lock:
+            events = self.rooms.get(chat_id)
+            if events is None:
+                events = self.rooms[chat_id] = deque(maxlen=self.size)
+                if len(self.rooms) > self.max_rooms:
+                    self.rooms.popitem(last=False)
+            else:
+                self.rooms.move_to_end(chat_id)
+            events.append(payload)
+
+    def since(self, chat_id, last_id):
+        """События после last_id или None, если буфер не покрывает пропуск."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            events = self.rooms.get(chat_id)
+            if not events or events[0]['id'] > last_id:
+                return None
+            return [e for e in events if e['id'] > last_id]
+
+    def discard(self, chat_id):
+        with self.lock:
+            self.rooms.pop(chat_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+
+room_buffer = RoomBuffer(app.config['ROOM_BUFFER_SIZE'], app.config['ROOM_BUFFER_ROOMS'])
+metrics.counter('mateugram_catch_up_total', 'Reconnect catch-ups by source')
+
+# Кроме комнаты chat_<id> (набор текста, комментарии, присутствие) каждый сокет чата стоит в комнате своей
+# кодировки: json_<id> получает new_message (или new_messages пачкой) словарями, msgpack_<id> — кадр
+# new_message_packed: массив сообщений, каждое — массив полей в порядке PACKED_MESSAGE_FIELDS.
+# python-socketio кодирует JSON заново для каждого получателя, а кадр MessagePack собирается один раз
+# на комнату и уходит всем как готовое двоичное вложение.
+PACKED_MESSAGE_FIELDS = ('id', 'chat_id', 'sender_id', 'sender_name', 'content', 'reply_to', 'forwarded_from',
+                         'file_path', 'file_name', 'file_type', 'created_at')
+MESSAGE_ENCODINGS = ('json', 'msgpack')
+
+def room_has_sockets(room):
+    """Есть ли у комнаты получатели. С очередью сообщений подписчики могут быть у других воркеров,
+    а менеджер видит только свои сокеты, поэтому тогда считаем, что есть."""
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        return True
+    try:
+        return bool(socketio.server.manager.rooms.get('/', {}).get(room))
+    except AttributeError:
+        return False
+
+class MessageFanout:
+    """Рассылка new_message по комнатам кодировок. В тихом чате сообщение уходит сразу; если чату
+    уже отправляли в последние window секунд, следующие копятся и уходят одним кадром по истечении окна.
+    Накопленные пачки отправляет одна фоновая задача на процесс, а не по задаче на чат."""
+    def __init__(self, window, max_batch, packing):
+        self.lock = threading.Lock()
+        self.window = window
+        self.max_batch = max_batch
+        self.packing = packing
+        self.sent_at = {}   # chat_id -> время последней отправки
+        self.pending = {}   # chat_id -> (когда отправить, события); порядок вставки — порядок сроков
+        self.wakeup = threading.Event()
+        self.flusher = None
+
+    def add(self, chat_id, payload):
+        now = time.monotonic()
+        with self.lock:
+            item = self.pending.get(chat_id)
+            if item is not None:
+                batch = item[1]
+                batch.append(payload)
+                if len(batch) < self.max_batch:
+                    return
+                del self.pending[chat_id]
+            elif self.window and now - self.sent_at.get(chat_id, 0) < self.window:
+                self.pending[chat_id] = (now + self.window, [payload])
+                if self.flusher is None:
+                    self.flusher = start_background_task(self._flush_loop)
+                self.wakeup.set()
+                return
+            else:
+                batch = [payload]
+            self.sent_at[chat_id] = now
+            if len(self.sent_at) > 10000:
+                self.sent_at = {cid: t for cid, t in self.sent_at.items() if now - t < self.window}
+        self.send(chat_id, batch)
+
+    def _flush_loop(self):
+        """Фоновая задача: отправляет пачки с истёкшим окном, спит до следующего срока, без пачек ждёт wakeup."""
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                now = time.monotonic()
+                ready = []
+                for chat_id, (due, batch) in list(self.pending.items()):
+                    if due > now:
+                        break
+                    del self.pending[chat_id]
+                    self.sent_at[chat_id] = now
+                    ready.append((chat_id, batch))
+                if self.pending:
+                    delay = next(iter(self.pending.values()))[0] - now
+                else:
+                    delay = None
+                    self.wakeup.clear()
+            for chat_id, batch in ready:
+                try:
+                    self.send(chat_id, batch)
+                except Exception as e:
+                    print(f"Message fanout error: {e}")
+            if delay is not None:
+                socketio.sleep(delay)
+
+    def send(self, chat_id, batch):
+        if room_has_sockets(f"json_{chat_id}"):
+            if len(batch) == 1:
+                socketio.emit('new_message', batch[0], room=f"json_{chat_id}")
+            else:
+                socketio.emit('new_messages', batch, room=f"json_{chat_id}")
+            metrics.inc('mateugram_message_frames_total', encoding='json')
+        if self.packing and room_has_sockets(f"msgpack_{chat_id}"):
+            frame = msgpack.packb([[payload[field] for field in PACKED_MESSAGE_FIELDS] for payload in batch])
+            socketio.emit('new_message_packed', frame, room=f"msgpack_{chat_id}")
+            metrics.inc('mateugram_message_frames_total', encoding='msgpack')
+        if len(batch) > 1:
+            metrics.inc('mateugram_message_batched_total', len(batch))
+
+message_fanout = MessageFanout(app.config['MESSAGE_BATCH_WINDOW'], app.config['MESSAGE_BATCH_MAX'],
+                               app.config['SOCKET_MSGPACK'] and msgpack is not None)
+metrics.counter('mateugram_message_frames_total', 'new_message frames sent to chat rooms by encoding')
+metrics.counter('mateugram_message_batched_total', 'Messages delivered in multi-message frames')
+
+def broadcast_message(msg, sender_name):
+    """Рассылает новое сообщение в комнаты чата, запоминает его для догрузки и уведомляет участников."""
+    payload = message_payload(msg, sender_name)
+    room_buffer.add(msg.chat_id, payload)
+    recent_messages.add(msg)
+    message_fanout.add(msg.chat_id, payload)
+    notify_unread(msg)
+
+def missed_messages(chat_id, last_id):
+    """Сообщения чата после last_id: из буфера, иначе keyset-запросом.
+    Возвращает (сообщения, полный ли список); при слишком большом пропуске клиент перезагружает страницу."""
+    limit = app.config['CATCH_UP_LIMIT']
+    events = room_buffer.since(chat_id, last_id)
+    if events is not None:
+        metrics.inc('mateugram_catch_up_total', source='buffer')
+        return events[:limit], len(events) <= limit
+    page = (Message.query.filter(Message.chat_id == chat_id, Message.id > last_id)
+            .order_by(Message.id).limit(limit + 1).all())
+    if len(page) > limit:
+        metrics.inc('mateugram_catch_up_total', source='reload')
+        return [], False
+    metrics.inc('mateugram_catch_up_total', source='db')
+    senders = get_user_profiles(m.sender_id for m in page)
+    return [message_payload(m, senders[m.sender_id].first_name if m.sender_id in senders else '')
+            for m in page], True
+
 # ---------- WebSocket события ----------
+@socketio.on('connect')
+def on_connect():
+    if current_user.is_authenticated:
+        join_room(f"user_{current_user.id}")
+        presence.connect(request.sid, current_user.id, get_user_chat_ids(current_user.id))
+
+@socketio.on('disconnect')
+def on_disconnect():
+    presence.disconnect(request.sid)
+
 @socketio.on('join')
+@timed_event('join')
 def on_join(data):
-    chat_id = data['chat_id']
+    try:
+        chat_id = int(data['chat_id'])
+    except (KeyError, TypeError, ValueError):
+        return
+    if not current_user.is_authenticated or chat_id not in get_user_chat_ids(current_user.id):
+        return
     join_room(f"chat_{chat_id}")
+    # Кодировку new_message клиент выбирает в join; MessagePack подтверждается событием encoding с порядком полей
+    encoding = 'msgpack' if data.get('encoding') == 'msgpack' and message_fanout.packing else 'json'
+    for other in MESSAGE_ENCODINGS:
+        if other != encoding:
+            leave_room(f"{other}_{chat_id}")
+    # Порядок полей уходит раньше входа в комнату: кадр new_message_packed, пришедший до encoding,
+    # клиенту нечем разобрать, а при пустом чате догрузка его не повторит
+    if encoding == 'msgpack':
+        emit('encoding', {'chat_id': chat_id, 'name': 'msgpack', 'fields': PACKED_MESSAGE_FIELDS})
+    join_room(f"{encoding}_{chat_id}")
+    mark_read(current_user.id, chat_id)
+    # Клиент передаёт id последнего полученного сообщения — досылаем пропущенное за время обрыва
+    try:
+        last_id = int(data.get('last_id') or 0)
+    except (TypeError, ValueError):
+        last_id = 0
+    if last_id:
+        use_chat_shard(chat_id)
+        messages, complete = missed_messages(chat_id, last_id)
+        if messages or not complete:
+            emit('catch_up', {'chat_id': chat_id, 'messages': messages, 'complete': complete})
+
+@socketio.on('leave')
+def on_leave(data):
+    try:
+        chat_id = int(data['chat_id'])
+    except (KeyError, TypeError, ValueError):
+        return
+    leave_room(f"chat_{chat_id}")
+    for encoding in MESSAGE_ENCODINGS:
+        leave_room(f"{encoding}_{chat_id}")
+    if current_user.is_authenticated:
+        presence.set_typing(chat_id, current_user.id, False)
+
+@socketio.on('typing')
+def on_typing(data):
+    """Клиент шлёт typing не чаще раза в несколько секунд; рассылает их presence_loop.
+    Пользователя берём из карты сокетов, а не из current_user — без загрузки сессии и профиля."""
+    try:
+        chat_id = int(data['chat_id'])
+    except (KeyError, TypeError, ValueError):
+        return
+    user_id = presence.user_of(request.sid)
+    if user_id is None or chat_id not in get_user_chat_ids(user_id):
+        return
+    presence.set_typing(chat_id, user_id, bool(data.get('typing', True)))
 
 @socketio.on('send_message')
+@timed_event('send_message')
 def handle_message(data):
-    chat_id = data['chat_id']
+    if not current_user.is_authenticated:
+        return
+    # Один тип id для кэшей и комнат: "5" и 5 — один и тот же чат
+    try:
+        chat_id = int(data['chat_id'])
+    except (KeyError, TypeError, ValueError):
+        return
     content = data.get('content', '')
-    sender_id = data['sender_id']
+    sender_id = current_user.id
+    chat = db.session.get(Chat, chat_id)
+    if not chat or not can_post(chat, get_membership(sender_id, chat_id)):
+        return
+    use_chat_shard(chat.id)
     reply_to = data.get('reply_to')
     file_path = data.get('file_path')
     file_name = data.get('file_name')
     file_type = data.get('file_type')
-    sender = db.session.get(User, sender_id)
+    sender = get_user_profile(sender_id)
     msg = Message(
         sender_id=sender_id,
         chat_id=chat_id,
@@ -2069,27 +4489,128 @@ def handle_message(data):
     )
     db.session.add(msg)
     db.session.commit()
+    presence.set_typing(chat_id, sender_id, False)
     # Синхронизация с FTP после сохранения сообщения
-    threading.Thread(target=sync_to_ftp, daemon=True).start()
-    emit('new_message', {
-        'content': content,
-        'sender_id': sender_id,
-        'sender_name': sender.first_name,
-        'chat_id': chat_id,
-        'reply_to': reply_to,
-        'file_path': file_path,
-        'file_name': file_name
-    }, room=f"chat_{chat_id}")
+    request_sync()
+    broadcast_message(msg, sender.first_name)
 
 # ---------- Загрузчик пользователя ----------
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    profile = user_profile_cache.get(user_id)
+    if profile is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            cache_user(user)
+        return user
+    # Собираем объект из кэша и присоединяем к сессии без запроса к БД
+    user = User(**profile)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
 
-# ---------- Создание таблиц ----------
-with app.app_context():
-    db.create_all()
+# ---------- Фабрика приложения ----------
+startup_timings = {}
+metrics.gauge('mateugram_startup_seconds', 'Time from import to ready by phase',
+              lambda: [({'phase': phase}, round(seconds, 4)) for phase, seconds in startup_timings.items()])
 
+def create_app(config=None, restore=None, background=True):
+    """Готовит приложение к работе: восстановление с FTP, папки, расширения и схема БД.
+    Сам импорт модуля ничего этого не делает, поэтому тест собирает приложение так:
+    create_app({'DATABASE_PATH': tmp_path}, restore=False). background=False — без фоновых
+    потоков присутствия и почты (команды командной строки рядом с работающим сервером).
+    Приложение одно на процесс: маршруты, расширения и кэши привязаны к модульному app.
+    Повторный вызов с той же конфигурацией возвращает его же, с другой — ошибка."""
+    config = dict(config or {})
+    if 'DATABASE_PATH' in config and 'SQLALCHEMY_DATABASE_URI' not in config:
+        config['DATABASE_PATH'] = os.path.abspath(config['DATABASE_PATH'])
+        config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{config['DATABASE_PATH']}"
+    if 'sqlalchemy' in app.extensions:
+        changed = sorted(key for key, value in config.items() if app.config.get(key) != value)
+        if changed:
+            raise RuntimeError(f"create_app() already called; the app is a per-process singleton "
+                               f"and cannot be rebuilt with different {', '.join(changed)}")
+        return app
+    app.config.update(config)
+    if restore is None:
+        restore = app.config['FTP_RESTORE_ON_START']
+    startup_timings['import'] = IMPORT_FINISHED - IMPORT_STARTED
+
+    # Загрузка данных при старте
+    start = time.perf_counter()
+    if restore:
+        sync_from_ftp()
+    startup_timings['restore'] = time.perf_counter() - start
+
+    # Создание папок
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs('photos', exist_ok=True)
+    os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+
+    if MESSAGE_SHARDS > 1:
+        app.config['SQLALCHEMY_BINDS'] = {f'shard{shard}': f"sqlite:///{shard_path(shard)}"
+                                          for shard in range(MESSAGE_SHARDS)}
+    if app.config['PROXY_FIX_HOPS']:
+        hops = app.config['PROXY_FIX_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    db.init_app(app)
+    mail.init_app(app)
+    # При нескольких воркерах gunicorn комнаты Socket.IO нужно делить через очередь (например, redis://)
+    socketio.init_app(app, cors_allowed_origins="*", async_mode=socketio_async_mode(),
+                      message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
+    # Сообщения других воркеров в буфер этого процесса не попадают: пропуск из него был бы неполным
+    room_buffer.enabled = not app.config['SOCKETIO_MESSAGE_QUEUE']
+    login_manager.init_app(app)
+
+    # Создание таблиц
+    start = time.perf_counter()
+    with app.app_context():
+        create_tables()
+        migrate_schema()
+    startup_timings['schema'] = time.perf_counter() - start
+    start = time.perf_counter()
+    build_assets()
+    startup_timings['assets'] = time.perf_counter() - start
+    if background:
+        start_background_task(presence_loop)
+        if app.config['MAIL_QUEUE_WORKER']:
+            start_background_task(mail_loop)
+    startup_timings['ready'] = time.perf_counter() - IMPORT_STARTED
+    print(f"App ready in {startup_timings['ready']:.2f}s (import {startup_timings['import']:.2f}s, "
+          f"FTP restore {startup_timings['restore']:.2f}s, schema {startup_timings['schema']:.2f}s)")
+    return app
+
+IMPORT_FINISHED = time.perf_counter()
+
+# Для разработки. В продакшене: gunicorn -c gunicorn.conf.py (см. gunicorn.conf.py)
+# python app.py restore — только восстановить базу и файлы с FTP
+# python app.py archive [дней] — перенести старые сообщения в архив (например, по cron раз в сутки)
+# MESSAGE_SHARDS=N python app.py shard — разложить сообщения существующей базы по N шардам
+# python app.py fetch-socketio — положить клиент Socket.IO в static/vendor, чтобы не зависеть от CDN
 if __name__ == '__main__':
+    if sys.argv[1:] == ['restore']:
+        sync_from_ftp()
+        sys.exit(0)
+    if sys.argv[1:] == ['fetch-socketio']:
+        sys.exit(0 if fetch_socketio_client() else 1)
+    # Команды запускаются рядом с работающим сервером: его база свежее копии на FTP,
+    # поэтому без восстановления и без фоновых потоков
+    if sys.argv[1:2] == ['archive']:
+        create_app(restore=False, background=False)
+        with app.app_context():
+            print(f"Archived {archive_old_messages(int(sys.argv[2]) if sys.argv[2:] else None)} messages")
+        final_sync()
+        sys.exit(0)
+    if sys.argv[1:] == ['shard']:
+        create_app(restore=False, background=False)
+        with app.app_context():
+            print(f"Moved {split_into_shards()} rows into {MESSAGE_SHARDS} shards")
+        final_sync()
+        sys.exit(0)
+    create_app()
     port = int(os.environ.get('PORT', 5000))
-    socketio.run(app, host='0.0.0.0', port=port, debug=True, allow_unsafe_werkzeug=True)
+    debug = os.getenv('FLASK_DEBUG', '1') == '1'
+    try:
+        socketio.run(app, host='0.0.0.0', port=port, debug=debug, use_reloader=debug, allow_unsafe_werkzeug=True)
+    finally:
+        final_sync()
@@ -0,0 +1,1049 @@
+import io
+import os
+import socket
+import asyncio
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import re
+import zlib
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+# Локальный FTP-сервер для сценария синхронизации (pip install pyftpdlib)
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    FTPServer = None
+
+# Локальный SMTP-сервер для сценария signup (pip install aiosmtpd)
+try:
+    from aiosmtpd.controller import Controller as SMTPController
+except ImportError:
+    SMTPController = None
+
+# Клиент Socket.IO для сценария sockets против запущенного сервера (ставится вместе с Flask-SocketIO)
+try:
+    import socketio as socketio_client
+except ImportError:
+    socketio_client = None
+
+# Нагрузочный прогон Mateugram: засеивает синтетическую базу, гоняет HTTP-страницы
+# и событие send_message множеством параллельных клиентов и пишет перцентили в JSON.
+# Пример: python bench.py --users 500 --messages 50000 --clients 32 --out before.json
+#         python bench.py --compare before.json --out after.json
+# Ёмкость по сокетам против настоящего сервера:
+#         python bench.py --seed-only --workdir data
+#         DATABASE_PATH=data/mateugram.db FTP_RESTORE_ON_START=0 gunicorn -c gunicorn.conf.py
+#         python bench.py --url http://127.0.0.1:5000 --sockets 1000
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ['chats', 'chat', 'search', 'react', 'send_message', 'ftp_sync', 'page_weight',
+             'api_chats', 'api_chat', 'api_weight', 'fanout', 'bulk_import', 'channel', 'signup']
+# Сценарии, которым нужен запущенный сервер (--url)
+SERVER_SCENARIOS = ['sockets']
+SEARCH_WORDS = ['привет', 'встреча', 'отчёт', 'завтра', 'фото', 'код', 'обед', 'релиз']
+REACTIONS = ['👍', '❤️', '😂', '🔥', '😮']
+FTP_USER = 'bench'
+FTP_PASS = 'bench'
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон Mateugram')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--chats', type=int, default=20, help='групповых чатов; чат 1 — общий для всех')
+    parser.add_argument('--members', type=int, default=30, help='участников в остальных чатах')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--reactions', type=int, default=10000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=16, help='параллельных клиентов')
+    parser.add_argument('--requests', type=int, default=25, help='запросов на клиента в каждом сценарии')
+    parser.add_argument('--syncs', type=int, default=3, help='прогонов полной FTP-синхронизации')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help='папка для базы и uploads (по умолчанию временная)')
+    parser.add_argument('--seed-only', action='store_true', help='только засеять базу в --workdir')
+    parser.add_argument('--url', help='адрес запущенного сервера для сценария sockets')
+    parser.add_argument('--sockets', type=int, default=500, help='сколько сокетов держать открытыми')
+    parser.add_argument('--broadcasts', type=int, default=20, help='сообщений в общий чат при открытых сокетах')
+    parser.add_argument('--fanout-sockets', type=int, default=200, help='получателей в сценарии fanout')
+    parser.add_argument('--fanout-burst', type=int, default=20, help='сообщений подряд в одной пачке сценария fanout')
+    parser.add_argument('--channel-subscribers', type=int, default=100000, help='подписчиков канала в сценарии channel')
+    parser.add_argument('--channel-viewers', type=int, default=1000, help='из них с открытым каналом')
+    parser.add_argument('--import-users', type=int, default=10000, help='участников в одном импорте сценария bulk_import')
+    parser.add_argument('--signups', type=int, default=50, help='регистраций в каждом режиме сценария signup')
+    parser.add_argument('--smtp-latency', type=float, default=0.3,
+                        help='секунд, которые локальный SMTP-сервер тратит на письмо (как у провайдера)')
+    parser.add_argument('--idle', type=float, default=10, help='секунд простоя с открытыми сокетами')
+    parser.add_argument('--typers', type=int, default=0, help='сколько клиентов «печатают» во время простоя')
+    parser.add_argument('--login-storm', type=int, default=0,
+                        help='потоков, которые входят по паролю, пока идут рассылки (засеянный пароль — bench)')
+    parser.add_argument('--sync-secret', default=os.getenv('SYNC_SECRET'),
+                        help='X-Sync-Secret сервера, чтобы читать CPU процесса из /metrics')
+    parser.add_argument('--secret-key', default=os.getenv('SECRET_KEY', 'dev-key-12345'),
+                        help='SECRET_KEY сервера, чтобы подписать сессии клиентов')
+    parser.add_argument('--out', default='bench-results.json')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    return parser.parse_args()
+
+def start_ftp_server(root):
+    """Запускает FTP-сервер на свободном порту в фоне, возвращает порт."""
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PASS, root, perm='elradfmwMT')
+    handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    server = FTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.socket.getsockname()[1]
+
+def load_app(workdir, ftp_port):
+    """Импортирует app.py с базой и uploads в workdir и, если есть, локальным FTP."""
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'mateugram.db')
+    os.environ.setdefault('SYNC_SECRET', 'bench')
+    if ftp_port:
+        os.environ.update({'FTP_HOST': '127.0.0.1', 'FTP_PORT': str(ftp_port),
+                           'FTP_USER': FTP_USER, 'FTP_PASS': FTP_PASS})
+    # Основная база и шарды сообщений (при MESSAGE_SHARDS), если остались от прошлого прогона
+    for name in os.listdir(workdir):
+        if name.startswith('mateugram') and name.endswith('.db'):
+            os.remove(os.path.join(workdir, name))
+    sys.path.insert(0, REPO_DIR)
+    import app as mateugram
+    # База засеивается заново, восстанавливать её с FTP не нужно
+    mateugram.create_app(restore=False)
+    return mateugram
+
+def seed(m, args):
+    """Заполняет базу синтетическими данными. Возвращает ({user_id: [chat_id, ...]}, [id сообщений])."""
+    rnd = random.Random(args.seed)
+    db = m.db
+    now = datetime.utcnow()
+    with m.app.app_context():
+        password_hash = m.generate_password_hash('bench')
+        users = [{'id': i, 'username': f'user{i}', 'first_name': f'User {i}', 'email': f'user{i}@bench.local',
+                  'password_hash': password_hash, 'verified': True, 'created_at': now}
+                 for i in range(1, args.users + 1)]
+        chats = [{'id': i, 'name': f'Группа {i}', 'is_group': True, 'created_by': 1, 'created_at': now}
+                 for i in range(1, args.chats + 1)]
+        members, user_chats = [], {u['id']: [] for u in users}
+        for chat in chats:
+            if chat['id'] == 1:
+                chat_users = list(user_chats)
+            else:
+                chat_users = rnd.sample(list(user_chats), min(args.members, args.users))
+            for user_id in chat_users:
+                members.append({'user_id': user_id, 'chat_id': chat['id'], 'role': 'owner' if user_id == 1 else 'member',
+                                'joined_at': now})
+                user_chats[user_id].append(chat['id'])
+        chat_users = {}
+        for row in members:
+            chat_users.setdefault(row['chat_id'], []).append(row['user_id'])
+        messages = []
+        for i in range(1, args.messages + 1):
+            chat_id = rnd.randint(1, args.chats)
+            words = rnd.choices(SEARCH_WORDS, k=rnd.randint(2, 12))
+            # id в диапазоне шарда чата (без шардов — просто i)
+            messages.append({'id': m.shard_of_chat(chat_id) * m.SHARD_ID_SPAN + i, 'chat_id': chat_id,
+                             'sender_id': rnd.choice(chat_users[chat_id]),
+                             'content': ' '.join(words), 'created_at': now - timedelta(seconds=args.messages - i),
+                             'edited': False, 'pinned': False, 'comment_count': 0})
+        reactions = []
+        for _ in range(args.reactions):
+            msg = rnd.choice(messages)
+            reactions.append({'message_id': msg['id'], 'user_id': rnd.choice(chat_users[msg['chat_id']]),
+                              'reaction': rnd.choice(REACTIONS)})
+        comments, comment_counts = [], Counter()
+        for _ in range(args.comments):
+            msg = rnd.choice(messages)
+            comment_counts[msg['id']] += 1
+            comments.append({'message_id': msg['id'], 'user_id': rnd.choice(chat_users[msg['chat_id']]),
+                             'content': ' '.join(rnd.choices(SEARCH_WORDS, k=4)), 'created_at': now})
+        for msg in messages:
+            msg['comment_count'] = comment_counts[msg['id']]
+        for model, rows in ((m.User, users), (m.Chat, chats), (m.ChatMember, members)):
+            for chunk in m.chunked(rows):
+                db.session.execute(db.insert(model), chunk)
+        # Сообщения, реакции и комментарии — в шард своего чата
+        for model, rows in ((m.Message, messages), (m.Reaction, reactions), (m.Comment, comments)):
+            key = 'id' if model is m.Message else 'message_id'
+            for shard in range(m.MESSAGE_SHARDS):
+                with m.shard_scope(shard):
+                    for chunk in m.chunked([row for row in rows if m.shard_of_message(row[key]) == shard]):
+                        db.session.execute(db.insert(model), chunk)
+        db.session.commit()
+    return user_chats, [msg['id'] for msg in messages]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, errors, wall):
+    values = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'count': len(values),
+        'errors': errors,
+        'seconds': round(wall, 3),
+        'throughput': round(len(values) / wall, 2) if wall else None,
+        'mean_ms': ms(sum(values) / len(values)) if values else None,
+        'p50_ms': ms(percentile(values, 50)),
+        'p90_ms': ms(percentile(values, 90)),
+        'p95_ms': ms(percentile(values, 95)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None
+    }
+
+class SimClient:
+    """Один пользователь: свой HTTP-клиент с сессией и, при необходимости, Socket.IO-клиент."""
+    def __init__(self, m, user_id, chat_ids, rnd):
+        self.m = m
+        self.user_id = user_id
+        self.chat_ids = chat_ids
+        self.rnd = rnd
+        self.http = m.app.test_client()
+        # Как браузер: принимаем сжатые ответы, байты на проводе считаем в check()
+        self.http.environ_base['HTTP_ACCEPT_ENCODING'] = 'gzip, br'
+        self.wire_bytes = 0
+        # Логинимся напрямую через сессию Flask-Login, чтобы не мерить хэширование паролей
+        with self.http.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)
+            sess['_fresh'] = True
+        self.sio = None
+
+    def connect_socket(self):
+        self.sio = self.m.socketio.test_client(self.m.app, flask_test_client=self.http)
+        for chat_id in self.chat_ids:
+            self.sio.emit('join', {'chat_id': chat_id})
+
+    def check(self, response):
+        self.wire_bytes += len(response.data)
+        if response.status_code >= 400:
+            raise RuntimeError(f'HTTP {response.status_code}')
+
+    def op_chats(self):
+        self.check(self.http.get('/chats'))
+
+    def op_chat(self):
+        self.check(self.http.get(f'/chat/{self.rnd.choice(self.chat_ids)}'))
+
+    def op_search(self):
+        chat_id = self.rnd.choice(self.chat_ids)
+        self.check(self.http.get(f'/chat/{chat_id}/search', query_string={'q': self.rnd.choice(SEARCH_WORDS)}))
+
+    def op_api_chats(self):
+        self.check(self.http.get('/api/v1/chats'))
+
+    def op_api_chat(self):
+        self.check(self.http.get(f'/api/v1/chats/{self.rnd.choice(self.chat_ids)}/messages'))
+
+    def op_react(self):
+        message_id = self.rnd.choice(self.message_ids)
+        self.check(self.http.post('/react', json={'message_id': message_id, 'reaction': self.rnd.choice(REACTIONS)}))
+
+    def op_send_message(self):
+        self.sio.emit('send_message', {'chat_id': self.rnd.choice(self.chat_ids),
+                                       'content': ' '.join(self.rnd.choices(SEARCH_WORDS, k=6))})
+        # Входящие рассылки не нужны — не даём очереди расти
+        self.sio.get_received()
+
+def run_scenario(name, clients, requests_per_client):
+    latencies, errors = [], Counter()
+    lock = threading.Lock()
+
+    def worker(client):
+        op = getattr(client, f'op_{name}')
+        local = []
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            try:
+                op()
+            except Exception as e:
+                with lock:
+                    errors[str(e)[:100]] += 1
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    wire_bytes = sum(client.wire_bytes for client in clients)
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        list(pool.map(worker, clients))
+    result = summarize(latencies, dict(errors), time.perf_counter() - start)
+    if latencies:
+        result['bytes_per_op'] = round((sum(client.wire_bytes for client in clients) - wire_bytes) / len(latencies))
+    return result
+
+def run_ftp_sync(m, syncs):
+    latencies, errors = [], Counter()
+    start = time.perf_counter()
+    for _ in range(syncs):
+        before = m.metrics.counters.get(('mateugram_ftp_errors_total', (('op', 'sync_to'),)), 0)
+        t = time.perf_counter()
+        m.sync_to_ftp(full=True)
+        latencies.append(time.perf_counter() - t)
+        if m.metrics.counters.get(('mateugram_ftp_errors_total', (('op', 'sync_to'),)), 0) > before:
+            errors['sync_to_ftp failed'] += 1
+    return summarize(latencies, dict(errors), time.perf_counter() - start)
+
+# Ссылки страницы на стили и скрипты: свои (/assets/, /static/) качаются, внешние только считаются
+ASSET_REF = re.compile(r'<(?:link rel="stylesheet" href|script src)="([^"]+)"')
+
+def response_text(m, response):
+    """Тело ответа как текст с учётом Content-Encoding (br доступен, только если он есть у приложения)."""
+    data, encoding = response.data, response.headers.get('Content-Encoding')
+    if encoding == 'gzip':
+        data = zlib.decompress(data, 31)
+    elif encoding == 'br':
+        data = m.brotli.decompress(data)
+    return data.decode()
+
+def fetch_page(m, http, url, headers, cached):
+    """Страница и её ещё не закэшированные свои ресурсы, как их качает браузер.
+    Возвращает (ответ, байт HTML, байт ресурсов, запросов, внешних ссылок)."""
+    r = http.get(url, headers=headers)
+    if r.status_code >= 400:
+        return r, 0, 0, 1, 0
+    asset_bytes, requests, external = 0, 1, 0
+    for ref in ASSET_REF.findall(response_text(m, r)):
+        if not ref.startswith('/'):
+            external += 1
+            continue
+        if ref.startswith('/assets/') and ref in cached:
+            continue
+        asset = http.get(ref, headers=headers)
+        asset_bytes += len(asset.data)
+        requests += 1
+        if 'immutable' in asset.headers.get('Cache-Control', ''):
+            cached.add(ref)
+    return r, len(r.data), asset_bytes, requests, external
+
+def last_message_id(m, chat_id):
+    with m.app.app_context(), m.shard_scope(m.shard_of_chat(chat_id)):
+        return m.Message.query.filter_by(chat_id=chat_id).order_by(m.Message.id.desc()).first().id
+
+def run_page_weight(m, client):
+    """Байты на переход по страницам, как их видит браузер: HTML и ещё не закэшированные свои ресурсы.
+    Первый проход — с пустым кэшем, второй — повторные переходы, когда ресурсы уже в кэше."""
+    chat_id = client.chat_ids[0]
+    message_id = last_message_id(m, chat_id)
+    anonymous = m.app.test_client()
+    pages = [(anonymous, '/'), (anonymous, '/login'), (anonymous, '/register'),
+             (client.http, '/chats'), (client.http, f'/chat/{chat_id}'), (client.http, f'/chat/{chat_id}/search?q=код'),
+             (client.http, f'/chat/{chat_id}/info'), (client.http, f'/message/{message_id}/comments'),
+             (client.http, '/new-chat'), (client.http, '/profile'), (client.http, '/settings')]
+    headers = {'Accept-Encoding': 'br, gzip'}
+    cached, weights, latencies, errors = set(), {}, [], Counter()
+    compress_before = compress_cpu(m)
+    start = time.perf_counter()
+    for visit in ('cold', 'warm'):
+        for http, url in pages:
+            t = time.perf_counter()
+            r, html_bytes, asset_bytes, _, external = fetch_page(m, http, url, headers, cached)
+            if r.status_code >= 400:
+                errors[f'{url}: HTTP {r.status_code}'] += 1
+                continue
+            latencies.append(time.perf_counter() - t)
+            page = weights.setdefault(url.split('?')[0], {'html': html_bytes, 'external': external})
+            page[f'{visit}_bytes'] = html_bytes + asset_bytes
+    result = summarize(latencies, dict(errors), time.perf_counter() - start)
+    result['pages'] = weights
+    seconds, count = (after - before for after, before in zip(compress_cpu(m), compress_before))
+    result['compressed_responses'] = count
+    result['compress_cpu_ms'] = round(seconds / count * 1000, 3) if count else None
+    for visit in ('cold', 'warm'):
+        result[f'{visit}_bytes'] = sum(page.get(f'{visit}_bytes', 0) for page in weights.values())
+    return result
+
+def run_api_weight(m, client):
+    """Запросы и байты на обход экранов чата: HTML-страницы со своими ресурсами против JSON API.
+    Проходы: первый (пустой кэш), повтор (ресурсы в кэше, API — с If-None-Match)
+    и новое сообщение в чате (страница чата целиком против ?after=)."""
+    chat_id = client.chat_ids[0]
+    message_id = last_message_id(m, chat_id)
+    screens = [('/chats', '/api/v1/chats'),
+               (f'/chat/{chat_id}', f'/api/v1/chats/{chat_id}/messages'),
+               (f'/chat/{chat_id}/info', f'/api/v1/chats/{chat_id}/members'),
+               (f'/chat/{chat_id}/search?q=код', f'/api/v1/chats/{chat_id}/search?q=код'),
+               (f'/message/{message_id}/comments', f'/api/v1/messages/{message_id}/comments')]
+    headers = {'Accept-Encoding': 'br, gzip'}
+    cached, etags, latencies, errors = set(), {}, [], Counter()
+    flows = {'html': {}, 'api': {}}
+
+    def html_get(url):
+        t = time.perf_counter()
+        r, html_bytes, asset_bytes, requests, _ = fetch_page(m, client.http, url, headers, cached)
+        latencies.append(time.perf_counter() - t)
+        if r.status_code >= 400:
+            errors[f'{url}: HTTP {r.status_code}'] += 1
+        return requests, html_bytes + asset_bytes
+
+    def api_get(url):
+        t = time.perf_counter()
+        r = client.http.get(url, headers=dict(headers, **({'If-None-Match': etags[url]} if url in etags else {})))
+        latencies.append(time.perf_counter() - t)
+        if r.status_code >= 400:
+            errors[f'{url}: HTTP {r.status_code}'] += 1
+        elif r.status_code == 200:
+            etags[url] = r.headers['ETag']
+        return 1, len(r.data)
+
+    def record(flow, visit, fetched):
+        flows[flow][visit] = {'requests': sum(n for n, _ in fetched), 'bytes': sum(b for _, b in fetched)}
+
+    start = time.perf_counter()
+    for visit in ('first', 'repeat'):
+        record('html', visit, [html_get(html) for html, _ in screens])
+        record('api', visit, [api_get(api) for _, api in screens])
+    # Новое сообщение: обе стороны узнают о нём по сокету и дочитывают экран чата
+    seen = last_message_id(m, chat_id)
+    with m.app.app_context(), m.shard_scope(m.shard_of_chat(chat_id)):
+        msg = m.Message(sender_id=client.user_id, chat_id=chat_id, content='новое сообщение')
+        m.db.session.add(msg)
+        m.db.session.commit()
+        m.broadcast_message(msg, '')
+    record('html', 'new_message', [html_get(f'/chat/{chat_id}')])
+    record('api', 'new_message', [api_get(f'/api/v1/chats/{chat_id}/messages?after={seen}')])
+    result = summarize(latencies, dict(errors), time.perf_counter() - start)
+    result['flows'] = flows
+    return result
+
+def print_api_weight(result):
+    visits = ('first', 'repeat', 'new_message')
+    print(f"{'flow':<8}" + ''.join(f"{v + ' req':>17}{'bytes':>9}" for v in visits))
+    for flow, data in result['flows'].items():
+        print(f"{flow:<8}" + ''.join(f"{data[v]['requests']:>17}{data[v]['bytes']:>9}" for v in visits))
+
+FANOUT_MESSAGES = 1000
+
+def run_fanout(m, args):
+    """Байты и CPU сервера на FANOUT_MESSAGES разосланных сообщений: JSON и MessagePack, по одному и пачками.
+    Получатели — участники комнаты без транспорта: пакеты кодируются как в проде, а eio.send только считает байты.
+    Сообщения идут очередями по --fanout-burst подряд с паузой больше окна MESSAGE_BATCH_WINDOW."""
+    server = m.socketio.server
+    fanout = m.message_fanout
+    sent = Counter()
+
+    def count_send(eio_sid, data):
+        sent['packets'] += 1
+        # +1: байт типа пакета engine.io у текстовых кадров
+        sent['bytes'] += len(data.encode()) + 1 if isinstance(data, str) else len(data)
+
+    rnd = random.Random(args.seed)
+    now = datetime.utcnow()
+    messages = [m.Message(id=10 ** 9 + i, chat_id=1, sender_id=1, created_at=now,
+                          content=' '.join(rnd.choices(SEARCH_WORDS, k=rnd.randint(2, 12))))
+                for i in range(FANOUT_MESSAGES)]
+    window = fanout.window or 0.05
+    modes = [('json', 0), ('json', window), ('msgpack', 0), ('msgpack', window)]
+    if not fanout.packing:
+        logging.warning("msgpack is not installed or SOCKET_MSGPACK=0, skipping msgpack modes")
+        modes = modes[:2]
+    original_send, original_window = server.eio.send, fanout.window
+    server.eio.send = count_send
+    results = {}
+    wall = time.perf_counter()
+    try:
+        for encoding, mode_window in modes:
+            sids = [server.manager.connect(f'bench-fanout-{encoding}-{i}', '/') for i in range(args.fanout_sockets)]
+            for sid in sids:
+                server.manager.enter_room(sid, '/', f'{encoding}_1')
+            fanout.window = mode_window
+            fanout.sent_at.clear()
+            sent.clear()
+            with m.app.app_context():
+                cpu, start = time.process_time(), time.perf_counter()
+                for n in range(0, FANOUT_MESSAGES, args.fanout_burst):
+                    for msg in messages[n:n + args.fanout_burst]:
+                        m.broadcast_message(msg, 'Bench')
+                    time.sleep(mode_window * 2)
+                time.sleep(mode_window * 2)
+                cpu = time.process_time() - cpu
+            results[f"{encoding}{'_batched' if mode_window else ''}"] = {
+                'seconds': round(time.perf_counter() - start, 2), 'recipients': len(sids),
+                'packets': sent['packets'], 'bytes': sent['bytes'],
+                'bytes_per_recipient': round(sent['bytes'] / len(sids)), 'cpu_ms': round(cpu * 1000, 1)}
+            for sid in sids:
+                server.manager.disconnect(sid, '/')
+    finally:
+        server.eio.send, fanout.window = original_send, original_window
+    result = summarize([], {}, time.perf_counter() - wall)
+    result['modes'] = results
+    return result
+
+def print_fanout(result):
+    print(f"per {FANOUT_MESSAGES} messages:")
+    print(f"{'mode':<18}{'recipients':>11}{'packets':>10}{'KB':>10}{'KB/recipient':>14}{'CPU ms':>10}")
+    for mode, r in result['modes'].items():
+        print(f"{mode:<18}{r['recipients']:>11}{r['packets']:>10}{r['bytes'] / 1024:>10.1f}"
+              f"{r['bytes_per_recipient'] / 1024:>14.1f}{r['cpu_ms']:>10}")
+
+CHANNEL_POSTS = 20
+
+def run_channel(m, args):
+    """Пост в канал с --channel-subscribers подписчиками, у каждого открыт сокет: --channel-viewers смотрят канал
+    (new_message), остальным уходит unread в личную комнату. Сокеты — как в fanout, без транспорта.
+    Отдельно — холодная загрузка списка подписчиков и запись накопленных счётчиков непрочитанных."""
+    db, server = m.db, m.socketio.server
+    sent = Counter()
+
+    def count_send(eio_sid, data):
+        sent['packets'] += 1
+        sent['bytes'] += len(data.encode()) + 1 if isinstance(data, str) else len(data)
+
+    now = datetime.utcnow()
+    with m.app.app_context():
+        first = (db.session.query(db.func.max(m.User.id)).scalar() or 0) + 1
+        users = [{'id': first + i, 'username': f'subscriber{i}', 'first_name': f'Subscriber {i}',
+                  'email': f'subscriber{i}@bench.local', 'password_hash': '', 'verified': True, 'created_at': now}
+                 for i in range(args.channel_subscribers)]
+        channel = m.Chat(name='Канал', is_channel=True, created_by=1)
+        db.session.add(channel)
+        db.session.flush()
+        channel_id = channel.id
+        members = [{'user_id': 1, 'chat_id': channel_id, 'role': 'owner', 'joined_at': now}]
+        members += [{'user_id': u['id'], 'chat_id': channel_id, 'role': 'member', 'joined_at': now} for u in users]
+        for model, rows in ((m.User, users), (m.ChatMember, members)):
+            for chunk in m.chunked(rows):
+                db.session.execute(db.insert(model), chunk)
+        db.session.commit()
+    rnd = random.Random(args.seed)
+    messages = [m.Message(id=2 * 10 ** 9 + i, chat_id=channel_id, sender_id=1, created_at=now,
+                          content=' '.join(rnd.choices(SEARCH_WORDS, k=rnd.randint(2, 12))))
+                for i in range(CHANNEL_POSTS)]
+    sids = []
+    for i, user in enumerate(users):
+        sid = server.manager.connect(f'bench-channel-{i}', '/')
+        server.manager.enter_room(sid, '/', f"user_{user['id']}")
+        if i < args.channel_viewers:
+            server.manager.enter_room(sid, '/', f'json_{channel_id}')
+        m.presence.connect(sid, user['id'], [channel_id])
+        sids.append((sid, user['id']))
+    # Волна «в сети» от подключений расходится до замеров
+    time.sleep(m.app.config['PRESENCE_INTERVAL'] * 2)
+    original_send, flush_interval = server.eio.send, m.app.config['UNREAD_FLUSH_INTERVAL']
+    server.eio.send = count_send
+    # Счётчики всех постов пишутся одним замеренным flush_unread, а не фоновой задачей по ходу
+    m.app.config['UNREAD_FLUSH_INTERVAL'] = float('inf')
+    result = {}
+    try:
+        with m.app.app_context():
+            t = time.perf_counter()
+            m.get_chat_member_ids(channel_id)
+            result['member_list_cold_ms'] = round((time.perf_counter() - t) * 1000, 1)
+            latencies = []
+            cpu = time.process_time()
+            for msg in messages:
+                t = time.perf_counter()
+                m.broadcast_message(msg, 'Канал')
+                latencies.append(time.perf_counter() - t)
+                time.sleep(m.message_fanout.window * 2)
+            cpu = time.process_time() - cpu
+            t = time.perf_counter()
+            m.flush_unread()
+            result['unread_flush_ms'] = round((time.perf_counter() - t) * 1000, 1)
+    finally:
+        server.eio.send, m.app.config['UNREAD_FLUSH_INTERVAL'] = original_send, flush_interval
+        # manager.disconnect перебирает все комнаты — на 100k сокетов это квадрат, выходим из своих напрямую
+        for sid, user_id in sids:
+            m.presence.disconnect(sid)
+            for room in (f'user_{user_id}', f'json_{channel_id}', sid, None):
+                server.manager.leave_room(sid, '/', room)
+    summary = summarize(latencies, {}, sum(latencies))
+    summary.update(result, subscribers=len(users), viewers=min(args.channel_viewers, len(users)),
+                   posts=len(messages), packets=sent['packets'], bytes=sent['bytes'],
+                   cpu_ms_per_post=round(cpu * 1000 / len(messages), 1))
+    return summary
+
+def print_channel(result):
+    print(f"channel with {result['subscribers']} subscribers ({result['viewers']} viewing), {result['posts']} posts:")
+    print(f"  post p50 {result['p50_ms']} ms, max {result['max_ms']} ms, CPU {result['cpu_ms_per_post']} ms/post, "
+          f"{result['packets'] // result['posts']} packets and {result['bytes'] // result['posts'] // 1024} KB per post")
+    print(f"  member list cold load {result['member_list_cold_ms']} ms, unread flush {result['unread_flush_ms']} ms")
+
+IMPORT_RUNS = 3
+
+def run_bulk_import(m, client, args):
+    """Массовое добавление --import-users участников в новую группу: IMPORT_RUNS раз JSON-списком
+    и столько же CSV-файлом. В списке, как у живого администратора, есть повторы и несуществующие имена."""
+    db = m.db
+    now = datetime.utcnow()
+    with m.app.app_context():
+        first = (db.session.query(db.func.max(m.User.id)).scalar() or 0) + 1
+        password_hash = m.generate_password_hash('bench')
+        users = [{'id': first + i, 'username': f'import{i}', 'first_name': f'Import {i}',
+                  'email': f'import{i}@bench.local', 'password_hash': password_hash, 'verified': True,
+                  'created_at': now} for i in range(args.import_users)]
+        for chunk in m.chunked(users):
+            db.session.execute(db.insert(m.User), chunk)
+        db.session.commit()
+    usernames = [u['username'] for u in users] + [f'missing{i}' for i in range(100)] + [users[0]['username']]
+    csv_body = ('username\n' + '\n'.join(usernames)).encode()
+    modes = {'json': [], 'csv': []}
+    errors = Counter()
+    start = time.perf_counter()
+    for run in range(IMPORT_RUNS):
+        for mode, latencies in modes.items():
+            r = client.http.post('/new-chat', data={'action': 'create', 'chat_type': 'group', 'name': f'Импорт {mode} {run}'})
+            chat_id = int(r.headers['Location'].rstrip('/').split('/')[-1])
+            t = time.perf_counter()
+            if mode == 'json':
+                r = client.http.post(f'/chat/{chat_id}/add_members', json={'usernames': usernames})
+            else:
+                r = client.http.post(f'/chat/{chat_id}/add_members', content_type='multipart/form-data',
+                                     data={'csv': (io.BytesIO(csv_body), 'members.csv')})
+            latencies.append(time.perf_counter() - t)
+            with m.app.app_context():
+                added = m.ChatMember.query.filter_by(chat_id=chat_id).count() - 1
+            if r.status_code >= 400 or added != len(users):
+                errors[f'{mode}: HTTP {r.status_code}, added {added}'] += 1
+    result = summarize(modes['json'] + modes['csv'], dict(errors), time.perf_counter() - start)
+    result['members'] = len(users)
+    result['modes'] = {mode: summarize(latencies, {}, sum(latencies)) for mode, latencies in modes.items()}
+    return result
+
+def print_bulk_import(result):
+    print(f"bulk import of {result['members']} members:")
+    print(f"{'mode':<8}{'p50 ms':>10}{'max ms':>10}{'members/s':>12}")
+    for mode, r in result['modes'].items():
+        print(f"{mode:<8}{r['p50_ms']:>10}{r['max_ms']:>10}{result['members'] / (r['p50_ms'] / 1000):>12.0f}")
+
+class BenchSMTPHandler:
+    """Принимает письма с задержкой на каждое, как почтовый провайдер."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.latency)
+        self.received += 1
+        return '250 Message accepted'
+
+def start_smtp_server(latency):
+    """Запускает SMTP-сервер на свободном порту в фоне, возвращает (контроллер, обработчик, порт)."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    handler = BenchSMTPHandler(latency)
+    logging.getLogger('mail.log').setLevel(logging.WARNING)
+    controller = SMTPController(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    return controller, handler, port
+
+SIGNUP_MODES = ('inline', 'queue')
+
+def run_signup(m, args):
+    """--signups регистраций с приветственным письмом в каждом режиме: inline — письмо уходит прямо
+    в запросе, как до очереди, queue — через outbound_mail и фоновый воркер. Хэш пароля на время
+    сценария дешёвый, чтобы разница была только в почте."""
+    controller, handler, port = start_smtp_server(args.smtp_latency)
+    state = m.app.extensions['mail']
+    smtp_settings = {'server': '127.0.0.1', 'port': port, 'use_ssl': False, 'use_tls': False,
+                     'username': None, 'password': None, 'suppress': False,
+                     'default_sender': 'bench@mateugram.local'}
+    saved_state = {name: getattr(state, name) for name in smtp_settings}
+    saved_config = {k: m.app.config[k] for k in ('MAIL_ON_REGISTER', 'PASSWORD_HASH_METHOD', 'MAIL_RATE_PER_MINUTE')}
+    for name, value in smtp_settings.items():
+        setattr(state, name, value)
+    m.app.config.update(MAIL_ON_REGISTER=True, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000', MAIL_RATE_PER_MINUTE=60000)
+    if not m.app.config['MAIL_QUEUE_WORKER']:
+        m.start_background_task(m.mail_loop)
+    enqueue_mail = m.enqueue_mail
+
+    def send_inline(recipient, subject, body, html=None):
+        m.mail.send(m.MailMessage(subject, recipients=[recipient], body=body, html=html))
+
+    modes, all_latencies, errors = {}, [], Counter()
+    start = time.perf_counter()
+    try:
+        for mode in SIGNUP_MODES:
+            m.enqueue_mail = send_inline if mode == 'inline' else enqueue_mail
+            latencies = []
+            received = handler.received
+            mode_start = time.perf_counter()
+            for i in range(args.signups):
+                username = f'signup_{mode}_{i}'
+                t = time.perf_counter()
+                r = m.app.test_client().post('/register', data={
+                    'first_name': 'Signup', 'last_name': '', 'username': username,
+                    'email': f'{username}@bench.local', 'password': 'bench', 'confirm_password': 'bench'})
+                latencies.append(time.perf_counter() - t)
+                if r.status_code != 302:
+                    errors[f'{mode}: HTTP {r.status_code}'] += 1
+            # Письма очереди уходят в фоне — ждём, пока дойдут все
+            deadline = time.monotonic() + 30 + 2 * args.signups * args.smtp_latency
+            while handler.received - received < args.signups and time.monotonic() < deadline:
+                time.sleep(0.02)
+            delivered = handler.received - received
+            if delivered < args.signups:
+                errors[f'{mode}: delivered {delivered} of {args.signups}'] += 1
+            modes[mode] = summarize(latencies, {}, sum(latencies))
+            modes[mode]['delivered_s'] = round(time.perf_counter() - mode_start, 3)
+            all_latencies += latencies
+    finally:
+        m.enqueue_mail = enqueue_mail
+        m.app.config.update(saved_config)
+        for name, value in saved_state.items():
+            setattr(state, name, value)
+        controller.stop()
+    result = summarize(all_latencies, dict(errors), time.perf_counter() - start)
+    result['smtp_latency_ms'] = round(args.smtp_latency * 1000)
+    result['modes'] = modes
+    return result
+
+def print_signup(result):
+    print(f"signup with a welcome mail, SMTP {result['smtp_latency_ms']} ms per message:")
+    print(f"{'mode':<8}{'p50 ms':>10}{'p99 ms':>10}{'all sent s':>12}")
+    for mode, r in result['modes'].items():
+        print(f"{mode:<8}{r['p50_ms']:>10}{r['p99_ms']:>10}{r['delivered_s']:>12}")
+
+def compress_cpu(m):
+    """(секунд CPU на сжатие, сжатых ответов) по гистограмме приложения."""
+    seconds = count = 0
+    for (name, _), data in m.metrics.histograms.items():
+        if name == 'mateugram_http_compress_seconds':
+            seconds += data[-1]
+            count += sum(data[:-1])
+    return seconds, count
+
+def print_page_weight(result):
+    print(f"{'page':<30}{'html':>9}{'cold':>9}{'warm':>9}{'ext':>5}")
+    for url, page in result['pages'].items():
+        print(f"{url:<30}{page['html']:>9}{page.get('cold_bytes', 0):>9}{page.get('warm_bytes', 0):>9}{page['external']:>5}")
+    print(f"{'total':<30}{'':>9}{result['cold_bytes']:>9}{result['warm_bytes']:>9}")
+    print(f"compressed responses: {result['compressed_responses']}, CPU per response: {result['compress_cpu_ms'] or '-'} ms")
+
+def session_cookies(secret_key, user_ids):
+    """Подписанные cookie сессий Flask-Login — как после входа, но без хэширования паролей на сервере."""
+    from flask import Flask
+    signer = Flask('bench')
+    signer.secret_key = secret_key
+    serializer = signer.session_interface.get_signing_serializer(signer)
+    return {user_id: serializer.dumps({'_user_id': str(user_id), '_fresh': True}) for user_id in user_ids}
+
+def server_metrics(url, secret):
+    """Метрики сервера без меток из /metrics: {имя: значение}; пусто, если недоступны."""
+    if not secret:
+        return {}
+    import requests
+    try:
+        r = requests.get(f'{url}/metrics', headers={'X-Sync-Secret': secret}, timeout=10)
+    except Exception:
+        return {}
+    values = {}
+    for line in r.text.splitlines():
+        if line and not line.startswith('#') and '{' not in line:
+            name, value = line.split()
+            values[name] = float(value)
+    return values
+
+def login_storm(url, args, stop):
+    """Потоки --login-storm входят под засеянными пользователями, пока не выставлен stop."""
+    import requests
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+
+    def worker(n):
+        session = requests.Session()
+        i = n
+        while not stop.is_set():
+            i += args.login_storm
+            start = time.perf_counter()
+            try:
+                r = session.post(f'{url}/login', data={'username': f'user{i % args.users + 1}', 'password': 'bench'},
+                                 allow_redirects=False, timeout=30)
+                status = r.status_code
+            except Exception as e:
+                status = type(e).__name__
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(args.login_storm)]
+    for thread in threads:
+        thread.start()
+    return threads, latencies, statuses
+
+def run_sockets(url, args):
+    """Открывает --sockets клиентов в общий чат 1, затем меряет доставку рассылок всем открытым сокетам."""
+    cookies = session_cookies(args.secret_key, [(i % args.users) + 1 for i in range(args.sockets)])
+    connect_latencies, errors = [], Counter()
+    delivery_latencies = []
+    sent_at = {}
+    lock = threading.Lock()
+    clients = []
+    presence_events = Counter()
+
+    def on_presence(data):
+        with lock:
+            presence_events['received'] += 1
+
+    def on_message(data):
+        received = time.perf_counter()
+        start = sent_at.get(data.get('content'))
+        if start is not None:
+            with lock:
+                delivery_latencies.append(received - start)
+
+    def on_messages(messages):
+        for data in messages:
+            on_message(data)
+
+    def connect(i):
+        user_id = (i % args.users) + 1
+        client = socketio_client.Client(reconnection=False)
+        client.on('new_message', on_message)
+        client.on('new_messages', on_messages)
+        client.on('presence', on_presence)
+        start = time.perf_counter()
+        try:
+            client.connect(url, headers={'Cookie': f'session={cookies[user_id]}'}, wait_timeout=30)
+            client.emit('join', {'chat_id': 1})
+        except Exception as e:
+            with lock:
+                errors[str(e)[:100]] += 1
+            return
+        with lock:
+            connect_latencies.append(time.perf_counter() - start)
+            clients.append(client)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(args.sockets, 64)) as pool:
+        list(pool.map(connect, range(args.sockets)))
+    connect_result = summarize(connect_latencies, dict(errors), time.perf_counter() - start)
+    connect_result['connected'] = len(clients)
+    logging.info(f"{len(clients)}/{args.sockets} sockets connected")
+
+    # Простой: сокеты открыты, --typers клиентов «печатают» каждые 200 мс.
+    # Рассылки присутствия должны оставаться пачками раз в PRESENCE_INTERVAL, а CPU — ограниченным.
+    # Клиент python-socketio запускает поток на каждый входящий пакет, поэтому при ~1000 сокетов
+    # в одном процессе узким местом становится сам bench — для большего числа запускайте несколько.
+    time.sleep(2)
+    with lock:
+        presence_events.clear()
+    before = server_metrics(url, args.sync_secret)
+    typers = clients[:args.typers]
+    typing_emits = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.idle:
+        for client in typers:
+            try:
+                client.emit('typing', {'chat_id': 1, 'typing': True})
+                typing_emits += 1
+            except Exception:
+                pass
+        time.sleep(0.2)
+    idle_seconds = time.perf_counter() - start
+    after = server_metrics(url, args.sync_secret)
+
+    def server_rate(name):
+        if name not in before or name not in after:
+            return None
+        return round((after[name] - before[name]) / idle_seconds, 3)
+
+    cpu_rate = server_rate('mateugram_process_cpu_seconds')
+    idle_result = summarize([], {}, idle_seconds)
+    idle_result.update({
+        'sockets': len(clients),
+        'typing_emits': typing_emits,
+        'presence_events': presence_events['received'],
+        'presence_events_per_socket_per_s': round(presence_events['received'] / max(len(clients), 1) / idle_seconds, 3),
+        'server_presence_broadcasts_per_s': server_rate('mateugram_presence_broadcasts_total'),
+        'server_cpu_percent': round(cpu_rate * 100, 1) if cpu_rate is not None else None
+    })
+    logging.info(f"Idle {idle_seconds:.0f}s: {typing_emits} typing emits -> "
+                 f"{idle_result['server_presence_broadcasts_per_s']} presence broadcasts/s, "
+                 f"server CPU {idle_result['server_cpu_percent']}%")
+
+    broadcast_errors = Counter()
+    # Рассылки во время шторма входов: задержка доставки должна остаться той же, что и без него
+    storm_stop = threading.Event()
+    if args.login_storm:
+        storm_threads, storm_latencies, storm_statuses = login_storm(url, args, storm_stop)
+        time.sleep(2)
+    start = time.perf_counter()
+    if clients:
+        time.sleep(1)  # даём join дойти до сервера
+        sender = clients[0]
+        for n in range(args.broadcasts):
+            content = f'bench-broadcast-{n}-{time.time()}'
+            sent_at[content] = time.perf_counter()
+            try:
+                sender.emit('send_message', {'chat_id': 1, 'content': content})
+            except Exception as e:
+                broadcast_errors[str(e)[:100]] += 1
+            time.sleep(0.2)
+        # Ждём хвост доставки, пока он идёт, но не дольше 10 секунд
+        deadline = time.time() + 10
+        delivered = -1
+        while time.time() < deadline and delivered != len(delivery_latencies):
+            delivered = len(delivery_latencies)
+            time.sleep(1)
+    broadcast_result = summarize(delivery_latencies, dict(broadcast_errors), time.perf_counter() - start)
+    broadcast_result['expected'] = len(clients) * args.broadcasts
+    broadcast_result['delivered'] = len(delivery_latencies)
+    results = {'socket_connect': connect_result, 'socket_idle': idle_result, 'socket_broadcast': broadcast_result}
+    if args.login_storm:
+        storm_stop.set()
+        for thread in storm_threads:
+            thread.join()
+        storm_errors = {str(k): v for k, v in storm_statuses.items() if k != 302}
+        results['login_storm'] = summarize(storm_latencies, storm_errors, time.perf_counter() - start)
+    for client in clients:
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return None
+
+def print_table(results, previous=None):
+    header = (f"{'scenario':<14}{'count':>7}{'err':>6}{'ops/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+              f"{'max ms':>10}{'B/op':>8}")
+    if previous:
+        header += f"{'p50 Δ':>9}{'p99 Δ':>9}"
+    print(header)
+    for name, r in results.items():
+        line = (f"{name:<14}{r['count']:>7}{sum(r['errors'].values()):>6}{r['throughput'] or 0:>10}"
+                f"{r['p50_ms'] or 0:>10}{r['p90_ms'] or 0:>10}{r['p99_ms'] or 0:>10}{r['max_ms'] or 0:>10}"
+                f"{r.get('bytes_per_op', '-'):>8}")
+        old = (previous or {}).get(name)
+        if old:
+            for key in ('p50_ms', 'p99_ms'):
+                if old.get(key) and r.get(key):
+                    line += f"{(r[key] / old[key] - 1) * 100:>+8.0f}%"
+                else:
+                    line += f"{'-':>9}"
+        print(line)
+
+def main():
+    args = parse_args()
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    if args.url:
+        scenarios = SERVER_SCENARIOS
+    unknown = set(scenarios) - set(SCENARIOS) - set(SERVER_SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    out_path = os.path.abspath(args.out)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['scenarios']
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='mateugram-bench-')
+
+    results = {}
+    if args.url:
+        if socketio_client is None:
+            sys.exit("python-socketio is not installed")
+        results.update(run_sockets(args.url.rstrip('/'), args))
+        write_report(args, out_path, results, None, previous)
+        return
+
+    ftp_port = None
+    if args.seed_only:
+        scenarios = []
+    if 'ftp_sync' in scenarios:
+        if FTPServer is None:
+            logging.warning("pyftpdlib is not installed, skipping ftp_sync")
+            scenarios.remove('ftp_sync')
+        else:
+            ftp_root = os.path.join(workdir, 'ftp')
+            os.makedirs(ftp_root, exist_ok=True)
+            ftp_port = start_ftp_server(ftp_root)
+
+    if 'signup' in scenarios and SMTPController is None:
+        logging.warning("aiosmtpd is not installed, skipping signup")
+        scenarios.remove('signup')
+
+    m = load_app(workdir, ftp_port)
+    t = time.perf_counter()
+    user_chats, message_ids = seed(m, args)
+    seed_seconds = time.perf_counter() - t
+    logging.info(f"Seeded {args.users} users, {args.chats} chats, {args.messages} messages in {seed_seconds:.1f}s")
+    if args.seed_only:
+        logging.info(f"Database: {os.path.join(workdir, 'mateugram.db')}")
+        return
+
+    rnd = random.Random(args.seed)
+    clients = []
+    for user_id in range(1, min(args.clients, args.users) + 1):
+        client = SimClient(m, user_id, user_chats[user_id], random.Random(rnd.random()))
+        client.message_ids = message_ids
+        clients.append(client)
+
+    for name in scenarios:
+        logging.info(f"Running {name}...")
+        if name == 'ftp_sync':
+            results[name] = run_ftp_sync(m, args.syncs)
+            continue
+        if name == 'page_weight':
+            results[name] = run_page_weight(m, clients[0])
+            continue
+        if name == 'api_weight':
+            results[name] = run_api_weight(m, clients[0])
+            continue
+        if name == 'fanout':
+            results[name] = run_fanout(m, args)
+            continue
+        if name == 'channel':
+            results[name] = run_channel(m, args)
+            continue
+        if name == 'bulk_import':
+            results[name] = run_bulk_import(m, clients[0], args)
+            continue
+        if name == 'signup':
+            results[name] = run_signup(m, args)
+            continue
+        if name == 'send_message':
+            for client in clients:
+                client.connect_socket()
+        results[name] = run_scenario(name, clients, args.requests)
+    write_report(args, out_path, results, seed_seconds, previous)
+
+def write_report(args, out_path, results, seed_seconds, previous):
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'workdir', 'secret_key')},
+        'seed_seconds': round(seed_seconds, 3) if seed_seconds is not None else None,
+        'scenarios': results
+    }
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print_table(results, previous)
+    if 'page_weight' in results:
+        print_page_weight(results['page_weight'])
+    if 'api_weight' in results:
+        print_api_weight(results['api_weight'])
+    if 'fanout' in results:
+        print_fanout(results['fanout'])
+    if 'channel' in results:
+        print_channel(results['channel'])
+    if 'bulk_import' in results:
+        print_bulk_import(results['bulk_import'])
+    if 'signup' in results:
+        print_signup(results['signup'])
+    logging.info(f"Results written to {out_path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import subprocess
+
+# Продакшен-запуск: gunicorn -c gunicorn.conf.py
+# Все параметры можно переопределить переменными окружения.
+
+# Каждый воркер собирает приложение фабрикой уже после fork и monkey-patch eventlet
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# eventlet держит тысячи WebSocket-соединений в одном процессе без потока на клиента
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'eventlet')
+# Комнаты Socket.IO и кэши живут в памяти процесса, а база — один файл SQLite,
+# поэтому по умолчанию воркер один. Больше воркеров — только с SOCKETIO_MESSAGE_QUEUE,
+# CACHE_REDIS_URL и sticky-сессиями на балансировщике.
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 2000))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+# Сколько ждать завершения воркера при остановке, включая финальную выгрузку на FTP
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+def on_starting(server):
+    """Восстанавливаем базу и файлы с FTP один раз, до запуска воркеров.
+    В отдельном процессе — мастер не должен импортировать приложение раньше eventlet."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    app_path = os.path.join(base_dir, 'app.py')
+    if os.getenv('FTP_RESTORE_ON_START', '1') == '1':
+        subprocess.run([sys.executable, app_path, 'restore'], check=False)
+    # Клиент Socket.IO отдаётся с нашего домена вместе с остальной статикой; без сети останется CDN
+    if not os.path.exists(os.path.join(base_dir, 'static', 'vendor', 'socket.io.min.js')):
+        subprocess.run([sys.executable, app_path, 'fetch-socketio'], check=False)
+    # Воркерам восстанавливать уже нечего
+    os.environ['FTP_RESTORE_ON_START'] = '0'
+
+def worker_exit(server, worker):
+    """При остановке воркера выгружаем на FTP несохранённые изменения."""
+    from app import final_sync
+    server.log.info("Final FTP sync before exit")
+    final_sync()
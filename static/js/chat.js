@@ -0,0 +1,218 @@
+var socket = io();
+var replyToId = null;
+var editMessageId = null;
+
+// new_message в MessagePack, если браузер умеет TextDecoder; сервер подтверждает кодировку событием encoding
+var packedFields = null;
+socket.on('connect', function() {
+    socket.emit('join', {chat_id: chatId, last_id: lastMessageId,
+                         encoding: window.TextDecoder ? 'msgpack' : 'json'});
+});
+socket.on('encoding', function(e) {
+    if (e.chat_id == chatId) packedFields = e.fields;
+});
+
+// «печатает…»: не чаще раза в 3 секунды, «перестал» — после 4 секунд тишины
+var typingSentAt = 0;
+var typingTimer = null;
+function notifyTyping() {
+    var now = Date.now();
+    if (now - typingSentAt > 3000) {
+        socket.emit('typing', {chat_id: chatId, typing: true});
+        typingSentAt = now;
+    }
+    clearTimeout(typingTimer);
+    typingTimer = setTimeout(stopTyping, 4000);
+}
+function stopTyping() {
+    clearTimeout(typingTimer);
+    if (typingSentAt) socket.emit('typing', {chat_id: chatId, typing: false});
+    typingSentAt = 0;
+}
+
+var statusText = document.getElementById('presence-status').innerText;
+socket.on('presence', function(p) {
+    if (p.chat_id != chatId) return;
+    if (otherUserId) {
+        if (p.online.indexOf(otherUserId) >= 0) statusText = 'в сети';
+        if (p.offline.indexOf(otherUserId) >= 0) statusText = 'был(а) в сети только что';
+    }
+    var typing = p.typing.filter(function(t) { return t.id != userId; });
+    var status = document.getElementById('presence-status');
+    if (typing.length == 1) status.innerText = typing[0].name + ' печатает…';
+    else if (typing.length > 1) status.innerText = typing.length + ' печатают…';
+    else status.innerText = statusText;
+});
+
+if (document.getElementById('send-btn')) {
+    document.getElementById('send-btn').onclick = sendMessage;
+    document.getElementById('message-input').onkeypress = function(e) {
+        if (e.key === 'Enter') sendMessage();
+    };
+    document.getElementById('message-input').oninput = notifyTyping;
+}
+
+function sendMessage() {
+    var input = document.getElementById('message-input');
+    var text = input.value.trim();
+    var fileInput = document.getElementById('file-upload');
+    // Сервер сам снимает «печатает…» при отправке
+    clearTimeout(typingTimer);
+    typingSentAt = 0;
+    if (editMessageId) {
+        fetch('/edit_message', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({message_id: editMessageId, content: text})
+        }).then(response => response.json())
+          .then(data => { if (data.success) location.reload(); else alert('Ошибка'); });
+        cancelEdit();
+        return;
+    }
+    if (text || fileInput.files.length > 0) {
+        if (fileInput.files.length > 0) {
+            var formData = new FormData();
+            formData.append('file', fileInput.files[0]);
+            formData.append('chat_id', chatId);
+            formData.append('content', text);
+            formData.append('reply_to', replyToId);
+            fetch('/upload', { method: 'POST', body: formData })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        socket.emit('send_message', {
+                            chat_id: chatId,
+                            content: text,
+                            file_path: data.file_path,
+                            file_name: data.file_name,
+                            file_type: data.file_type,
+                            sender_id: userId,
+                            reply_to: replyToId
+                        });
+                        input.value = '';
+                        fileInput.value = '';
+                        cancelReply();
+                    } else alert('Ошибка загрузки');
+                });
+        } else {
+            socket.emit('send_message', {
+                chat_id: chatId,
+                content: text,
+                sender_id: userId,
+                reply_to: replyToId
+            });
+            input.value = '';
+            cancelReply();
+        }
+    }
+}
+
+socket.on('new_message', appendMessage);
+socket.on('new_messages', function(messages) {
+    messages.forEach(appendMessage);
+});
+socket.on('new_message_packed', function(frame) {
+    if (!packedFields) return;
+    msgpackDecode(new Uint8Array(frame)).forEach(function(row) {
+        var data = {};
+        packedFields.forEach(function(field, i) { data[field] = row[i]; });
+        appendMessage(data);
+    });
+});
+socket.on('catch_up', function(data) {
+    if (data.chat_id != chatId) return;
+    if (!data.complete) { location.reload(); return; }
+    data.messages.forEach(appendMessage);
+});
+
+function appendMessage(data) {
+    // Пачки из окна рассылки и догрузка после переподключения могут прийти не по порядку:
+    // повтор узнаём по уже показанному id, а не по сравнению с последним
+    if (data.chat_id != chatId || document.getElementById('msg-' + data.id)) return;
+    lastMessageId = Math.max(lastMessageId, data.id);
+    var messagesDiv = document.getElementById('messages');
+    var msgDiv = document.createElement('div');
+    msgDiv.className = 'message ' + (data.sender_id == userId ? 'sent' : 'received');
+    msgDiv.id = 'msg-' + data.id;
+    msgDiv.setAttribute('data-id', data.id);
+    if (data.sender_id != userId) {
+        var senderDiv = document.createElement('div');
+        senderDiv.className = 'sender';
+        senderDiv.innerText = data.sender_name;
+        msgDiv.appendChild(senderDiv);
+    }
+    if (data.reply_to) {
+        var replyDiv = document.createElement('div');
+        replyDiv.className = 'reply-info';
+        replyDiv.innerText = 'В ответ на...';
+        msgDiv.appendChild(replyDiv);
+    }
+    var contentDiv = document.createElement('div');
+    contentDiv.innerText = data.content;
+    msgDiv.appendChild(contentDiv);
+    if (data.file_path) {
+        var fileDiv = document.createElement('div');
+        fileDiv.className = 'file-attachment';
+        var fileName = data.file_path.split('/').pop();
+        if (/\.(png|jpe?g|gif)$/i.test(fileName)) {
+            fileDiv.innerHTML = `<a href="/uploads/${fileName}" target="_blank"><img src="/uploads/thumb/${fileName}" class="file-thumb" loading="lazy"></a>`;
+        } else {
+            fileDiv.innerHTML = `<a href="/uploads/${fileName}" target="_blank">📎 ${data.file_name}</a>`;
+        }
+        msgDiv.appendChild(fileDiv);
+    }
+    var timeDiv = document.createElement('div');
+    timeDiv.className = 'time';
+    var sentAt = data.created_at ? new Date(data.created_at) : new Date();
+    timeDiv.innerText = sentAt.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+    msgDiv.appendChild(timeDiv);
+    var next = null;
+    for (var el = messagesDiv.lastElementChild; el && +el.getAttribute('data-id') > data.id; el = el.previousElementSibling) {
+        next = el;
+    }
+    messagesDiv.insertBefore(msgDiv, next);
+    messagesDiv.scrollTop = messagesDiv.scrollHeight;
+}
+
+function replyTo(msgId, preview) {
+    replyToId = msgId;
+    document.getElementById('reply-indicator').style.display = 'flex';
+    document.getElementById('reply-text').innerText = 'Ответ на: ' + preview;
+}
+function cancelReply() { replyToId = null; document.getElementById('reply-indicator').style.display = 'none'; }
+function editMessage(msgId, content) {
+    editMessageId = msgId;
+    document.getElementById('message-input').value = content;
+    document.getElementById('edit-indicator').style.display = 'flex';
+}
+function cancelEdit() {
+    editMessageId = null;
+    document.getElementById('edit-indicator').style.display = 'none';
+    document.getElementById('message-input').value = '';
+}
+function deleteMessage(msgId) {
+    if (confirm('Удалить сообщение?')) {
+        fetch('/delete_message', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId}) })
+            .then(response => response.json()).then(data => { if (data.success) location.reload(); });
+    }
+}
+function pinMessage(msgId) {
+    fetch('/pin_message', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId}) })
+        .then(response => response.json()).then(data => { if (data.success) location.reload(); });
+}
+function addReaction(msgId, emoji) {
+    fetch('/react', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId, reaction: emoji}) })
+        .then(response => response.json()).then(data => { if (data.success) location.reload(); });
+}
+function forward(msgId) {
+    var chatId = prompt('Введите ID чата для пересылки:');
+    if (chatId) {
+        fetch('/forward', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({message_id: msgId, to_chat_id: chatId}) })
+            .then(response => response.json()).then(data => { if (data.success) alert('Переслано'); else alert('Ошибка'); });
+    }
+}
+function showComments(msgId) { window.location.href = '/message/' + msgId + '/comments'; }
+function searchMessages() {
+    var query = document.getElementById('search-input').value;
+    if (query) window.location.href = '/chat/' + chatId + '/search?q=' + encodeURIComponent(query);
+}
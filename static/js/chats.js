@@ -0,0 +1,14 @@
+// Счётчики непрочитанных: сервер шлёт в личную комнату {chat_id, delta} о новом сообщении
+// и {chat_id, count: 0}, когда чат прочитан (в том числе в другой вкладке)
+var socket = io();
+
+socket.on('unread', function(data) {
+    var badge = document.getElementById('unread-' + data.chat_id);
+    if (!badge) {
+        // Новый для этой страницы чат — список обновится при следующем заходе
+        return;
+    }
+    var count = 'count' in data ? data.count : (parseInt(badge.innerText, 10) || 0) + data.delta;
+    badge.innerText = count;
+    badge.style.display = count > 0 ? '' : 'none';
+});
@@ -0,0 +1,25 @@
+function appendComment(c) {
+    var div = document.createElement('div');
+    div.className = 'comment';
+    var author = document.createElement('span'); author.className = 'author'; author.innerText = c.user_name;
+    var time = document.createElement('span'); time.className = 'time'; time.innerText = c.created_at;
+    var content = document.createElement('div'); content.className = 'content'; content.innerText = c.content;
+    div.appendChild(author); div.appendChild(time); div.appendChild(content);
+    document.getElementById('comments').appendChild(div);
+    lastId = c.id;
+}
+function loadMore() {
+    fetch('/message/' + messageId + '/comments.json?after=' + lastId)
+        .then(response => response.json())
+        .then(data => {
+            data.comments.forEach(appendComment);
+            hasMore = data.has_more;
+            document.getElementById('more').style.display = hasMore ? 'block' : 'none';
+        });
+}
+var socket = io();
+socket.on('connect', function() { socket.emit('join', {chat_id: roomChatId}); });
+socket.on('new_comment', function(c) {
+    // Новые комментарии дописываем, только когда все предыдущие уже загружены
+    if (c.message_id == messageId && !hasMore && c.id > lastId) appendComment(c);
+});
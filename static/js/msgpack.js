@@ -0,0 +1,67 @@
+// Минимальный декодер MessagePack для кадров new_message_packed: nil, bool, числа, строки,
+// двоичные данные, массивы и словари. Расширения (ext, timestamp) сервер не отправляет.
+function msgpackDecode(bytes) {
+    var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    var utf8 = new TextDecoder();
+    var pos = 0;
+
+    function str(length) {
+        var value = utf8.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return value;
+    }
+    function bin(length) {
+        var value = bytes.slice(pos, pos + length);
+        pos += length;
+        return value;
+    }
+    function array(length) {
+        var value = new Array(length);
+        for (var i = 0; i < length; i++) value[i] = read();
+        return value;
+    }
+    function map(length) {
+        var value = {};
+        for (var i = 0; i < length; i++) {
+            var key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+    function read() {
+        var type = bytes[pos++];
+        var value;
+        if (type < 0x80) return type;
+        if (type < 0x90) return map(type & 0x0f);
+        if (type < 0xa0) return array(type & 0x0f);
+        if (type < 0xc0) return str(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: value = bytes[pos]; pos += 1; return bin(value);
+            case 0xc5: value = view.getUint16(pos); pos += 2; return bin(value);
+            case 0xc6: value = view.getUint32(pos); pos += 4; return bin(value);
+            case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+            case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+            case 0xcc: value = bytes[pos]; pos += 1; return value;
+            case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+            case 0xce: value = view.getUint32(pos); pos += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+            case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+            case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+            case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+            case 0xd9: value = bytes[pos]; pos += 1; return str(value);
+            case 0xda: value = view.getUint16(pos); pos += 2; return str(value);
+            case 0xdb: value = view.getUint32(pos); pos += 4; return str(value);
+            case 0xdc: value = view.getUint16(pos); pos += 2; return array(value);
+            case 0xdd: value = view.getUint32(pos); pos += 4; return array(value);
+            case 0xde: value = view.getUint16(pos); pos += 2; return map(value);
+            case 0xdf: value = view.getUint32(pos); pos += 4; return map(value);
+        }
+        throw new Error('msgpack: unsupported type 0x' + type.toString(16));
+    }
+    return read();
+}
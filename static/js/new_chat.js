@@ -0,0 +1,7 @@
+function setType(type) {
+    document.getElementById('chat_type').value = type;
+    document.querySelectorAll('.type-btn').forEach(btn => btn.classList.remove('active'));
+    document.getElementById('btn-' + type).classList.add('active');
+    document.getElementById('private-fields').style.display = type === 'private' ? 'block' : 'none';
+    document.getElementById('group-fields').style.display = (type === 'group' || type === 'channel') ? 'block' : 'none';
+}
@@ -0,0 +1,8 @@
+document.getElementById('avatar').addEventListener('change', function(e) {
+    const file = e.target.files[0];
+    if (file) {
+        const reader = new FileReader();
+        reader.onload = function(e) { document.getElementById('preview').src = e.target.result; };
+        reader.readAsDataURL(file);
+    }
+});
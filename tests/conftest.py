@@ -0,0 +1,44 @@
+import os
+import sys
+import itertools
+from collections import namedtuple
+
+import pytest
+
+# Приложение собирается фабрикой на временной базе: без FTP, почты и фоновых потоков
+os.environ.setdefault('FTP_RESTORE_ON_START', '0')
+os.environ.setdefault('MAIL_QUEUE_WORKER', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as mateugram
+
+usernames = (f'user{i}' for i in itertools.count(1))
+Account = namedtuple('Account', ('client', 'id', 'username'))
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """Одно приложение на сессию: create_app() — синглтон процесса."""
+    root = tmp_path_factory.mktemp('mateugram')
+    return mateugram.create_app({
+        'TESTING': True,
+        'DATABASE_PATH': str(root / 'mateugram.db'),
+        'UPLOAD_FOLDER': str(root / 'uploads'),
+        'ARCHIVE_FOLDER': str(root / 'archive'),
+        # Быстрый хэш: тесты проверяют не KDF
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    }, restore=False, background=False)
+
+@pytest.fixture
+def register(app):
+    """Регистрирует нового пользователя и возвращает Account с залогиненным клиентом."""
+    def register():
+        username = next(usernames)
+        client = app.test_client()
+        response = client.post('/register', data={
+            'first_name': username.title(), 'last_name': '', 'username': username,
+            'email': f'{username}@example.com', 'password': 'pw', 'confirm_password': 'pw'})
+        assert response.status_code == 302
+        with app.app_context():
+            user_id = mateugram.User.query.filter_by(username=username).one().id
+        return Account(client, user_id, username)
+    return register
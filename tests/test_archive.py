@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as mateugram
+from test_memberships import create_group
+from test_messages import send_messages
+
+@pytest.fixture
+def old_chat(app, register, monkeypatch):
+    """Группа с пятью сообщениями месячной давности: реакции, комментарии и закреплённое первое."""
+    monkeypatch.setitem(app.config, 'CHAT_PAGE_SIZE', 2)
+    monkeypatch.setitem(app.config, 'ARCHIVE_SEGMENT_SIZE', 2)
+    owner, member = register(), register()
+    chat_id = create_group(owner, member)
+    socket = mateugram.socketio.test_client(app, flask_test_client=owner.client)
+    socket.emit('join', {'chat_id': chat_id})
+    ids = send_messages(app, socket, chat_id, 'раз', 'два', 'три', 'четыре', 'пять')
+    socket.disconnect()
+    owner.client.post('/pin_message', json={'message_id': ids[0]})
+    member.client.post('/react', json={'message_id': ids[1], 'reaction': '👍'})
+    owner.client.post('/react', json={'message_id': ids[3], 'reaction': '🔥'})
+    for content in ('первый', 'второй'):
+        member.client.post(f'/message/{ids[2]}/comments', data={'content': content})
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+        mateugram.db.session.execute(mateugram.db.update(mateugram.Message)
+                                     .where(mateugram.Message.chat_id == chat_id)
+                                     .values(created_at=datetime.utcnow() - timedelta(days=30)))
+        mateugram.db.session.commit()
+    return chat_id, owner, member, ids
+
+def history(account, chat_id):
+    """Вся история чата через API, страница за страницей: (id, реакции, число комментариев)."""
+    url = f'/api/v1/chats/{chat_id}/messages'
+    page = account.client.get(url).json
+    messages = page['messages']
+    while page['has_more']:
+        page = account.client.get(url, query_string={'before': messages[0]['id']}).json
+        messages = page['messages'] + messages
+    return [(m['id'], m['reactions'], m['comment_count']) for m in messages]
+
+def archive(app, days=7):
+    with app.app_context():
+        return mateugram.archive_old_messages(days)
+
+def hot_ids(app, chat_id):
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+        return [m.id for m in mateugram.Message.query.filter_by(chat_id=chat_id).order_by(mateugram.Message.id)]
+
+def test_archived_history_pages_the_same(app, old_chat):
+    chat_id, owner, member, ids = old_chat
+    before = history(owner, chat_id)
+    assert [row[0] for row in before] == ids
+    assert archive(app) == 4
+    assert history(owner, chat_id) == before
+    # Закреплённое сообщение остаётся в горячей базе, остальные ушли в сегменты
+    assert hot_ids(app, chat_id) == [ids[0]]
+    assert owner.client.get(f'/api/v1/chats/{chat_id}/messages').json['pinned']['id'] == ids[0]
+    with app.app_context():
+        segments = mateugram.ArchiveSegment.query.filter_by(chat_id=chat_id).order_by(mateugram.ArchiveSegment.first_id)
+        assert [(s.first_id, s.last_id) for s in segments] == [(ids[1], ids[2]), (ids[3], ids[4])]
+        assert mateugram.find_archived_message(ids[3]).reactions == [(owner.id, '🔥')]
+        assert mateugram.find_archived_message(ids[0]) is None
+    comments = owner.client.get(f'/api/v1/messages/{ids[2]}/comments').json
+    assert [c['content'] for c in comments['comments']] == ['первый', 'второй']
+    assert comments['comment_count'] == 2
+
+@pytest.mark.parametrize('table, values', [
+    ('reaction', {'reaction': '🎉'}),
+    ('comment', {'content': 'поздний'}),
+])
+def test_change_after_snapshot_rewrites_segment(app, old_chat, monkeypatch, capsys, table, values):
+    chat_id, owner, member, ids = old_chat
+    upload_segment = mateugram.upload_segment
+    landed = []
+
+    def upload_and_race(segment):
+        # Между снимком и удалением в базу пишет другой процесс — своим соединением
+        if not landed and segment.chat_id == chat_id:
+            with mateugram.shard_engine(mateugram.shard_of_chat(chat_id)).begin() as conn:
+                conn.execute(mateugram.db.metadata.tables[table].insert()
+                             .values(message_id=ids[1], user_id=member.id, **values))
+            landed.append(segment.filename)
+        return upload_segment(segment)
+    monkeypatch.setattr(mateugram, 'upload_segment', upload_and_race)
+    assert archive(app) == 4
+    assert f'Chat {chat_id} changed while archiving' in capsys.readouterr().out
+    with app.app_context():
+        message = next(m for m in mateugram.archived_page(chat_id, None, 10) if m.id == ids[1])
+        if table == 'reaction':
+            assert (member.id, '🎉') in message.reactions
+        else:
+            assert [c.content for c in message.comments] == ['поздний']
+        with mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+            # Ничего не осталось висеть в горячей базе без сообщения
+            assert not mateugram.Reaction.query.filter_by(message_id=ids[1]).count()
+            assert not mateugram.Comment.query.filter_by(message_id=ids[1]).count()
+
+def test_failed_upload_is_retried_next_run(app, old_chat, monkeypatch):
+    chat_id, owner, member, ids = old_chat
+    monkeypatch.setattr(mateugram, 'upload_segment', lambda segment: False)
+    archive(app)
+    with app.app_context():
+        pending = [s.filename for s in mateugram.ArchiveSegment.query.filter_by(chat_id=chat_id, uploaded=False)]
+    assert len(pending) == 2
+    uploaded = []
+
+    def upload(segment):
+        uploaded.append(segment.filename)
+        return True
+    monkeypatch.setattr(mateugram, 'upload_segment', upload)
+    assert archive(app) == 0
+    assert set(pending) <= set(uploaded)
+    with app.app_context():
+        assert not mateugram.ArchiveSegment.query.filter_by(chat_id=chat_id, uploaded=False).count()
+    # Уже выгруженные сегменты больше не трогаются
+    uploaded.clear()
+    archive(app)
+    assert not set(pending) & set(uploaded)
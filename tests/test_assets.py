@@ -0,0 +1,90 @@
+import gzip
+import hashlib
+import os
+import re
+import shutil
+
+import pytest
+
+import app as mateugram
+
+needs_brotli = pytest.mark.skipif(mateugram.brotli is None, reason='brotli is not installed')
+
+@pytest.fixture
+def static(app, tmp_path):
+    """Копия static/ во временной папке: тест может добавить и убрать файлы, не трогая репозиторий."""
+    folder = tmp_path / 'static'
+    shutil.copytree(app.static_folder, folder)
+    original = app.static_folder
+    app.static_folder = str(folder)
+    yield folder
+    app.static_folder = original
+    mateugram.build_assets()
+
+def test_assets_are_fingerprinted(app):
+    path = os.path.join(app.static_folder, 'css', 'chat.css')
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    assert mateugram.asset_url('css/chat.css') == f'/assets/css/chat.{digest}.css'
+    assert all(re.fullmatch(r'(css|js|vendor)/[\w.-]+\.[0-9a-f]{12}\.(css|js)', path) for path in mateugram.asset_paths)
+
+def test_changed_file_gets_new_name(app, static):
+    old = mateugram.asset_url('js/chat.js')
+    with open(static / 'js' / 'chat.js', 'a') as f:
+        f.write('\n// ещё строка\n')
+    mateugram.build_assets()
+    new = mateugram.asset_url('js/chat.js')
+    assert new != old
+    client = app.test_client()
+    assert client.get(old).status_code == 404
+    assert client.get(new).status_code == 200
+
+@pytest.mark.parametrize('accept, expected', [
+    pytest.param('gzip, br', 'br', marks=needs_brotli),
+    ('gzip', 'gzip'),
+    ('identity', None),
+])
+def test_precompressed_variant_is_chosen(app, accept, expected):
+    with open(os.path.join(app.static_folder, 'js', 'chat.js'), 'rb') as f:
+        source = f.read()
+    response = app.test_client().get(mateugram.asset_url('js/chat.js'), headers={'Accept-Encoding': accept})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == expected
+    body = response.get_data()
+    if expected == 'br':
+        body = mateugram.brotli.decompress(body)
+    elif expected == 'gzip':
+        body = gzip.decompress(body)
+    assert body == source
+    assert response.headers['Content-Type'] == 'application/javascript; charset=utf-8'
+
+def test_asset_cache_headers(app):
+    client = app.test_client()
+    url = mateugram.asset_url('css/chat.css')
+    digest = mateugram.assets['css/chat.css'].digest
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    # У каждого варианта свой сильный ETag: hook сжатия ответ не трогает
+    assert response.headers['ETag'] == f'"{digest}-gzip"'
+    assert client.get(url, headers={'Accept-Encoding': 'identity'}).headers['ETag'] == f'"{digest}-identity"'
+    repeat = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'"{digest}-gzip"'})
+    assert repeat.status_code == 304
+    assert client.get('/assets/css/chat.000000000000.css').status_code == 404
+
+def test_socketio_client_falls_back_to_cdn(app, register, static):
+    vendor = static / 'vendor'
+    shutil.rmtree(vendor, ignore_errors=True)
+    mateugram.build_assets()
+    assert mateugram.asset_url('socket.io.js') == mateugram.SOCKETIO_CLIENT_URL
+    account = register()
+    assert mateugram.SOCKETIO_CLIENT_URL in account.client.get('/chats').get_data(as_text=True)
+    # Локальная копия (python app.py fetch-socketio) отдаётся из /assets/ с хэшем
+    vendor.mkdir()
+    (vendor / 'socket.io.min.js').write_text('/* socket.io */' * 100)
+    mateugram.build_assets()
+    url = mateugram.asset_url('socket.io.js')
+    assert re.fullmatch(r'/assets/vendor/socket\.io\.min\.[0-9a-f]{12}\.js', url)
+    page = account.client.get('/chats').get_data(as_text=True)
+    assert url in page and mateugram.SOCKETIO_CLIENT_URL not in page
+    assert account.client.get(url).status_code == 200
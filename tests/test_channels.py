@@ -0,0 +1,84 @@
+import pytest
+
+import app as mateugram
+from test_memberships import create_group, role
+
+def chat_messages(app, chat_id):
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+        return [m.content for m in mateugram.Message.query.filter_by(chat_id=chat_id).order_by(mateugram.Message.id)]
+
+def comment_count(app, message_id):
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_message(message_id)):
+        return mateugram.Comment.query.filter_by(message_id=message_id).count()
+
+def open_socket(app, account, chat_id):
+    socket = mateugram.socketio.test_client(app, flask_test_client=account.client)
+    socket.emit('join', {'chat_id': chat_id})
+    socket.get_received()
+    return socket
+
+@pytest.fixture
+def channel(app, register):
+    """Канал с группой обсуждения: подписчик канала, участник обсуждения и посторонний."""
+    owner, subscriber, discussant, outsider = register(), register(), register(), register()
+    response = owner.client.post('/new-chat', data={'action': 'create', 'chat_type': 'channel', 'name': 'Канал'})
+    channel_id = int(response.headers['Location'].rstrip('/').split('/')[-1])
+    with app.app_context():
+        channel = mateugram.db.session.get(mateugram.Chat, channel_id)
+        group_id, group_token = channel.linked_group_id, channel.linked_group.invite_token
+        channel_token = channel.invite_token
+    subscriber.client.get(f'/join/{channel_token}')
+    discussant.client.get(f'/join/{group_token}')
+    assert role(app, subscriber.id, channel_id) == 'member'
+    assert role(app, discussant.id, group_id) == 'member'
+    owner_socket = open_socket(app, owner, channel_id)
+    owner_socket.emit('send_message', {'chat_id': channel_id, 'content': 'пост'})
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(channel_id)):
+        post_id = mateugram.Message.query.filter_by(chat_id=channel_id).one().id
+    yield owner, subscriber, discussant, outsider, channel_id, group_id, post_id
+    owner_socket.disconnect()
+
+def test_only_owner_and_admins_post_to_channel(app, channel):
+    owner, subscriber, discussant, outsider, channel_id, group_id, post_id = channel
+    subscriber_socket = open_socket(app, subscriber, channel_id)
+    subscriber_socket.emit('send_message', {'chat_id': channel_id, 'content': 'от подписчика'})
+    assert chat_messages(app, channel_id) == ['пост']
+    owner.client.get(f'/chat/{channel_id}/set_role/{subscriber.id}/admin')
+    subscriber_socket.emit('send_message', {'chat_id': channel_id, 'content': 'от администратора'})
+    assert chat_messages(app, channel_id) == ['пост', 'от администратора']
+    subscriber_socket.disconnect()
+
+def test_subscriber_cannot_forward_into_channel(app, register, channel):
+    owner, subscriber, discussant, outsider, channel_id, group_id, post_id = channel
+    friend = register()
+    chat_id = create_group(subscriber, friend)
+    socket = open_socket(app, subscriber, chat_id)
+    socket.emit('send_message', {'chat_id': chat_id, 'content': 'переслать'})
+    socket.disconnect()
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+        message_id = mateugram.Message.query.filter_by(chat_id=chat_id).one().id
+    response = subscriber.client.post('/forward', json={'message_id': message_id, 'to_chat_id': channel_id})
+    assert response.json == {'success': False}
+    assert chat_messages(app, channel_id) == ['пост']
+    # Пересылка в чат, где можно писать, работает
+    response = owner.client.post('/forward', json={'message_id': post_id, 'to_chat_id': group_id})
+    assert response.json == {'success': True}
+
+@pytest.mark.parametrize('who, allowed', [('subscriber', True), ('discussant', True), ('outsider', False)])
+def test_comment_permissions(app, channel, who, allowed):
+    owner, subscriber, discussant, outsider, channel_id, group_id, post_id = channel
+    account = {'subscriber': subscriber, 'discussant': discussant, 'outsider': outsider}[who]
+    account.client.post(f'/message/{post_id}/comments', data={'content': 'комментарий'})
+    assert comment_count(app, post_id) == (1 if allowed else 0)
+    response = account.client.get(f'/api/v1/messages/{post_id}/comments')
+    assert response.status_code == (200 if allowed else 403)
+
+def test_new_comment_reaches_channel_and_discussion(app, channel):
+    owner, subscriber, discussant, outsider, channel_id, group_id, post_id = channel
+    subscriber_socket = open_socket(app, subscriber, channel_id)
+    discussant_socket = open_socket(app, discussant, group_id)
+    discussant.client.post(f'/message/{post_id}/comments', data={'content': 'из обсуждения'})
+    for socket in (subscriber_socket, discussant_socket):
+        comments = [e['args'][0] for e in socket.get_received() if e['name'] == 'new_comment']
+        assert [(c['message_id'], c['content']) for c in comments] == [(post_id, 'из обсуждения')]
+        socket.disconnect()
@@ -0,0 +1,103 @@
+import gzip
+import os
+import zlib
+
+import pytest
+
+import app as mateugram
+
+needs_brotli = pytest.mark.skipif(mateugram.brotli is None, reason='brotli is not installed')
+PAGE = ('<li>сообщение</li>' * 200).encode()
+
+def compress(app, body, accept, mimetype='text/html', etag=None, stable=False):
+    """Ответ после after_request-хука сжатия для запроса с данным Accept-Encoding."""
+    with app.test_request_context(headers={'Accept-Encoding': accept}):
+        response = app.response_class(body, mimetype=mimetype)
+        if etag:
+            response.set_etag(*etag)
+        if stable:
+            mateugram.stable_response()
+        return mateugram.compress_response(response)
+
+def decode(data, encoding):
+    if encoding == 'br':
+        return mateugram.brotli.decompress(data)
+    return gzip.decompress(data) if encoding == 'gzip' else data
+
+@pytest.mark.parametrize('accept, expected', [
+    pytest.param('gzip, deflate, br', 'br', marks=needs_brotli),
+    pytest.param('br;q=0.1, gzip', 'br', marks=needs_brotli),
+    ('gzip, br;q=0', 'gzip'),
+    ('gzip', 'gzip'),
+    ('identity', None),
+    ('', None),
+])
+def test_encoding_is_negotiated(app, accept, expected):
+    response = compress(app, PAGE, accept)
+    assert response.headers.get('Content-Encoding') == expected
+    assert decode(response.get_data(), expected) == PAGE
+    # Кэши по пути должны различать варианты, даже если этот ответ отдан как есть
+    assert 'Accept-Encoding' in response.vary
+
+def test_small_response_is_not_compressed(app):
+    size = app.config['COMPRESS_MIN_SIZE']
+    assert 'Content-Encoding' not in compress(app, b'a' * (size - 1), 'gzip').headers
+    assert compress(app, b'a' * size, 'gzip').headers['Content-Encoding'] == 'gzip'
+
+def test_incompressible_response_is_sent_as_is(app):
+    body = os.urandom(4096)
+    response = compress(app, body, 'gzip', mimetype='text/plain')
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == body
+
+@pytest.mark.parametrize('mimetype', ['image/png', 'application/octet-stream'])
+def test_binary_types_are_skipped(app, mimetype):
+    assert 'Content-Encoding' not in compress(app, PAGE, 'gzip', mimetype=mimetype).headers
+
+def test_strong_etag_becomes_weak(app):
+    assert compress(app, PAGE, 'gzip', etag=('abc',)).headers['ETag'] == 'W/"abc"'
+    assert compress(app, PAGE, 'gzip', etag=('abc', True)).headers['ETag'] == 'W/"abc"'
+    # Тело не менялось — сильный ETag остаётся сильным
+    assert compress(app, PAGE, 'identity', etag=('abc',)).headers['ETag'] == '"abc"'
+
+def test_stable_response_is_compressed_once(app, monkeypatch):
+    mateugram.compressed_cache.clear()
+    calls = []
+    compress_bytes = mateugram.compress_bytes
+    monkeypatch.setattr(mateugram, 'compress_bytes',
+                        lambda data, encoding: calls.append(encoding) or compress_bytes(data, encoding))
+    first = compress(app, PAGE, 'gzip', stable=True).get_data()
+    assert compress(app, PAGE, 'gzip', stable=True).get_data() == first
+    assert calls == ['gzip']
+    # Другая кодировка и другое тело — другие ключи, обычный ответ не кэшируется вовсе
+    compress(app, PAGE + b'!', 'gzip', stable=True)
+    compress(app, PAGE, 'gzip')
+    compress(app, PAGE, 'gzip')
+    assert calls == ['gzip'] * 4
+    assert mateugram.compressed_cache.stats()['size'] == 2
+
+@pytest.mark.parametrize('encoding', [pytest.param('br', marks=needs_brotli), 'gzip'])
+def test_stream_is_flushed_after_every_chunk(app, encoding):
+    chunks = ['<li>первый</li>' * 50, '', '<li>второй</li>', b'<li>third</li>']
+    with app.test_request_context(headers={'Accept-Encoding': encoding}):
+        response = app.response_class(iter(chunks), mimetype='text/html')
+        response.headers['Content-Length'] = '1000'
+        response = mateugram.compress_response(response)
+        assert response.headers['Content-Encoding'] == encoding
+        assert 'Content-Length' not in response.headers
+        if encoding == 'br':
+            decompress = mateugram.brotli.Decompressor().process
+        else:
+            decompress = zlib.decompressobj(31).decompress
+        parts = list(response.response)
+    # Каждый кусок распаковывается сразу, не дожидаясь следующих
+    expected = [c.encode() if isinstance(c, str) else c for c in chunks if c]
+    assert [decompress(part) for part in parts[:-1]] == expected
+    assert decompress(parts[-1]) == b''
+
+def test_streaming_can_be_turned_off(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'COMPRESS_STREAMING', False)
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = mateugram.compress_response(app.response_class(iter([PAGE]), mimetype='text/html'))
+        assert 'Content-Encoding' not in response.headers
+        assert b''.join(response.response) == PAGE
@@ -0,0 +1,95 @@
+import io
+import time
+from concurrent.futures import Future
+
+from PIL import Image
+
+import app as mateugram
+
+def save_image(app, name, size=(1200, 900)):
+    path = f"{app.config['UPLOAD_FOLDER']}/{name}"
+    Image.new('RGB', size, (200, 30, 30)).save(path, format='JPEG')
+    return path
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+def test_enqueue_creates_variant(app):
+    path = save_image(app, 'enqueue.jpg')
+    future = mateugram.enqueue_image_processing('enqueue.jpg', ['thumb'])
+    assert future.result(timeout=60) == path
+    with Image.open(mateugram.variant_filename(path, 'thumb')) as thumb:
+        assert max(thumb.size) == 480
+
+def test_enqueue_skips_non_images(app):
+    assert mateugram.enqueue_image_processing('notes.pdf', ['thumb']) is None
+
+def test_enqueue_without_pillow(app, monkeypatch):
+    save_image(app, 'nopillow.jpg')
+    monkeypatch.setattr(mateugram, 'Image', None)
+    assert mateugram.enqueue_image_processing('nopillow.jpg', ['thumb']) is None
+
+def test_processed_callback_runs_in_app_task(app, monkeypatch):
+    synced = []
+    monkeypatch.setattr(mateugram, 'request_sync', lambda: synced.append(True))
+    save_image(app, 'callback.jpg')
+    mateugram.enqueue_image_processing('callback.jpg', ['avatar']).result(timeout=60)
+    wait_for(lambda: synced)
+
+def test_processed_callback_reports_errors(app, monkeypatch, capsys):
+    synced = []
+    monkeypatch.setattr(mateugram, 'request_sync', lambda: synced.append(True))
+    future = Future()
+    future.set_exception(OSError('broken image'))
+    mateugram.on_image_processed(future)
+    assert not synced
+    assert 'broken image' in capsys.readouterr().out
+
+def test_variant_falls_back_to_original(app):
+    path = save_image(app, 'fallback.jpg')
+    with open(path, 'rb') as f:
+        original = f.read()
+    client = app.test_client()
+    response = client.get('/uploads/thumb/fallback.jpg')
+    assert response.status_code == 200 and response.data == original
+    mateugram.enqueue_image_processing('fallback.jpg', ['thumb']).result(timeout=60)
+    response = client.get('/uploads/thumb/fallback.jpg')
+    assert response.status_code == 200 and response.data != original
+    with Image.open(io.BytesIO(response.data)) as thumb:
+        assert max(thumb.size) == 480
+
+def test_reuploaded_avatar_gets_new_name(app, register):
+    client, user_id, _ = register()
+    names = []
+    for _ in range(2):
+        data = io.BytesIO()
+        Image.new('RGB', (300, 300)).save(data, format='PNG')
+        data.seek(0)
+        client.post('/setup_profile', data={'avatar': (data, 'me.png')}, content_type='multipart/form-data')
+        with app.app_context():
+            names.append(mateugram.db.session.get(mateugram.User, user_id).avatar)
+    assert names[0] != names[1]
+
+def test_exif_is_stripped_and_orientation_applied(app):
+    # Снимок «на боку»: слева красное, справа синее, Orientation=6 (повернуть на 90° по часовой) и GPS
+    img = Image.new('RGB', (400, 200), (255, 0, 0))
+    img.paste((0, 0, 255), (200, 0, 400, 200))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    exif.get_ifd(0x8825)[2] = (55.0, 45.0, 0.0)
+    path = f"{app.config['UPLOAD_FOLDER']}/exif.jpg"
+    img.save(path, format='JPEG', exif=exif.tobytes())
+    mateugram.enqueue_image_processing('exif.jpg', ['avatar', 'thumb']).result(timeout=60)
+    for name in (path, mateugram.variant_filename(path, 'thumb'), mateugram.variant_filename(path, 'avatar')):
+        with Image.open(name) as result:
+            assert 'exif' not in result.info and not dict(result.getexif()), name
+    # После поворота красное сверху, синее снизу
+    with Image.open(mateugram.variant_filename(path, 'thumb')) as thumb:
+        assert thumb.size == (200, 400)
+        assert thumb.getpixel((100, 20))[0] > 200 and thumb.getpixel((100, 380))[2] > 200
+    with Image.open(mateugram.variant_filename(path, 'avatar')) as avatar:
+        assert avatar.size == (160, 160)
+        assert avatar.getpixel((80, 10))[0] > 200 and avatar.getpixel((80, 150))[2] > 200
@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+import app as mateugram
+
+@pytest.mark.parametrize('stored, configured', [
+    ('scrypt:32768:8:1', 'scrypt'),
+    ('pbkdf2:sha256:600000', 'pbkdf2'),
+    ('pbkdf2:sha256:600000', 'pbkdf2:sha256'),
+    ('pbkdf2:sha256:1000', 'pbkdf2:sha256:1000'),
+])
+def test_short_method_does_not_rehash(monkeypatch, stored, configured):
+    monkeypatch.setitem(mateugram.app.config, 'PASSWORD_HASH_METHOD', configured)
+    assert not mateugram.password_hasher.needs_rehash(f'{stored}$salt$hash')
+
+@pytest.mark.parametrize('stored, configured', [
+    ('pbkdf2:sha256:260000', 'pbkdf2'),
+    ('pbkdf2:sha256:600000', 'scrypt'),
+    ('scrypt:16384:8:1', 'scrypt'),
+    ('pbkdf2:sha512:600000', 'pbkdf2:sha256:600000'),
+])
+def test_changed_method_rehashes(monkeypatch, stored, configured):
+    monkeypatch.setitem(mateugram.app.config, 'PASSWORD_HASH_METHOD', configured)
+    assert mateugram.password_hasher.needs_rehash(f'{stored}$salt$hash')
+
+def test_failure_counter_is_atomic():
+    cache = mateugram.LRUCache(100, 60)
+    threads = [threading.Thread(target=lambda: [cache.incr('key') for _ in range(1000)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.get('key') == 8000
+
+def test_ip_limit_uses_forwarded_client_address(app, register, monkeypatch):
+    monkeypatch.setitem(app.config, 'LOGIN_MAX_FAILURES', 100)
+    monkeypatch.setitem(app.config, 'LOGIN_MAX_FAILURES_PER_IP', 3)
+    account = register()
+    client = app.test_client()
+
+    def login(ip, password):
+        return client.post('/login', data={'username': account.username, 'password': password},
+                           headers={'X-Forwarded-For': ip})
+
+    for _ in range(3):
+        assert login('203.0.113.7', 'wrong').status_code == 200
+    assert login('203.0.113.7', 'pw').status_code == 429
+    # За тем же прокси другой клиент входит как обычно
+    assert login('198.51.100.20', 'pw').status_code == 302
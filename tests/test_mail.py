@@ -0,0 +1,164 @@
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as mateugram
+
+aiosmtpd = pytest.importorskip('aiosmtpd.controller')
+
+class Handler:
+    """SMTP-сервер в процессе: запоминает письма и соединения, по заказу отвечает ошибкой."""
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+        self.data_reply = None    # например, '451 Try again later'
+        self.refused = set()      # получатели, которых сервер отвергает
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 No such user'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.data_reply:
+            return self.data_reply
+        self.sessions.add(id(session))
+        self.messages.append((time.monotonic(), envelope.rcpt_tos[0], envelope.content.decode()))
+        return '250 Message accepted'
+
+@pytest.fixture
+def smtp(app, monkeypatch):
+    handler = Handler()
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    controller = aiosmtpd.Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    state = app.extensions['mail']
+    for name, value in {'server': '127.0.0.1', 'port': port,
+                        'use_ssl': False, 'use_tls': False, 'username': None, 'password': None,
+                        'suppress': False, 'default_sender': 'noreply@mateugram.test'}.items():
+        monkeypatch.setattr(state, name, value)
+    monkeypatch.setitem(app.config, 'MAIL_RATE_PER_MINUTE', 6000)
+    with app.app_context():
+        mateugram.OutboundMail.query.delete()
+        mateugram.db.session.commit()
+    yield handler
+    controller.stop()
+
+def queue_mail(app, *recipients):
+    with app.app_context():
+        for recipient in recipients:
+            mateugram.enqueue_mail(recipient, 'Тема', f'Письмо для {recipient}')
+        mateugram.db.session.commit()
+
+def deliver(app):
+    """Один проход воркера: захват пачки и отправка."""
+    with app.app_context():
+        batch = mateugram.claim_mail_batch()
+        if batch:
+            mateugram.send_mail_batch(batch)
+        return len(batch)
+
+def mail_rows(app):
+    with app.app_context():
+        return {m.recipient: (m.status, m.attempts) for m in mateugram.OutboundMail.query}
+
+def test_signup_queues_mail_and_wakes_worker(app, smtp, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_ON_REGISTER', True)
+    mateugram.mail_wakeup.clear()
+    client = app.test_client()
+    response = client.post('/register', data={
+        'first_name': 'Почта', 'last_name': '', 'username': 'mailuser', 'email': 'mailuser@example.com',
+        'password': 'pw', 'confirm_password': 'pw'})
+    assert response.status_code == 302
+    # Запрос ничего не отправил сам: письмо ждёт воркера, а воркер разбужен коммитом
+    assert smtp.messages == []
+    assert mail_rows(app) == {'mailuser@example.com': ('pending', 0)}
+    assert mateugram.mail_wakeup.is_set()
+    assert deliver(app) == 1
+    assert [rcpt for _, rcpt, _ in smtp.messages] == ['mailuser@example.com']
+
+def test_batch_goes_through_one_connection_with_pacing(app, smtp, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_RATE_PER_MINUTE', 600)
+    recipients = [f'reader{i}@example.com' for i in range(3)]
+    queue_mail(app, *recipients)
+    assert deliver(app) == 3
+    assert sorted(rcpt for _, rcpt, _ in smtp.messages) == recipients
+    assert len(smtp.sessions) == 1
+    times = [t for t, _, _ in smtp.messages]
+    # 600 писем в минуту — не чаще раза в 0.1 с
+    assert all(b - a >= 0.09 for a, b in zip(times, times[1:]))
+    assert set(mail_rows(app).values()) == {('sent', 0)}
+
+def test_failed_delivery_is_retried_with_backoff(app, smtp):
+    queue_mail(app, 'retry@example.com')
+    smtp.data_reply = '451 Try again later'
+    assert deliver(app) == 1
+    assert mail_rows(app) == {'retry@example.com': ('pending', 1)}
+    with app.app_context():
+        item = mateugram.OutboundMail.query.one()
+        delay = (item.next_attempt_at - datetime.utcnow()).total_seconds()
+        assert 0.7 * app.config['MAIL_RETRY_DELAY'] < delay <= 1.2 * app.config['MAIL_RETRY_DELAY']
+    # До срока повтора письмо не захватывается
+    assert deliver(app) == 0
+    smtp.data_reply = None
+    with app.app_context():
+        mateugram.OutboundMail.query.update({'next_attempt_at': datetime.utcnow()})
+        mateugram.db.session.commit()
+    assert deliver(app) == 1
+    assert mail_rows(app) == {'retry@example.com': ('sent', 1)}
+
+def test_gives_up_after_max_attempts(app, smtp, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_MAX_ATTEMPTS', 2)
+    queue_mail(app, 'broken@example.com')
+    smtp.data_reply = '451 Try again later'
+    for _ in range(2):
+        with app.app_context():
+            mateugram.OutboundMail.query.update({'next_attempt_at': datetime.utcnow()})
+            mateugram.db.session.commit()
+        deliver(app)
+    assert mail_rows(app) == {'broken@example.com': ('failed', 2)}
+
+def test_refused_recipient_fails_at_once(app, smtp):
+    smtp.refused.add('nobody@example.com')
+    queue_mail(app, 'nobody@example.com', 'somebody@example.com')
+    assert deliver(app) == 2
+    assert mail_rows(app) == {'nobody@example.com': ('failed', 1), 'somebody@example.com': ('sent', 0)}
+
+def test_two_workers_never_claim_the_same_mail(app, smtp, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_BATCH_SIZE', 5)
+    queue_mail(app, *[f'user{i}@example.com' for i in range(20)])
+    claimed = []
+    barrier = threading.Barrier(4)
+
+    def worker():
+        barrier.wait()
+        with app.app_context():
+            while batch := mateugram.claim_mail_batch():
+                claimed.extend(item.id for item in batch)
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(claimed) == len(set(claimed)) == 20
+
+def test_expired_lease_is_claimed_again(app, smtp):
+    queue_mail(app, 'lost@example.com')
+    with app.app_context():
+        first = mateugram.claim_mail_batch()
+        token = first[0].claim
+        # Воркер с арендой «упал»: пока аренда не истекла, письмо не трогают
+        assert mateugram.claim_mail_batch() == []
+        mateugram.OutboundMail.query.update({'next_attempt_at': datetime.utcnow() - timedelta(seconds=1)})
+        mateugram.db.session.commit()
+        again = mateugram.claim_mail_batch()
+        assert [item.id for item in again] == [first[0].id]
+        assert again[0].claim != token
+        mateugram.send_mail_batch(again)
+    assert mail_rows(app) == {'lost@example.com': ('sent', 0)}
@@ -0,0 +1,132 @@
+import pytest
+
+import app as mateugram
+
+def create_group(owner, *members):
+    response = owner.client.post('/new-chat', data={'action': 'create', 'chat_type': 'group', 'name': 'Группа'})
+    chat_id = int(response.headers['Location'].rstrip('/').split('/')[-1])
+    for member in members:
+        owner.client.post(f'/chat/{chat_id}/add_member', data={'username': member.username})
+    return chat_id
+
+def role(app, user_id, chat_id):
+    """Роль через кэш членства — так её видят все проверки прав."""
+    with app.app_context():
+        membership = mateugram.get_membership(user_id, chat_id)
+        return membership.role if membership else None
+
+@pytest.fixture
+def group(app, register):
+    owner, member = register(), register()
+    chat_id = create_group(owner, member)
+    # Прогреваем кэш: устаревшая роль могла бы пережить изменение только оттуда
+    assert role(app, owner.id, chat_id) == 'owner'
+    assert role(app, member.id, chat_id) == 'member'
+    return owner, member, chat_id
+
+def test_promote(app, group):
+    owner, member, chat_id = group
+    owner.client.get(f'/chat/{chat_id}/set_role/{member.id}/admin')
+    assert role(app, member.id, chat_id) == 'admin'
+
+def test_demote(app, register, group):
+    owner, member, chat_id = group
+    other = register()
+    owner.client.post(f'/chat/{chat_id}/add_member', data={'username': other.username})
+    owner.client.get(f'/chat/{chat_id}/set_role/{member.id}/admin')
+    assert role(app, member.id, chat_id) == 'admin'
+    owner.client.get(f'/chat/{chat_id}/set_role/{member.id}/member')
+    assert role(app, member.id, chat_id) == 'member'
+    # Бывший администратор больше не может удалять участников
+    member.client.get(f'/chat/{chat_id}/remove/{other.id}')
+    assert role(app, other.id, chat_id) == 'member'
+
+def test_remove(app, group):
+    owner, member, chat_id = group
+    owner.client.get(f'/chat/{chat_id}/remove/{member.id}')
+    assert role(app, member.id, chat_id) is None
+    with app.app_context():
+        assert chat_id not in mateugram.get_user_chat_ids(member.id)
+        assert member.id not in mateugram.get_chat_member_ids(chat_id)
+    assert member.client.get(f'/chat/{chat_id}').status_code == 302
+
+def test_leave(app, group):
+    owner, member, chat_id = group
+    member.client.get(f'/chat/{chat_id}/leave')
+    assert role(app, member.id, chat_id) is None
+    with app.app_context():
+        assert chat_id not in mateugram.get_user_chat_ids(member.id)
+    assert member.client.get(f'/chat/{chat_id}').status_code == 302
+
+def test_ban_blocks_posting(app, group):
+    # Отдельного бана нет: администратор исключает участника, и тот сразу теряет право писать
+    owner, member, chat_id = group
+    socket = mateugram.socketio.test_client(app, flask_test_client=member.client)
+    socket.emit('send_message', {'chat_id': chat_id, 'content': 'до'})
+    owner.client.get(f'/chat/{chat_id}/set_role/{member.id}/admin')
+    owner.client.get(f'/chat/{chat_id}/remove/{member.id}')
+    assert role(app, member.id, chat_id) is None
+    socket.emit('send_message', {'chat_id': chat_id, 'content': 'после'})
+    socket.disconnect()
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+        contents = [m.content for m in mateugram.Message.query.filter_by(chat_id=chat_id)]
+    assert contents == ['до']
+
+def test_rejoin_after_remove(app, group):
+    owner, member, chat_id = group
+    owner.client.get(f'/chat/{chat_id}/remove/{member.id}')
+    assert role(app, member.id, chat_id) is None
+    owner.client.post(f'/chat/{chat_id}/add_member', data={'username': member.username})
+    assert role(app, member.id, chat_id) == 'member'
+
+def open_private_chat(account, other):
+    response = account.client.post('/new-chat', data={'action': 'create', 'chat_type': 'private', 'username': other.username})
+    return int(response.headers['Location'].rstrip('/').split('/')[-1])
+
+@pytest.mark.parametrize('how', ['leave', 'remove'])
+def test_private_chat_after_leaving_starts_fresh(app, register, how):
+    alice, bob = register(), register()
+    chat_id = open_private_chat(alice, bob)
+    assert open_private_chat(bob, alice) == chat_id
+    if how == 'leave':
+        bob.client.get(f'/chat/{chat_id}/leave')
+    else:
+        alice.client.get(f'/chat/{chat_id}/remove/{bob.id}')
+    new_chat_id = open_private_chat(bob, alice)
+    assert new_chat_id != chat_id
+    assert role(app, bob.id, new_chat_id) and role(app, alice.id, new_chat_id)
+    assert bob.client.get(f'/chat/{new_chat_id}').status_code == 200
+
+def test_backfill_marks_unpaired_chats_once(app, register):
+    alice, bob = register(), register()
+    with app.app_context():
+        chats = [mateugram.Chat(is_group=False, is_channel=False, created_by=alice.id) for _ in range(2)]
+        mateugram.db.session.add_all(chats)
+        mateugram.db.session.flush()
+        for chat in chats:
+            mateugram.db.session.add_all([mateugram.ChatMember(user_id=alice.id, chat_id=chat.id, role='owner'),
+                                          mateugram.ChatMember(user_id=bob.id, chat_id=chat.id, role='member')])
+        mateugram.db.session.commit()
+        first, duplicate = chats[0].id, chats[1].id
+        mateugram.backfill_private_keys()
+        keys = dict(mateugram.db.session.query(mateugram.Chat.id, mateugram.Chat.private_key)
+                    .filter(mateugram.Chat.id.in_([first, duplicate])))
+        assert keys == {first: mateugram.private_chat_key(alice.id, bob.id),
+                        duplicate: mateugram.unpaired_chat_key(duplicate)}
+        assert not mateugram.Chat.query.filter(mateugram.Chat.is_group == False, mateugram.Chat.is_channel == False,
+                                               mateugram.Chat.private_key.is_(None)).count()
+
+@pytest.mark.parametrize('body', [['user1'], {'usernames': 'abc'}, {'usernames': [1, 2]}, {}])
+def test_add_members_rejects_malformed_json(app, register, body):
+    owner = register()
+    chat_id = create_group(owner)
+    response = owner.client.post(f'/chat/{chat_id}/add_members', json=body)
+    assert response.status_code == 400 and not response.json['success']
+
+def test_add_members_json_report(app, register):
+    owner, member = register(), register()
+    chat_id = create_group(owner)
+    response = owner.client.post(f'/chat/{chat_id}/add_members',
+                                 json={'usernames': [f'@{member.username}', 'nobody', member.username]})
+    assert [row['status'] for row in response.json['report']] == ['added', 'not_found', 'duplicate']
+    assert role(app, member.id, chat_id) == 'member'
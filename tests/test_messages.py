@@ -0,0 +1,154 @@
+import pytest
+
+import app as mateugram
+from test_memberships import create_group
+
+@pytest.fixture
+def chat(app, register):
+    """Группа из двух участников, оба с открытыми сокетами в чате."""
+    owner, member = register(), register()
+    chat_id = create_group(owner, member)
+    sockets = []
+    for account in (owner, member):
+        socket = mateugram.socketio.test_client(app, flask_test_client=account.client)
+        socket.emit('join', {'chat_id': chat_id})
+        socket.get_received()
+        sockets.append(socket)
+    yield chat_id, owner, member, sockets
+    for socket in sockets:
+        socket.disconnect()
+
+def received_messages(socket):
+    """Все new_message / new_messages, пришедшие сокету, по одному словарю на сообщение."""
+    payloads = []
+    for event in socket.get_received():
+        if event['name'] == 'new_message':
+            payloads.append(event['args'][0])
+        elif event['name'] == 'new_messages':
+            payloads.extend(event['args'][0])
+    return payloads
+
+def test_string_chat_id_is_the_same_chat(app, chat, monkeypatch):
+    monkeypatch.setitem(app.config, 'MESSAGE_BATCH_WINDOW', 0)
+    monkeypatch.setattr(mateugram.message_fanout, 'window', 0)
+    chat_id, owner, member, (owner_socket, member_socket) = chat
+    owner_socket.emit('send_message', {'chat_id': str(chat_id), 'content': 'строкой'})
+    owner_socket.emit('send_message', {'chat_id': chat_id, 'content': 'числом'})
+    payloads = received_messages(member_socket)
+    assert [p['content'] for p in payloads] == ['строкой', 'числом']
+    # Права проверялись по тому же ключу кэша, что и у всех остальных обработчиков
+    assert mateugram.membership_cache.get((owner.id, str(chat_id))) is None
+
+@pytest.mark.parametrize('limit, expected', [(0, 1), (-5, 1), (2, 2), (10 ** 6, 3)])
+def test_comments_limit_is_clamped(app, chat, limit, expected):
+    chat_id, owner, member, (owner_socket, member_socket) = chat
+    owner_socket.emit('send_message', {'chat_id': chat_id, 'content': 'пост'})
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+        message_id = mateugram.Message.query.filter_by(chat_id=chat_id).one().id
+    for i in range(3):
+        member.client.post(f'/message/{message_id}/comments', data={'content': f'комментарий {i}'})
+    for url in (f'/message/{message_id}/comments.json', f'/api/v1/messages/{message_id}/comments'):
+        response = owner.client.get(url, query_string={'limit': limit})
+        assert len(response.json['comments']) == expected
+        assert response.json['has_more'] == (expected < 3)
+
+def catch_up(app, account, chat_id, last_id):
+    """Переподключение с last_id: сообщения события catch_up."""
+    socket = mateugram.socketio.test_client(app, flask_test_client=account.client)
+    socket.emit('join', {'chat_id': chat_id, 'last_id': last_id})
+    events = [e['args'][0] for e in socket.get_received() if e['name'] == 'catch_up']
+    socket.disconnect()
+    assert len(events) == 1 and events[0]['complete']
+    return events[0]['messages']
+
+def send_messages(app, socket, chat_id, *contents):
+    for content in contents:
+        socket.emit('send_message', {'chat_id': chat_id, 'content': content})
+    with app.app_context(), mateugram.shard_scope(mateugram.shard_of_chat(chat_id)):
+        return [m.id for m in mateugram.Message.query.filter_by(chat_id=chat_id).order_by(mateugram.Message.id)]
+
+def test_catch_up_sees_edits_and_deletes(app, chat):
+    chat_id, owner, member, (owner_socket, member_socket) = chat
+    first, second, third = send_messages(app, owner_socket, chat_id, 'раз', 'два', 'три')
+    assert [m['content'] for m in catch_up(app, member, chat_id, first)] == ['два', 'три']
+    owner.client.post('/edit_message', json={'message_id': second, 'content': 'два!'})
+    owner.client.post('/delete_message', json={'message_id': third})
+    assert [m['content'] for m in catch_up(app, member, chat_id, first)] == ['два!']
+
+def test_room_buffer_is_off_with_message_queue(app, chat, monkeypatch):
+    monkeypatch.setattr(mateugram.room_buffer, 'enabled', False)
+    chat_id, owner, member, (owner_socket, member_socket) = chat
+    first, second = send_messages(app, owner_socket, chat_id, 'раз', 'два')
+    assert mateugram.room_buffer.since(chat_id, first) is None
+    # Догрузка идёт из базы, где есть и сообщения других воркеров
+    assert [m['id'] for m in catch_up(app, member, chat_id, first)] == [second]
+
+def test_reaction_on_old_pinned_message_refreshes_cached_page(app, chat, monkeypatch):
+    monkeypatch.setattr(mateugram.recent_messages, 'per_chat', 2)
+    monkeypatch.setitem(app.config, 'CHAT_PAGE_SIZE', 2)
+    chat_id, owner, member, (owner_socket, member_socket) = chat
+    pinned_id, *_ = send_messages(app, owner_socket, chat_id, 'закреп', 'два', 'три', 'четыре')
+    owner.client.post('/pin_message', json={'message_id': pinned_id})
+    url = f'/api/v1/chats/{chat_id}/messages'
+    page = owner.client.get(url).json
+    assert page['pinned']['id'] == pinned_id
+    assert pinned_id not in [m['id'] for m in page['messages']]
+    member.client.post('/react', json={'message_id': pinned_id, 'reaction': '👍'})
+    assert owner.client.get(url).json['pinned']['reactions'] == [[member.id, '👍']]
+
+def test_batched_messages_share_one_flusher(app, register, monkeypatch):
+    monkeypatch.setattr(mateugram.message_fanout, 'window', 0.05)
+    monkeypatch.setattr(mateugram.message_fanout, 'flusher', None)
+    started = []
+    start_background_task = mateugram.start_background_task
+
+    def counting_start(target, *args):
+        started.append(target)
+        return start_background_task(target, *args)
+    monkeypatch.setattr(mateugram, 'start_background_task', counting_start)
+    chats = []
+    for _ in range(3):
+        owner, member = register(), register()
+        chat_id = create_group(owner, member)
+        sockets = []
+        for account in (owner, member):
+            socket = mateugram.socketio.test_client(app, flask_test_client=account.client)
+            socket.emit('join', {'chat_id': chat_id})
+            socket.get_received()
+            sockets.append(socket)
+        chats.append((chat_id, sockets))
+    for chat_id, (owner_socket, member_socket) in chats:
+        for i in range(3):
+            owner_socket.emit('send_message', {'chat_id': chat_id, 'content': f'сообщение {i}'})
+    mateugram.time.sleep(0.3)
+    assert len(started) == 1
+    for chat_id, (owner_socket, member_socket) in chats:
+        assert [p['content'] for p in received_messages(member_socket)] == [f'сообщение {i}' for i in range(3)]
+        for socket in (owner_socket, member_socket):
+            socket.disconnect()
+
+def test_fanout_emits_without_local_sockets_when_queue_is_shared(app, monkeypatch):
+    emitted = []
+    monkeypatch.setattr(mateugram.socketio, 'emit', lambda event, data, room: emitted.append(room))
+    mateugram.message_fanout.send(10 ** 9, [{'id': 1}])
+    assert emitted == []
+    monkeypatch.setitem(app.config, 'SOCKETIO_MESSAGE_QUEUE', 'redis://queue')
+    monkeypatch.setattr(mateugram.message_fanout, 'packing', False)
+    mateugram.message_fanout.send(10 ** 9, [{'id': 1}])
+    assert emitted == [f'json_{10 ** 9}']
+
+def test_encoding_arrives_before_anything_else(app, register):
+    owner, member = register(), register()
+    chat_id = create_group(owner, member)
+    owner_socket = mateugram.socketio.test_client(app, flask_test_client=owner.client)
+    owner_socket.emit('join', {'chat_id': chat_id})
+    owner_socket.emit('send_message', {'chat_id': chat_id, 'content': 'до входа'})
+    member_socket = mateugram.socketio.test_client(app, flask_test_client=member.client)
+    member_socket.get_received()
+    member_socket.emit('join', {'chat_id': chat_id, 'encoding': 'msgpack'})
+    names = [event['name'] for event in member_socket.get_received()]
+    # Без порядка полей клиент отбрасывает new_message_packed, поэтому encoding — первым
+    assert names[0] == 'encoding'
+    assert 'unread' in names
+    for socket in (owner_socket, member_socket):
+        socket.disconnect()
@@ -0,0 +1,32 @@
+import app as mateugram
+
+def stored_last_seen(app, user_id):
+    with app.app_context():
+        return mateugram.db.session.get(mateugram.User, user_id).last_seen
+
+def test_last_seen_written_only_when_presence_changes(app, register):
+    account = register()
+    mateugram.flush_last_seen()
+    socket = mateugram.socketio.test_client(app, flask_test_client=account.client)
+    mateugram.flush_last_seen()
+    came_online = stored_last_seen(app, account.id)
+    assert came_online is not None
+
+    # Пока пользователь просто в сети, сброс ничего не пишет и не будит выгрузку на FTP
+    mateugram.change_tracker.take_dirty()
+    mateugram.flush_last_seen()
+    assert not mateugram.change_tracker.take_dirty()
+    assert stored_last_seen(app, account.id) == came_online
+
+    socket.disconnect()
+    mateugram.flush_last_seen()
+    assert stored_last_seen(app, account.id) > came_online
+
+def test_final_flush_writes_users_still_online(app, register):
+    account = register()
+    socket = mateugram.socketio.test_client(app, flask_test_client=account.client)
+    mateugram.flush_last_seen()
+    came_online = stored_last_seen(app, account.id)
+    mateugram.flush_last_seen(include_online=True)
+    assert stored_last_seen(app, account.id) > came_online
+    socket.disconnect()
@@ -0,0 +1,58 @@
+import pytest
+
+import app as mateugram
+
+SERVICE_URLS = ['/cache-stats', '/sync-stats', '/metrics', '/profiler']
+
+@pytest.mark.parametrize('url', SERVICE_URLS)
+def test_service_endpoints_require_secret(app, url):
+    client = app.test_client()
+    assert client.get(url).status_code == 403
+    assert client.get(url, headers={'X-Sync-Secret': 'wrong'}).status_code == 403
+    assert client.get(url, headers={'X-Sync-Secret': mateugram.SYNC_SECRET}).status_code == 200
+
+def test_metrics_accept_bearer_token(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_SECRET', 'prometheus')
+    client = app.test_client()
+    assert client.get('/metrics', headers={'Authorization': 'Bearer prometheus'}).status_code == 200
+    assert client.get('/metrics', headers={'Authorization': 'Bearer nope'}).status_code == 403
+    # Bearer-токен принимается только там, где он предусмотрен
+    assert client.get('/sync-stats', headers={'Authorization': f'Bearer {mateugram.SYNC_SECRET}'}).status_code == 403
+
+@pytest.fixture
+def secret_client(app):
+    client = app.test_client()
+    client.environ_base['HTTP_X_SYNC_SECRET'] = mateugram.SYNC_SECRET
+    yield client
+    mateugram.profiler.configure(False, app.config['SLOW_REQUEST_MS'])
+
+@pytest.mark.parametrize('threshold_ms', ['abc', '', -5, [1]])
+def test_profiler_rejects_bad_threshold(secret_client, threshold_ms):
+    response = secret_client.post('/profiler', json={'threshold_ms': threshold_ms})
+    assert response.status_code == 400
+
+def test_profiler_profiles_one_request_at_a_time(secret_client):
+    assert secret_client.post('/profiler', json={'enabled': True, 'threshold_ms': 0}).status_code == 200
+    before = len(mateugram.profiler.traces)
+    # Пока профилируется другой запрос, этот выполняется без профиля
+    assert mateugram.profiler.running.acquire(blocking=False)
+    try:
+        secret_client.get('/sync-stats')
+    finally:
+        mateugram.profiler.running.release()
+    assert len(mateugram.profiler.traces) == before
+    secret_client.get('/sync-stats')
+    assert len(mateugram.profiler.traces) == before + 1
+    assert mateugram.profiler.running.acquire(blocking=False)
+    mateugram.profiler.running.release()
+
+def test_metric_labels_are_escaped():
+    metrics = mateugram.Metrics()
+    metrics.counter('test_total', 'Test')
+    metrics.inc('test_total', path='a"b\\c\nd')
+    assert 'test_total{path="a\\"b\\\\c\\nd"} 1' in metrics.render()
+
+def test_sql_timer_ignores_unpaired_event(app):
+    class Connection:
+        info = {}
+    mateugram.sql_timer_stop(Connection(), None, 'SELECT 1', (), None, False)
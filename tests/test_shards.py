@@ -0,0 +1,141 @@
+import os
+import re
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+
+import app as mateugram
+from test_memberships import create_group
+from test_messages import send_messages
+
+# Число шардов читается при импорте, поэтому эти тесты идут в отдельном процессе с MESSAGE_SHARDS=2
+sharded = pytest.mark.skipif(mateugram.MESSAGE_SHARDS != 2, reason='MESSAGE_SHARDS=2 only')
+
+@pytest.mark.skipif(mateugram.MESSAGE_SHARDS != 1, reason='already sharded')
+def test_with_two_shards():
+    result = subprocess.run([sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', __file__],
+                            env={**os.environ, 'MESSAGE_SHARDS': '2'}, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout[-3000:]
+    # Пропущен только сам этот тест: шардовые действительно прогнались
+    assert re.search(r'\b1 skipped\b', result.stdout.splitlines()[-1])
+
+@pytest.fixture
+def chats(app, register):
+    """По группе в каждом шарде: {шард: (chat_id, владелец, участник)}."""
+    chats = {}
+    while len(chats) < 2:
+        owner, member = register(), register()
+        chat_id = create_group(owner, member)
+        chats.setdefault(mateugram.shard_of_chat(chat_id), (chat_id, owner, member))
+    return chats
+
+def post(app, account, chat_id, *contents):
+    socket = mateugram.socketio.test_client(app, flask_test_client=account.client)
+    socket.emit('join', {'chat_id': chat_id})
+    ids = send_messages(app, socket, chat_id, *contents)
+    socket.disconnect()
+    return ids
+
+def stored(app, shard, table, column, value):
+    """id строк таблицы в файле шарда — мимо ShardedSession."""
+    with app.app_context(), mateugram.shard_engine(shard).connect() as conn:
+        return [row.id for row in conn.execute(mateugram.db.text(
+            f'SELECT id FROM "{table}" WHERE {column} = :value ORDER BY id'), {'value': value})]
+
+@sharded
+def test_messages_go_to_the_shard_of_their_chat(app, chats):
+    for shard, (chat_id, owner, member) in chats.items():
+        assert chat_id % 2 == shard
+        ids = post(app, owner, chat_id, 'раз', 'два')
+        assert stored(app, shard, 'message', 'chat_id', chat_id) == ids
+        assert stored(app, 1 - shard, 'message', 'chat_id', chat_id) == []
+        # Шард виден по одному id
+        assert all(message_id // mateugram.SHARD_ID_SPAN == shard for message_id in ids)
+        assert {mateugram.shard_of_message(message_id) for message_id in ids} == {shard}
+
+@sharded
+def test_message_id_selects_the_shard(app, chats):
+    (chat0, owner0, member0), (chat1, owner1, member1) = chats[0], chats[1]
+    message_id, = post(app, owner1, chat1, 'пост')
+    member1.client.post('/react', json={'message_id': message_id, 'reaction': '👍'})
+    member1.client.post(f'/message/{message_id}/comments', data={'content': 'комментарий'})
+    assert len(stored(app, 1, 'reaction', 'message_id', message_id)) == 1
+    assert len(stored(app, 1, 'comment', 'message_id', message_id)) == 1
+    assert stored(app, 0, 'reaction', 'message_id', message_id) == []
+    # Пересылка читает оригинал в его шарде и пишет копию в шард получателя
+    owner0.client.post(f'/chat/{chat0}/add_member', data={'username': owner1.username})
+    assert owner1.client.post('/forward', json={'message_id': message_id, 'to_chat_id': chat0}).json['success']
+    with app.app_context(), mateugram.shard_scope(0):
+        copy = mateugram.Message.query.filter_by(chat_id=chat0, forwarded_from=message_id).one()
+    assert mateugram.shard_of_message(copy.id) == 0
+
+@sharded
+def test_unselected_shard_fails_loudly(app, chats):
+    with app.app_context(), mateugram.shard_scope(None):
+        with pytest.raises(RuntimeError, match='Shard is not selected for table message'):
+            mateugram.Message.query.count()
+        # Таблицы основной базы шард не требуют
+        assert mateugram.db.session.get(mateugram.Chat, chats[0][0])
+
+def history(account, chat_id):
+    """Вся история чата через API: содержимое, ответ (по содержимому), реакции и комментарии."""
+    url = f'/api/v1/chats/{chat_id}/messages'
+    page = account.client.get(url).json
+    messages = page['messages']
+    while page['has_more']:
+        page = account.client.get(url, query_string={'before': messages[0]['id']}).json
+        messages = page['messages'] + messages
+    content = {m['id']: m['content'] for m in messages}
+    return [(m['content'], content.get(m['reply_to']), m['reactions'],
+             [c['content'] for c in account.client.get(f"/api/v1/messages/{m['id']}/comments").json['comments']])
+            for m in messages]
+
+@sharded
+def test_split_keeps_history(app, chats, monkeypatch):
+    monkeypatch.setitem(app.config, 'CHAT_PAGE_SIZE', 2)
+    # Таблицы сообщений в основной базе, как до включения шардов; id — старые, без диапазона шарда
+    tables = [t for t in mateugram.db.metadata.sorted_tables if t.name in mateugram.SHARDED_TABLES]
+    expected = {}
+    with app.app_context():
+        mateugram.db.metadata.create_all(mateugram.db.engine, tables=tables)
+        message, reaction, comment = (mateugram.db.metadata.tables[name] for name in ('message', 'reaction', 'comment'))
+        with mateugram.db.engine.begin() as conn:
+            next_id = 10 ** 6
+            for shard, (chat_id, owner, member) in sorted(chats.items()):
+                first, second, third = next_id, next_id + 1, next_id + 2
+                next_id += 3
+                conn.execute(message.insert(), [
+                    {'id': first, 'chat_id': chat_id, 'sender_id': owner.id, 'content': f'раз {shard}',
+                     'reply_to': None, 'created_at': datetime.utcnow()},
+                    {'id': second, 'chat_id': chat_id, 'sender_id': member.id, 'content': f'два {shard}',
+                     'reply_to': first, 'created_at': datetime.utcnow()},
+                    {'id': third, 'chat_id': chat_id, 'sender_id': owner.id, 'content': f'три {shard}',
+                     'reply_to': None, 'created_at': datetime.utcnow()}])
+                conn.execute(reaction.insert(), {'id': first, 'message_id': first, 'user_id': member.id,
+                                                 'reaction': '👍'})
+                conn.execute(comment.insert(), {'id': second, 'message_id': second, 'user_id': owner.id,
+                                                'content': f'комментарий {shard}', 'created_at': datetime.utcnow()})
+                conn.execute(message.update().where(message.c.id == second).values(comment_count=1))
+                expected[chat_id] = [(f'раз {shard}', None, [[member.id, '👍']], []),
+                                     (f'два {shard}', f'раз {shard}', [], [f'комментарий {shard}']),
+                                     (f'три {shard}', None, [], [])]
+        assert mateugram.split_into_shards() == 10
+        assert 'message' not in mateugram.db.inspect(mateugram.db.engine).get_table_names()
+    for shard, (chat_id, owner, member) in chats.items():
+        assert history(owner, chat_id) == expected[chat_id]
+        assert {message_id // mateugram.SHARD_ID_SPAN for message_id in stored(app, shard, 'message', 'chat_id', chat_id)} == {shard}
+
+@sharded
+def test_sync_uploads_only_the_touched_shard(app, chats, monkeypatch):
+    chat_id, owner, member = chats[1]
+    message_id, = post(app, owner, chat_id, 'пост')
+    monkeypatch.setattr(mateugram, 'request_sync', lambda: None)
+    mateugram.change_tracker.take_databases()
+    member.client.post('/react', json={'message_id': message_id, 'reaction': '👍'})
+    assert mateugram.change_tracker.stats()['dirty_databases'] == ['mateugram-shard1.db']
+    uploaded = []
+    monkeypatch.setattr(mateugram, 'upload_file_to_ftp', lambda local, remote: uploaded.append(remote) or True)
+    mateugram.sync_to_ftp()
+    assert uploaded == ['mateugram-shard1.db']
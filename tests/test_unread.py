@@ -0,0 +1,91 @@
+import pytest
+
+import app as mateugram
+from test_memberships import create_group
+
+def test_taken_counts_stay_visible_until_written():
+    counters = mateugram.UnreadCounters()
+    counters.add(1, [7])
+    counters.take()
+    assert counters.apply(7, {1: 3}) == {1: 4}
+    counters.done()
+    assert counters.apply(7, {1: 4}) == {1: 4}
+
+def test_failed_write_merges_back():
+    counters = mateugram.UnreadCounters()
+    counters.add(1, [7])
+    counters.add(2, [7])
+    counters.reset(7, 3)
+    counters.take()
+    counters.add(1, [7])
+    counters.reset(7, 2)
+    counters.restore()
+    deltas, resets = counters.take()
+    # Обнуление после снятия отменяет незаписанное приращение
+    assert deltas == {(7, 1): 2}
+    assert resets == {(7, 2), (7, 3)}
+
+def chat_unread(account, chat_id):
+    chats = account.client.get('/api/v1/chats').json['chats']
+    return next(chat['unread'] for chat in chats if chat['id'] == chat_id)
+
+@pytest.fixture
+def unread_chat(app, register):
+    owner, member = register(), register()
+    chat_id = create_group(owner, member)
+    socket = mateugram.socketio.test_client(app, flask_test_client=owner.client)
+    socket.emit('join', {'chat_id': chat_id})
+    yield chat_id, owner, member, socket
+    socket.disconnect()
+
+def test_flush_error_keeps_counts(app, unread_chat, monkeypatch):
+    chat_id, owner, member, socket = unread_chat
+    socket.emit('send_message', {'chat_id': chat_id, 'content': 'раз'})
+
+    def fail():
+        raise RuntimeError('database is locked')
+    with monkeypatch.context() as patch:
+        patch.setattr(mateugram.db.session, 'commit', fail)
+        with pytest.raises(RuntimeError):
+            mateugram.flush_unread()
+    assert chat_unread(member, chat_id) == 1
+    mateugram.flush_unread()
+    assert chat_unread(member, chat_id) == 1
+
+def test_api_read_is_explicit(app, unread_chat):
+    chat_id, owner, member, socket = unread_chat
+    socket.emit('send_message', {'chat_id': chat_id, 'content': 'раз'})
+    assert member.client.get(f'/api/v1/chats/{chat_id}/messages').status_code == 200
+    assert chat_unread(member, chat_id) == 1
+    assert member.client.post(f'/api/v1/chats/{chat_id}/read').json == {'success': True}
+    assert chat_unread(member, chat_id) == 0
+
+def test_counts_are_written_at_once_with_several_workers(app, unread_chat, monkeypatch):
+    monkeypatch.setitem(app.config, 'SOCKETIO_MESSAGE_QUEUE', 'redis://queue')
+    chat_id, owner, member, socket = unread_chat
+    socket.emit('send_message', {'chat_id': chat_id, 'content': 'раз'})
+    with app.app_context():
+        stored = mateugram.ChatMember.query.filter_by(user_id=member.id, chat_id=chat_id).one().unread_count
+    assert stored == 1
+
+def test_opening_read_chat_leaves_database_clean(app, unread_chat):
+    chat_id, owner, member, socket = unread_chat
+    mateugram.flush_unread()
+    mateugram.change_tracker.take_dirty()
+    member.client.get(f'/chat/{chat_id}')
+    member_socket = mateugram.socketio.test_client(app, flask_test_client=member.client)
+    member_socket.emit('join', {'chat_id': chat_id})
+    member_socket.disconnect()
+    mateugram.flush_unread()
+    assert not mateugram.change_tracker.take_dirty()
+
+def test_reading_unread_chat_is_written_once(app, unread_chat):
+    chat_id, owner, member, socket = unread_chat
+    socket.emit('send_message', {'chat_id': chat_id, 'content': 'раз'})
+    mateugram.flush_unread()
+    changes = mateugram.change_tracker.stats()['table_changes'].get('chat_member', 0)
+    assert member.client.post(f'/api/v1/chats/{chat_id}/read').status_code == 200
+    assert member.client.post(f'/api/v1/chats/{chat_id}/read').status_code == 200
+    mateugram.flush_unread()
+    assert mateugram.change_tracker.stats()['table_changes']['chat_member'] == changes + 1
+    assert chat_unread(member, chat_id) == 0
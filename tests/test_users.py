@@ -0,0 +1,76 @@
+from sqlalchemy import event
+
+import app as mateugram
+
+def test_lru_cache_evicts_oldest(monkeypatch):
+    cache = mateugram.LRUCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' дольше всех не читали
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+def test_lru_cache_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(mateugram.time, 'monotonic', lambda: now[0])
+    cache = mateugram.LRUCache(10, 60)
+    cache.set('a', 1)
+    now[0] += 59
+    assert cache.get('a') == 1
+    now[0] += 2
+    assert cache.get('a', 'miss') == 'miss'
+    assert cache.stats()['size'] == 0
+
+class StatementLog(list):
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.append(statement)
+
+def test_load_user_hit_runs_no_select(app, register):
+    account = register()
+    with app.test_request_context():
+        mateugram.invalidate_user(account.id)
+        mateugram.load_user(str(account.id))
+    with app.test_request_context():
+        with StatementLog(mateugram.db.engine) as statements:
+            user = mateugram.load_user(str(account.id))
+            assert user.username == account.username and user.first_name == account.username.title()
+        assert statements == []
+        # Поля вне кэша дочитываются из базы по требованию
+        assert user.check_password('pw')
+
+def test_settings_change_is_not_served_stale(app, register):
+    account = register()
+    account.client.get('/chats')
+    assert mateugram.user_profile_cache.get(account.id)['first_name'] == account.username.title()
+    account.client.post('/settings', data={'first_name': 'Переименован'})
+    # Профиль, собранный из кэша в load_user, сохраняется как обычный объект сессии
+    with app.app_context():
+        assert mateugram.db.session.get(mateugram.User, account.id).first_name == 'Переименован'
+        assert mateugram.get_user_profile(account.id).first_name == 'Переименован'
+    assert 'Переименован' in account.client.get('/settings').get_data(as_text=True)
+
+def test_new_avatar_is_not_served_stale(app, register):
+    import io
+    from PIL import Image
+    account = register()
+    account.client.get('/chats')
+    data = io.BytesIO()
+    Image.new('RGB', (50, 50)).save(data, format='PNG')
+    data.seek(0)
+    account.client.post('/setup_profile', data={'avatar': (data, 'face.png')}, content_type='multipart/form-data')
+    with app.app_context():
+        avatar = mateugram.db.session.get(mateugram.User, account.id).avatar
+        assert avatar and mateugram.get_user_profile(account.id).avatar == avatar